@@ -2,17 +2,30 @@ import os
 import pandas as pd
 import numpy as np
 import SimpleITK as sitk
-from collections import OrderedDict
+from collections import OrderedDict, deque
 from pathlib import Path
 from tqdm.auto import tqdm
-import copy
+import threading
+import queue
+from concurrent.futures import ThreadPoolExecutor
+import hashlib
+import pydicom
 
 from .SegmentationLoader import SegmentationLoader
-from .utils import DataFrameUtils, JsonUtils
+from .utils import DataFrameUtils, JsonUtils, ShardUtils, StudyJsonWriter
 from .utils import GetDirectionDict
 from .pydicom_utils import DCMUtils
 from .sitk_utils import SitkUtils
+from .file_utils import FileUtils
+from .Prefetcher import Prefetcher
+from .VolumeStore import VolumeStore
+from .Manifest import Manifest, SeriesRecord
+from .SOPIndex import SOPIndex
+from .SliceGrouper import SliceGrouper
+from .StudyValidator import StudyValidator
+from .WorkPlanner import WorkPlanner
 from .IssueLogger import IssueLogger
+from .Metrics import Metrics
 
 
 class ImageLoader:
@@ -22,7 +35,18 @@ class ImageLoader:
                         parquet_segmentations: Path or pd.DataFrame = None,
                         add_columns: list or str = None,
                         reset_logger: bool = True,
-                        extract_nii: bool = False
+                        extract_nii: bool = False,
+                        shard: str = None,
+                        shard_plan: Path = None,
+                        patients: list = None,
+                        studies: list = None,
+                        series_types: list = None,
+                        provided_by: list = None,
+                        manufacturer: list = None,
+                        io_workers: int = 8,
+                        seg_workers: int = 1,
+                        prefetcher: Prefetcher = None,
+                        sop_index: Path = 'sop_index.sqlite'
     ) -> None:
         
         self.images_directory_path = images_directory_path
@@ -30,6 +54,40 @@ class ImageLoader:
         self.parquet_segmentations = parquet_segmentations
         self.add_columns = add_columns
         self.extract_nii = extract_nii
+        self.io_workers = io_workers
+
+        # SEG extraction threads. With more than one, the SEGs are extracted alongside the header scan
+        self.seg_workers = seg_workers
+        self.segmentation_jobs = []
+        self.segmentation_pool = None
+
+        # Optional read-ahead of the next series while the current one is parsed, also passed to DICOM2NII.
+        # Only the headers are fetched, None fetches the whole files (DICOM2NII.ExecuteFused reads their pixels next)
+        self.prefetcher = prefetcher
+        self.prefetch_head_bytes = 2**17
+
+        # "i/N": only the patients of this shard are processed, manifest and issues are written per shard
+        # shard_plan: split of the patients by cost (WorkPlanner), the sha1 split otherwise
+        self.shard = shard
+        self.shard_plan = JsonUtils.Load(shard_plan) if shard_plan else None
+        self.image_loader_path = ShardUtils.ShardPath('image_loader.json', shard)
+        self.issues_path = ShardUtils.ShardPath('issues/image_loader_issues.json', shard)
+
+        # SOP Instance UID -> path index, filled during the header scan. None to disable
+        # Opened by the scan (OpenSOPIndex) and closed when it ends, constructing the loader creates no file
+        self.sop_index_path = ShardUtils.ShardPath(sop_index, shard) if sop_index else None
+        self.sop_index = None
+
+        # Restrict the run to a subset of the parquet, values as stored in the parquet (e.g. user_series_type 'T2AX')
+        # Filters are pushed down to pyarrow, only the row groups needed are read
+        self.row_filters = [    (column, 'in', [values] if isinstance(values, str) else list(values))
+                                for column, values in [ ('patient_id', patients),
+                                                        ('study_uid', studies),
+                                                        ('user_series_type', series_types),
+                                                        ('provided_by', provided_by),
+                                                        ('manufacturer', manufacturer) ]
+                                if values is not None
+        ]
         
 
         self.default_cols = [
@@ -46,9 +104,34 @@ class ImageLoader:
                                 'use_case_form'
         ]
         
-        self.logger = IssueLogger(reset = reset_logger)
+        self.logger = IssueLogger(reset = reset_logger, issue_logger = self.issues_path)
 
         
+    def OpenSOPIndex(self, create: bool = True) -> SOPIndex or None:
+        '''
+        The SOP Instance UID index of the loader, opened on first use. create=False: only an index already on disk
+        '''
+        if self.sop_index is None and self.sop_index_path and (create or os.path.isfile(self.sop_index_path)):
+            self.sop_index = SOPIndex(self.sop_index_path)
+
+        return self.sop_index
+
+    def Close(self) -> None:
+        '''
+        Close the SOP Instance UID index, opened again by the next scan
+        '''
+        if self.sop_index is not None:
+            self.sop_index.Close()
+            self.sop_index = None
+
+    def __enter__(self):
+
+        return self
+
+    def __exit__(self, *exc):
+
+        self.Close()
+
 #%% parquet related process
 
     def PrintDefaultColumns(self):
@@ -92,13 +175,13 @@ class ImageLoader:
                 self.logger.LogIssue( 'select_col', {'bad_format':'Use strings with "," delimeter or list'} )
         
 
-        self.df = DataFrameUtils.Read(self.parquet_series)
+        available_columns = DataFrameUtils.Columns(self.parquet_series)
 
-        self.selected_columns = [col for col in self.default_cols if col in self.df]
+        self.selected_columns = [col for col in self.default_cols if col in available_columns]
 
         for col in self.default_cols:
 
-                if col not in self.df.columns:
+                if col not in available_columns:
 
                     print(f'Default column named "{col}" does not exist inside parquet file and it will be ignored')
 
@@ -106,7 +189,7 @@ class ImageLoader:
 
         for col in select_columns:
 
-            if col not in self.df.columns:
+            if col not in available_columns:
 
                 print(f'"{col}" does not exist inside parquet file and it will be ignored')
 
@@ -116,18 +199,22 @@ class ImageLoader:
 
                 self.selected_columns.append(col)
 
-        self.df = self.df[self.selected_columns].copy()
+        self.df = DataFrameUtils.Read(self.parquet_series, columns=self.selected_columns, filters=self.row_filters).copy()
+
+        if self.shard:
+            self.df = self.df[ self.df.patient_id.map( lambda patient: ShardUtils.InShard(patient, self.shard, self.shard_plan) ) ].copy()
         
         if isinstance(self.parquet_segmentations, pd.DataFrame):
             pass
         elif self.parquet_segmentations != None:
-            self.seg_df = DataFrameUtils.Read(self.parquet_segmentations)
+            self.df_seg = DataFrameUtils.Read(self.parquet_segmentations, columns=['source_series_uid'])
+            self.seg_sources = set(self.df_seg.source_series_uid)
             
         return self.df
     
     def __CheckPathExist(self) -> bool:
         
-        path_exists = os.path.exists(self.series_path)
+        path_exists = self.series_files.get(self.series_path) is not None
 
         if not path_exists:
             self.logger.LogIssue('FileNotFound',{self.series_path:'Not found'})
@@ -139,13 +226,40 @@ class ImageLoader:
         Checks if the images with same slice location and same bvalue ('N/A' if not DWI) are the same
         '''
 
-        A = SitkUtils.LoadSingleFile(imageA)
-        A = sitk.GetArrayFromImage(A)
+        with Metrics.Stage('duplicate_check') as stage:
+
+            A = SitkUtils.LoadSingleFile(imageA)
+            A = sitk.GetArrayFromImage(A)
+
+            B = SitkUtils.LoadSingleFile(imageB)
+            B = sitk.GetArrayFromImage(B)
 
-        B = SitkUtils.LoadSingleFile(imageB)
-        B = sitk.GetArrayFromImage(B)
+            if Metrics.enabled:
+                stage.Count(files=2, bytes_read=Metrics.FileSize([imageA, imageB]))
 
         return np.array_equal(A, B)
+
+    def __PixelDigest(self, image: Path, frame: int = None) -> str:
+        '''
+        Digest of the pixel data, DWI slices with the same origin and header values are compared with it.
+        frame: index of the frame inside a multi-frame file
+        '''
+
+        with Metrics.Stage('duplicate_check') as stage:
+
+            if frame is None:
+                ITK = SitkUtils.LoadSingleFile(image)
+
+            else:
+                ITK = SitkUtils.LoadFrames([{'path': image, 'frame': frame}])
+
+            pixels = sitk.GetArrayViewFromImage(ITK)
+            digest = f'{pixels.dtype}{pixels.shape}' + hashlib.sha1(pixels.tobytes()).hexdigest()
+
+            if Metrics.enabled:
+                stage.Count(files=1, bytes_read=Metrics.FileSize(image))
+
+        return digest
     
     def GetMetaData(self, data: pd.DataFrame) -> dict:
 
@@ -172,129 +286,85 @@ class ImageLoader:
 
                 return temp_meta
     
-    def __GetPatientsWithOnlyUnknown(self) -> list:
-
-        unkwnown_dwi_pat = []
-        
-        for patient,pval in self.image_loader.items():
-
-            for study,stval in pval.items():
-
-                if 'DWI' not in stval:
-                    continue
-                
-                if len(stval['DWI'].keys() ) == 1:
-                    continue
-
-                bval_keys = list(stval['DWI'].keys())
-
-                count_unknown = 0
-
-                for bval_key in bval_keys:
-                    if 'Unknown' in str(bval_key):
-                        count_unknown += 1
-
-                if (count_unknown <= 1) or (len( set ( bval_keys ) ) != count_unknown):
-                    continue
-
-                unkwnown_dwi_pat.append(patient)
-
-        return unkwnown_dwi_pat
-
-    
-    def __OrderMultipleUnknownDWISeries(self):
-
-        unkwnown_dwi = self.__GetPatientsWithOnlyUnknown()
-        self.AvoidDWI = {}
-
-        orderbymax_meanvalue_dict = {}
-        for patient in unkwnown_dwi:
-
-            orderbymax_meanvalue_dict[patient] = {}
-
-            for study,stval in self.image_loader[patient].items():
-
-                if 'DWI' not in stval:
-                    continue
-        
-                orderbymax_meanvalue_dict[patient][study] = {}
-
-                unknown_keys = list( stval['DWI'].keys() )
-                pos_keys = list ( stval['DWI'][unknown_keys[0]]['dcm_path'].keys() )
-
-                slice_len = 0
-    
-                for b in unknown_keys:
-
-                    N_image_size = len( self.image_loader[patient][study]['DWI'][b]['dcm_path'].keys() )
+    def __OnlyUnknownDWI(self, patient: str, study: str) -> bool:
+        '''
+        The DWI of the study has more than one series and none of them has a known b-value
+        '''
+        stval = self.image_loader[patient][study]
 
-                    if N_image_size > slice_len:
-                        slice_len = N_image_size
-                
-                temp_unknown_keys = [b for b in unknown_keys if  len( self.image_loader[patient][study]['DWI'][b]['dcm_path'].keys()) == slice_len]
+        if 'DWI' not in stval or len( stval['DWI'].keys() ) == 1:
+            return False
 
-                for b in unknown_keys:
+        bval_keys = list(stval['DWI'].keys())
+        count_unknown = sum( 'Unknown' in str(bval_key) for bval_key in bval_keys )
 
-                    if b not in temp_unknown_keys:
-                        self.logger.LogIssue('DWIMultiSeriesNotSameSliceNumber',{ f'{patient}_{study}_{unknownkey}': len( self.image_loader[patient][study]['DWI'][unknownkey]['dcm_path'].keys())
-                                                                        for unknownkey in unknown_keys
-                                                                        }
-                        )
+        return count_unknown > 1 and len( set(bval_keys) ) == count_unknown
 
-                        self.AvoidDWI.update({patient:{study:b}})
+    def __OrderUnknownDWI(self, patient: str, study: str) -> None:
+        '''
+        Slices of the DWI series without a known b-value assigned to them by decreasing max and mean of the slice,
+        at every position. Only the series with the most slices are ordered.
+        '''
+        if not self.__OnlyUnknownDWI(patient, study):
+            return
 
-                unknown_keys = temp_unknown_keys
+        stval = self.image_loader[patient][study]
 
-                for pos in pos_keys:
+        unknown_keys = list( stval['DWI'].keys() )
+        pos_keys = stval['DWI'][unknown_keys[0]].positions.tolist()
 
-                    orderbymax_meanvalue_dict[patient][study][pos] = {}
+        slice_len = max( stval['DWI'][b].Count() for b in unknown_keys )
 
-                    for unknownB in unknown_keys:
+        temp_unknown_keys = [b for b in unknown_keys if stval['DWI'][b].Count() == slice_len]
 
-                        temp_path = stval['DWI'][unknownB]['dcm_path'][pos]['path']
-                        temp_img = sitk.ReadImage(temp_path)
-                        temp_max = sitk.GetArrayFromImage(temp_img).max()
-                        temp_mean = sitk.GetArrayFromImage(temp_img).mean()
-                        
-                        orderbymax_meanvalue_dict[patient][study][pos][f"{temp_max}_{temp_mean}"] = temp_path
+        for b in unknown_keys:
 
-                    orderbymax_meanvalue_dict[patient][study][pos] = OrderedDict(   sorted (orderbymax_meanvalue_dict [patient][study][pos].items(), 
-                                                                                    key=lambda x: (float(x[0].split('_')[0]), float(x[0].split('_')[1])), 
-                                                                                    reverse=True)
-                    )
+            if b not in temp_unknown_keys:
+                self.logger.LogIssue('DWIMultiSeriesNotSameSliceNumber',{ f'{patient}_{study}_{unknownkey}': stval['DWI'][unknownkey].Count()
+                                                                for unknownkey in unknown_keys
+                                                                }
+                )
 
+                self.AvoidDWI.update({patient:{study:b}})
 
-    
-        for patient in unkwnown_dwi:
+        unknown_keys = temp_unknown_keys
 
-            for study,stval in self.image_loader[patient].items():
+        # Every position is ranked before a path is changed
+        orderbymax_meanvalue_dict = {}
 
-                if 'DWI' not in stval:
-                    continue
+        for pos in pos_keys:
 
-                unknown_keys = list( stval['DWI'].keys() )
-                pos_keys = list ( stval['DWI'][unknown_keys[0]]['dcm_path'].keys() )
+            orderbymax_meanvalue_dict[pos] = {}
 
-                slice_len = 0
+            for unknownB in unknown_keys:
 
-                for b in unknown_keys:
+                record = stval['DWI'][unknownB]
+                temp_path = record.Path( record.Index(pos) )
+                temp_frame = record.Frame( record.Index(pos) )
 
-                    N_image_size = len( self.image_loader[patient][study]['DWI'][b]['dcm_path'].keys() )
+                if temp_frame is None:
+                    temp_img = sitk.ReadImage(temp_path)
+                else:
+                    temp_img = SitkUtils.LoadFrames([{'path': temp_path, 'frame': temp_frame}])
 
-                    if N_image_size > slice_len:
-                        slice_len = N_image_size
+                temp_max = sitk.GetArrayFromImage(temp_img).max()
+                temp_mean = sitk.GetArrayFromImage(temp_img).mean()
                 
-                unknown_keys = [b for b in unknown_keys if  len( self.image_loader[patient][study]['DWI'][b]['dcm_path'].keys()) == slice_len]
-
+                orderbymax_meanvalue_dict[pos][f"{temp_max}_{temp_mean}"] = (temp_path, temp_frame)
 
-                for pos in pos_keys:
+            orderbymax_meanvalue_dict[pos] = OrderedDict(   sorted (orderbymax_meanvalue_dict[pos].items(), 
+                                                            key=lambda x: (float(x[0].split('_')[0]), float(x[0].split('_')[1])), 
+                                                            reverse=True)
+            )
 
-                    max_values = list ( orderbymax_meanvalue_dict[patient][study][pos].keys() )
+        for pos in pos_keys:
 
-                    for i,unknownB in enumerate(unknown_keys):
-                        self.image_loader[patient][study]['DWI'][unknownB]['dcm_path'][pos]['path'] = orderbymax_meanvalue_dict[patient][study][pos][max_values[i]]
-                        self.image_loader[patient][study]['DWI'][unknownB]['dcm_path'][pos]['max_mean'] = max_values[i]
+            max_values = list ( orderbymax_meanvalue_dict[pos].keys() )
 
+            for i,unknownB in enumerate(unknown_keys):
+                record = stval['DWI'][unknownB]
+                temp_path, temp_frame = orderbymax_meanvalue_dict[pos][max_values[i]]
+                record.SetPath( record.Index(pos), temp_path, max_mean = max_values[i], frame = temp_frame )
 
     def OrderFileSeries(self, series_files:tuple):
 
@@ -328,128 +398,147 @@ class ImageLoader:
         duplicates_found = []
         direction_dict = GetDirectionDict()
         rescale_type = None
+        instances = []
+        dwi_slices = []
 
         for file in series_files:
 
             file = file.replace('\\','/')
             
             #Pydicom is used for bvalues at this point. Sitk does not decode the b-values and in some cases return None for unreadable tags
-            dcm_img = DCMUtils.ReadSlice(file)
-            sitk_img = SitkUtils.ReadImageInfo(file)
+            with Metrics.Stage('header_parse') as stage:
 
-            plane = SitkUtils.GetImagePlane(sitk_img)
+                try:
+                    dcm_file = DCMUtils.ReadSlice(file, stop_before_pixels=True)
 
-            origin_idx = direction_dict[plane]['origin']
-            plane_name = direction_dict[plane]['plane']
+                except pydicom.errors.InvalidDicomError:
+                    # The directory listing is not filtered by GDCM anymore
+                    self.logger.LogIssue('NotDICOMFile',{file:f'Skipped, inside series {self.series_uid}'})
+                    continue
 
-            if plane_name not in plane_found:
-                plane_found.append(plane_name)
+                #Enhanced (multi-frame) files: every frame is a slice, described by its functional groups
+                if DCMUtils.IsMultiFrame(dcm_file):
 
+                    file_slices = [ (frame, dcm_img) + DCMUtils.GetFrameGeometry(dcm_img) + (DCMUtils.GetRawBValue(dcm_img),)
+                                    for frame, dcm_img in enumerate( DCMUtils.GetFrames(dcm_file) ) ]
 
+                else:
 
-            origin = sitk_img.GetOrigin()
+                    sitk_img = SitkUtils.ReadImageInfo(file)
+                    file_slices = [ (None, dcm_file, sitk_img.GetOrigin(), sitk_img.GetDirection(), SitkUtils.GetBvalue(sitk_img)) ]
 
-            bvalue = 'N/A'
+                if Metrics.enabled:
+                    stage.Count(files=1, bytes_read=Metrics.FileSize(file))
 
-            if sequence != 'DWI':
+            sop_uid = str( dcm_file.get('SOPInstanceUID', '') )
 
-                if bvalue not in location_dict:
-                    
-                    location_dict[bvalue] = {
-                                                'origin': [],
-                                                'main_plane_origin': [],
-                                                'path': []                            
-                }
-                    
-                if origin in location_dict[bvalue]['origin']:
+            for frame, dcm_img, origin, direction, sitk_bvalue in file_slices:
 
-                    same_origin = location_dict[bvalue]['origin'].index(origin)
-                    comparison_image_path = location_dict[bvalue]['path'][same_origin]
+                plane = SitkUtils.GetDirectionPlane(direction)
 
-                    if self.__CheckDuplicate(file, comparison_image_path):
-                        duplicates_found.append(file)
-                        self.logger.LogIssue( 'DuplicateDetected', { self.series_uid: duplicates_found} )
-                        continue
-                    
-                    else:
+                origin_idx = direction_dict[plane]['origin']
+                plane_name = direction_dict[plane]['plane']
 
-                        self.logger.LogIssue( 'SameOriginFound', { self.series_uid: 'No Duplicate Image'} )
-                        continue
+                if plane_name not in plane_found:
+                    plane_found.append(plane_name)
 
+                #One row per file, the frames of a multi-frame file are indexed by their first one
+                if not frame:
+                    instances.append( (sop_uid, file, self.patient_id, self.study_uid, origin[origin_idx], dcm_file.get('Rows'), dcm_file.get('Columns')) )
 
-                location_dict[bvalue]['origin'].append(origin)
-                location_dict[bvalue]['main_plane_origin'].append(origin[origin_idx])
-                location_dict[bvalue]['path'].append(file)
+                bvalue = 'N/A'
 
-                if sequence == 'ADC' and (0x0028,0x1054) in dcm_img:
+                if sequence != 'DWI':
 
-                    rescale_type = dcm_img[(0x0028,0x1054)].value
+                    if bvalue not in location_dict:
+                        
+                        location_dict[bvalue] = {
+                                                    'origin': [],
+                                                    'main_plane_origin': [],
+                                                    'path': [],
+                                                    'sop': [],
+                                                    'frame': []
+                    }
+                        
+                    if origin in location_dict[bvalue]['origin']:
 
+                        same_origin = location_dict[bvalue]['origin'].index(origin)
+                        comparison_image_path = location_dict[bvalue]['path'][same_origin]
+                        comparison_frame = location_dict[bvalue]['frame'][same_origin]
 
+                        #Same SOP Instance UID (and frame) is the same instance, pixels are compared only otherwise
+                        if sop_uid and (sop_uid, frame) == (location_dict[bvalue]['sop'][same_origin], comparison_frame):
+                            duplicate = True
 
-            if sequence == 'DWI':
-                self.check = dcm_img
-                bvalue, message = DCMUtils.GetBValue(dcm_img)
-                sitk_bvalue = SitkUtils.GetBvalue(sitk_img)
+                        elif frame is None and comparison_frame is None:
+                            duplicate = self.__CheckDuplicate(file, comparison_image_path)
 
-                if bvalue == None:
-                    
-                    self.logger.LogIssue('MissingBValue',{self.series_uid:f'{message} and {df_bvalue} in parquet'})
-                    bvalue = 'Unknown'
+                        else:
+                            duplicate = self.__PixelDigest(file, frame) == self.__PixelDigest(comparison_image_path, comparison_frame)
 
-                if bvalue not in location_dict:
-                    
-                    location_dict[bvalue] = {
-                                                'origin': [],
-                                                'main_plane_origin': [],
-                                                'path': []                            
-                }
-                
-                if bvalue in location_dict:
-                    
-                    counter = 0
-                    no_duplicated = True
+                        if duplicate:
+                            duplicates_found.append(file)
+                            self.logger.LogIssue( 'DuplicateDetected', { self.series_uid: duplicates_found} )
+                            continue
+                        
+                        else:
 
-                    while (origin in location_dict[bvalue]['origin']) and no_duplicated :
+                            self.logger.LogIssue( 'SameOriginFound', { self.series_uid: 'No Duplicate Image'} )
+                            continue
 
-                        base = bvalue.split('-')[0]
-                        same_origin = location_dict[bvalue]['origin'].index(origin)
-                        comparison_image_path = location_dict[bvalue]['path'][same_origin]
-                        counter += 1
-                        bvalue = base+f'-{counter}'
 
-                        if self.__CheckDuplicate(file, comparison_image_path):
+                    location_dict[bvalue]['origin'].append(origin)
+                    location_dict[bvalue]['main_plane_origin'].append(origin[origin_idx])
+                    location_dict[bvalue]['path'].append(file)
+                    location_dict[bvalue]['sop'].append(sop_uid)
+                    location_dict[bvalue]['frame'].append(frame)
 
-                            no_duplicated = False
-                            duplicates_found.append(file)
-                            self.logger.LogIssue( 'DuplicateDetected', { self.series_uid: duplicates_found} )
-                            bvalue = bvalue.split('-')[0]
+                    if sequence == 'ADC' and (0x0028,0x1054) in dcm_img:
 
-                            continue
+                        rescale_type = dcm_img[(0x0028,0x1054)].value
 
-                        if bvalue not in location_dict:
-                    
-                            location_dict[bvalue] = {
-                                                        'origin': [],
-                                                        'main_plane_origin': [],
-                                                        'path': []                            
-                            }
 
-                if bvalue not in bvalue_list:
-                    bvalue_list.append(bvalue)
 
-                if sitk_bvalue not in original_bvalue:
-                    original_bvalue.append(sitk_bvalue)
+                if sequence == 'DWI':
+                    self.check = dcm_img
+                    bvalue, message = DCMUtils.GetBValue(dcm_img)
 
+                    if bvalue == None:
+                        
+                        self.logger.LogIssue('MissingBValue',{self.series_uid:f'{message} and {df_bvalue} in parquet'})
+                        bvalue = 'Unknown'
+
+                    if sitk_bvalue not in original_bvalue:
+                        original_bvalue.append(sitk_bvalue)
+
+                    #Slices with the same b-value and origin are split into volumes once all the headers are read
+                    dwi_slices.append( SliceGrouper.SliceInfo(len(dwi_slices), file, dcm_img, bvalue, origin, origin[origin_idx], sop_uid, frame) )
+
+        if dwi_slices:
 
-                location_dict[bvalue]['origin'].append(origin)
-                location_dict[bvalue]['main_plane_origin'].append(origin[origin_idx])
-                location_dict[bvalue]['path'].append(file)
+            with Metrics.Stage('dwi_grouping'):
+                volumes, duplicates = SliceGrouper.Group(dwi_slices, self.__PixelDigest)
+
+            for bvalue, volume in volumes.items():
+
+                location_dict[bvalue] = {
+                                            'origin': [info['origin'] for info in volume],
+                                            'main_plane_origin': [info['main_origin'] for info in volume],
+                                            'path': [info['file'] for info in volume],
+                                            'sop': [info['sop'] for info in volume],
+                                            'frame': [info['frame'] for info in volume]
+                }
 
+            #SliceGrouper.Group orders the volumes by b-value
+            bvalue_list = list(volumes)
 
+            if duplicates:
+                duplicates_found = [info['file'] for info in duplicates]
+                self.logger.LogIssue( 'DuplicateDetected', { self.series_uid: duplicates_found} )
 
-                meta['meta']['Non Decoded sitk Bvalues'] = ','.join( map(str,original_bvalue) )
-                meta['meta']['Decoded Pydicom Bvalues'] = ','.join( map(str, bvalue_list) )
+            #Sorted by b-value, the files are listed by name and their order must not show in the manifest
+            meta['meta']['Non Decoded sitk Bvalues'] = ','.join( map(str, sorted(original_bvalue, key=SliceGrouper.BValueKey)) )
+            meta['meta']['Decoded Pydicom Bvalues'] = ','.join( map(str, bvalue_list) )
                             
         if len(plane_found) > 1:
 
@@ -463,6 +552,10 @@ class ImageLoader:
         if rescale_type:
             meta['meta']['rescale_type'] = rescale_type
 
+        #Before the segmentation, which finds its referenced slices in the index
+        if self.sop_index:
+            self.sop_index.AddSeries(self.series_uid, instances)
+
 
         if sequence in self.image_loader[self.patient_id][self.study_uid]:
             base_seq = sequence.split('-')[0]
@@ -477,48 +570,165 @@ class ImageLoader:
 
         for bv in location_dict:
 
-            self.image_loader[self.patient_id][self.study_uid][sequence][bv] = copy.deepcopy(meta)
+            #One slice per main plane origin, as the dictionary of the json
+            dcm_path = {main_or: (pth, orig, frame)
+                for main_or,pth,orig,frame in zip(location_dict[bv]['main_plane_origin'],location_dict[bv]['path'],location_dict[bv]['origin'],location_dict[bv]['frame'])
+            }
 
-            origin_list = location_dict[bv]['origin'].copy()
-            main_origin_list = location_dict[bv]['main_plane_origin'].copy()
-            path_list = location_dict[bv]['path'].copy()
+            positions = sorted(dcm_path)
 
-            dcm_path = {main_or:
-                                {
-                                    'path':pth,
-                                    'ImagePositionPatient': ','.join( map(str, orig) )
-                                }
-                for main_or,pth,orig in zip(main_origin_list,path_list,origin_list)
-            }
+            #The meta of the b-values of a series is the same object, it is not modified afterwards
+            self.image_loader[self.patient_id][self.study_uid][sequence][bv] = SeriesRecord(  meta['meta'],
+                                                                                                [dcm_path[pos][0] for pos in positions],
+                                                                                                positions,
+                                                                                                [dcm_path[pos][1] for pos in positions],
+                                                                                                [dcm_path[pos][2] for pos in positions]
+            )
 
+            #If segmentation for parquet is given, the SEG of the T2 is extracted after the scan (or alongside it, seg_workers > 1)
+            if isinstance(self.parquet_segmentations,str):
 
+                if self.sequence == 'T2' and self.series_uid in self.seg_sources:
 
+                    job = (self.patient_id, self.study_uid, sequence, self.image_loader[self.patient_id][self.study_uid][sequence]['N/A'])
+                    self.segmentation_jobs.append( (job, self.segmentation_pool.submit(self.__ExtractSegmentation, job[3]) if self.segmentation_pool else None) )
 
-            dcm_path = OrderedDict(sorted(dcm_path.items()))
-            self.image_loader[self.patient_id][self.study_uid][sequence][bv]['dcm_path'] = copy.deepcopy(dcm_path)
 
-            #If segmentation for parquet is given
-            if isinstance(self.parquet_segmentations,str):
-                self.df_seg = DataFrameUtils.Read(self.parquet_segmentations)
+#%% segmentations
 
-                if self.sequence == 'T2':
-                    
-                    load_segs = SegmentationLoader(self.images_directory_path,self.parquet_series,self.parquet_segmentations)
+    def __ExtractSegmentation(self, T2series_dict: SeriesRecord or dict) -> tuple:
+        '''
+        SEG masks of one T2 series, (label_dict, zeromask_dict) of SegmentationLoader.GetSeriesSegmentations.
+        The tables are read once and shared, every thread has its own SegmentationLoader.
+        '''
+        if not hasattr(self, 'segmentation_tables'):
+            self.segmentation_tables = (    DataFrameUtils.Read(self.parquet_series, columns=['patient_id', 'series_uid']),
+                                            DataFrameUtils.Read(self.parquet_segmentations, columns=['source_series_uid', 'derived_series_uid']) )
 
-                    if self.series_uid in self.df_seg.source_series_uid.to_list():
+        df, df_seg = self.segmentation_tables
 
-                        label_dict, zeromask_dict = load_segs.GetSeriesSegmentations( self.image_loader[self.patient_id][self.study_uid][sequence]['N/A'] )
+        load_segs = SegmentationLoader(self.images_directory_path, df, df_seg, issue_logger = self.issues_path, sop_index = self.sop_index)
 
-                        self.image_loader[self.patient_id][self.study_uid]['SEG'] = label_dict
+        return load_segs.GetSeriesSegmentations(T2series_dict)
 
-                        if zeromask_dict:
+    def __StoreSegmentation(self, patient: str, study: str, sequence: str, label_dict: dict, zeromask_dict: dict) -> None:
+        '''
+        SEG entry of the study, right after its T2 as when it was extracted during the scan
+        '''
+        stval = self.image_loader[patient][study]
 
-                            for label in zeromask_dict:
-                                self.logger.LogIssue("ZeroMaskFound",{zeromask_dict[label]['meta']['seg_series_uid']:f"Mask {label} derived from{self.series_uid}, patient {self.patient_id}"})
+        if 'SEG' not in stval:
 
+            items = list(stval.items())
+            position = [ key for key, _ in items ].index(sequence) + 1
 
-    def GetImageLoader(self) -> dict:
-        
+            stval.clear()
+            stval.update( items[:position] + [('SEG', label_dict)] + items[position:] )
+
+        stval['SEG'] = label_dict
+
+        series_uid = stval[sequence]['N/A']['meta']['series_uid']
+
+        for label in zeromask_dict:
+            self.logger.LogIssue("ZeroMaskFound",{zeromask_dict[label]['meta']['seg_series_uid']:f"Mask {label} derived from{series_uid}, patient {patient}"})
+
+    def __CollectSegmentations(self, study: tuple = None) -> None:
+        '''
+        Results of the segmentation jobs in scan order, of one (patient, study) or all of them.
+        The jobs without a future are run here
+        '''
+        jobs = [ job for job in self.segmentation_jobs if study is None or job[0][:2] == study ]
+        self.segmentation_jobs = [ job for job in self.segmentation_jobs if study is not None and job[0][:2] != study ]
+
+        for (patient, study, sequence, record), future in jobs:
+
+            label_dict, zeromask_dict = future.result() if future is not None else self.__ExtractSegmentation(record)
+            self.__StoreSegmentation(patient, study, sequence, label_dict, zeromask_dict)
+
+    def ExtractSegmentations(self, workers: int = None) -> dict:
+        '''
+        Extract the SEG of every T2 of the manifest with a pair in the segments parquet and fill the SEG entries in bulk.
+        Runs on its own over image_loader.json of an earlier scan (the manifest is then written back), workers threads.
+        '''
+        workers = workers or self.seg_workers
+
+        if not hasattr(self, 'df'):
+            self.LoadParquet()
+
+        if not isinstance(self.parquet_segmentations, str):
+            return getattr(self, 'image_loader', None)
+
+        standalone = not hasattr(self, 'image_loader')
+
+        if standalone:
+            self.image_loader = JsonUtils.Load(self.image_loader_path)
+
+        jobs = [    (patient, study, sequence, bvalues['N/A'])
+                    for patient, pval in self.image_loader.items()
+                    for study, stval in pval.items()
+                    for sequence, bvalues in list(stval.items())
+                    if sequence.split('-')[0] == 'T2' and 'N/A' in bvalues and bvalues['N/A']['meta']['series_uid'] in self.seg_sources
+        ]
+
+        # The index of an earlier scan, if there is one, closed at the end unless it was already open
+        opened = self.sop_index is None and self.OpenSOPIndex(create=False) is not None
+
+        try:
+
+            if workers > 1 and len(jobs) > 1:
+
+                with ThreadPoolExecutor(max_workers=workers) as executor:
+                    self.segmentation_jobs = [ (job, executor.submit(self.__ExtractSegmentation, job[3])) for job in jobs ]
+                    self.__CollectSegmentations()
+
+            else:
+                self.segmentation_jobs = [ (job, None) for job in jobs ]
+                self.__CollectSegmentations()
+
+        finally:
+
+            if opened:
+                self.Close()
+
+        if standalone:
+            JsonUtils.Write(self.image_loader, self.image_loader_path)
+
+        return self.image_loader
+
+    def __SegmentationsDone(self, study: tuple) -> bool:
+
+        return all( future is not None and future.done() for job, future in self.segmentation_jobs if job[:2] == study )
+
+    def __FinishStudy(self, patient: str, study: str, keep: bool) -> tuple:
+        '''
+        The SEG and the unknown b-value order of a scanned study, (patient, study, record) to yield
+        '''
+        self.__CollectSegmentations( (patient, study) )
+
+        with Metrics.Stage('order_unknown_dwi'):
+            self.__OrderUnknownDWI(patient, study)
+
+        record = self.image_loader[patient][study]
+
+        if not keep:
+
+            del self.image_loader[patient][study]
+
+            if not self.image_loader[patient] and patient != self.patient_id:
+                del self.image_loader[patient]
+
+        return patient, study, record
+
+    def IterStudies(self, keep: bool = True):
+        '''
+        Scan the cohort study by study, (patient, study, record) is yielded as soon as the series of the study are scanned,
+        its SEG extracted and its unknown b-values ordered. record is the study of the manifest, sequence -> b-value ->
+        SeriesRecord (Manifest.StudyToJson for the json of image_loader.json).
+        keep: the studies stay in self.image_loader, otherwise they are dropped once yielded and the memory stays flat.
+        With seg_workers > 1 up to seg_workers - 1 studies wait for their SEG while the next ones are scanned, the studies
+        are yielded in scan order. The instances stored in more than one series are logged once the cohort is scanned.
+        The SOP Instance UID index is closed when the scan ends, unless it was open before (OpenSOPIndex).
+        '''
         self.LoadParquet()
 
         self.pat_dict = {
@@ -528,42 +738,122 @@ class ImageLoader:
                                 }
                                 for patient in self.df.patient_id.unique()
         }
-        self.image_loader = {}
-        for patient in tqdm(self.pat_dict, desc= 'Reading ... ', colour='MAGENTA'):
+        self.image_loader = Manifest()
+        self.AvoidDWI = {}
 
-            self.image_loader[patient] = {}
-            self.patient_id = patient
+        #List the files of every series directory at once, no file is opened here
+        with Metrics.Stage('list_files') as stage:
 
-            for study in self.pat_dict[patient]:
+            self.series_files = FileUtils.ListSeriesDirectories(
+                    [   os.path.join(self.images_directory_path,patient,study,series).replace('\\','/')
+                        for patient in self.pat_dict
+                        for study in self.pat_dict[patient]
+                        for series in self.pat_dict[patient][study]
+                    ],
+                    workers = self.io_workers
+            )
 
-                self.study_uid = study
-                self.image_loader[patient][study] = {}
+            stage.Count(files=sum( len(files) for files in self.series_files.values() if files ))
 
-                for series in self.pat_dict[patient][study]:
-                    
-                    self.series_uid = series
-                    self.series_path = os.path.join(self.images_directory_path,patient,study,series).replace('\\','/')
-                    
-                    if not self.__CheckPathExist():
-                        continue
-                    
-                    #Load files' path contained in series_path
-                    files = SitkUtils.GetFiles(self.series_path)
+        # SEG extraction of every T2 starts as soon as the T2 is scanned, otherwise when its study is finished
+        self.segmentation_jobs = []
+        if self.seg_workers > 1 and isinstance(self.parquet_segmentations, str):
+            self.segmentation_pool = ThreadPoolExecutor(max_workers=self.seg_workers)
+
+        # Only the headers are parsed here, the first bytes of every file are enough
+        if self.prefetcher:
+            self.prefetcher.Start( [ (path, files) for path, files in self.series_files.items() if files ], head_bytes = self.prefetch_head_bytes )
+
+        pending = deque()
+        opened = self.sop_index is None and self.OpenSOPIndex() is not None
+
+        try:
+
+            for patient in tqdm(self.pat_dict, desc= 'Reading ... ', colour='MAGENTA'):
+
+                self.image_loader[patient] = {}
+                self.patient_id = patient
+
+                for study in self.pat_dict[patient]:
+
+                    self.study_uid = study
+                    self.image_loader[patient][study] = {}
+
+                    for series in self.pat_dict[patient][study]:
+                        
+                        self.series_uid = series
+                        self.series_path = os.path.join(self.images_directory_path,patient,study,series).replace('\\','/')
+                        
+                        if not self.__CheckPathExist():
+                            continue
+                        
+                        if self.prefetcher:
+                            self.prefetcher.Acquire(self.series_path)
+
+                        with Metrics.Series(series):
+
+                            self.OrderFileSeries(self.series_files[self.series_path])
+
+                    pending.append( (patient, study) )
+
+                    while pending and ( len(pending) >= self.seg_workers or self.__SegmentationsDone(pending[0]) ):
+                        yield self.__FinishStudy(*pending.popleft(), keep)
+
+            self.patient_id = None
+
+            while pending:
+                yield self.__FinishStudy(*pending.popleft(), keep)
+
+            #Same instance stored in more than one series folder
+            if self.sop_index:
+
+                duplicates = self.sop_index.Duplicates( [ series for patient in self.pat_dict for study in self.pat_dict[patient] for series in self.pat_dict[patient][study] ] )
+
+                if duplicates:
+                    self.logger.LogIssue('DuplicateInstance', duplicates)
+
+        finally:
+
+            if self.prefetcher:
+                self.prefetcher.Stop()
 
-                    self.OrderFileSeries(files)
+            if self.segmentation_pool:
+                self.segmentation_pool.shutdown()
+                self.segmentation_pool = None
 
-        self.__OrderMultipleUnknownDWISeries()
+            if opened:
+                self.Close()
 
-        JsonUtils.Write(self.image_loader, 'image_loader.json')
+        # The manifest keeps its own compact copy of the paths
+        del self.series_files
+
+        if not keep:
+            for patient in [ patient for patient, pval in self.image_loader.items() if not pval ]:
+                del self.image_loader[patient]
+
+    def GetImageLoader(self) -> dict:
+        '''
+        Scan the cohort (IterStudies), image_loader.json is written study by study
+        '''
+        with StudyJsonWriter(self.image_loader_path) as writer:
+
+            for patient, study, record in self.IterStudies():
+
+                with Metrics.Stage('write_manifest'):
+                    writer.Write(patient, study, Manifest.StudyToJson(record))
 
         if self.extract_nii:
 
-            extractor = DICOM2NII('image_loader.json',
+            extractor = DICOM2NII(self.image_loader_path,
                                     keep_max_bvalue= True,
+                                    shard= self.shard,
+                                    prefetcher= self.prefetcher
             )
 
             extractor.Execute()
 
+        return self.image_loader
+
         
 
 
@@ -572,6 +862,21 @@ class DICOM2NII():
     def __init__(self, 
                     image_loader: str or dict,
                     keep_max_bvalue:bool = True,
+                    crop_to_gland: bool = False,
+                    crop_padding: float = 10.0,
+                    shard: str = None,
+                    prefetcher: Prefetcher = None,
+                    decode_workers: int = 1,
+                    output_format: str = 'nifti',
+                    store_per_study: bool = False,
+                    max_memory: int = None,
+                    study_workers: int = 1,
+                    validate: bool = False,
+                    validation_checks: list = None,
+                    sop_index: Path = 'sop_index.sqlite',
+                    nifti_dtype: str = 'auto',
+                    verify_nifti: bool = False,
+                    stream_slices: int = 0
     ) -> None:
         
         self.image_loader = image_loader
@@ -580,11 +885,146 @@ class DICOM2NII():
             self.image_loader = JsonUtils.Load(image_loader)
         
         self.keep_max_bvalue = keep_max_bvalue
-        self.logger = IssueLogger(reset = False)
+        self.crop_to_gland = crop_to_gland
+        self.crop_padding = crop_padding
+
+        # Slices decoded in a thread pool when > 1 (compressed series), ImageSeriesReader otherwise
+        self.decode_workers = decode_workers
+
+        # Studies converted at once in a thread pool. max_memory (bytes): a study starts only while the estimated peaks
+        # of the studies in flight fit in it, the peak of every study is kept in self.study_memory
+        self.study_workers = study_workers
+        self.max_memory = max_memory
+        self.study_memory = {}
+
+        # nifti: one .nii.gz per volume. zarr/hdf5: chunked store of the cohort (nii_files.zarr), or of each study
+        self.store_suffixes = {'zarr': '.zarr', 'hdf5': '.h5'}
+
+        if output_format != 'nifti' and output_format not in self.store_suffixes:
+            raise ValueError(f'Unknown output_format {output_format}, use nifti, zarr or hdf5')
+
+        self.output_format = output_format
+        self.store_per_study = store_per_study
+        self.store_lock = threading.Lock()
+
+        # nifti_files.json and the studies of the manifest, shared by the studies in flight (and the scan of ExecuteFused)
+        self.entries_lock = threading.Lock()
+
+        # Pixel type of the .nii.gz: 'auto' smallest lossless integer type, 'original' or a numpy type (NiftiUtils.Write).
+        # verify_nifti reads every file back, one which differs is written again with the type of the volume.
+        self.nifti_dtype = nifti_dtype
+        self.verify_nifti = verify_nifti
+
+        # > 0: the T2, DWI and DCE .nii.gz are written stream_slices slices at a time straight from the DICOM files
+        # (SitkUtils.StreamDICOM2Nifti), without the volume in memory. Not for the crop, the stores or verify_nifti.
+        self.stream_slices = stream_slices
+
+        # Must match the shard of the ImageLoader, the issues of the scan are read from the shard's log
+        self.shard = shard
+        self.nifti_files_path = ShardUtils.ShardPath('nifti_files.json', shard)
+
+        # Crop of every volume {patient: {study: {name: {'index', 'size', 'origin'}}}}, beside nifti_files.json which maps
+        # every name to a file only
+        self.crop_boxes_path = ShardUtils.ShardPath('crop_boxes.json', shard)
+        self.logger = IssueLogger(reset = False, issue_logger = ShardUtils.ShardPath('issues/image_loader_issues.json', shard))
+
+        # Optional read-ahead, the slices of the next studies are fetched while the current one is converted
+        self.prefetcher = prefetcher
+
+        # Gland labels used for the crop box, the rest of the labels are used only when none of these exist
+        self.gland_labels = ['TZ+CZ', 'PZ']
+
+        # Header-only checks before the export, the failed studies are skipped without reading their pixels
+        self.validate = validate
+        self.validation_checks = validation_checks
+        self.validation_plan_path = ShardUtils.ShardPath('validation_plan.json', shard)
+        self.sop_index_path = ShardUtils.ShardPath(sop_index, shard) if sop_index else None
+        self.plan = {}
+
+        # The index of the ImageLoader while it is filled (ExecuteFused), opened from sop_index_path otherwise
+        self.shared_sop_index = None
+
+    def __OpenSOPIndex(self) -> SOPIndex or None:
+
+        if self.shared_sop_index is not None:
+            return self.shared_sop_index
+
+        if self.sop_index_path and os.path.isfile(self.sop_index_path):
+            return SOPIndex(self.sop_index_path)
+
+        return None
+
+    def __CloseSOPIndex(self, sop_index: SOPIndex or None) -> None:
+
+        if sop_index is not None and sop_index is not self.shared_sop_index:
+            sop_index.Close()
+
+    def Validate(self) -> dict:
+        '''
+        Pass/fail plan of the studies from the manifest and the headers (StudyValidator), written to validation_plan.json
+        '''
+        sop_index = self.__OpenSOPIndex()
+        validator = self.__Validator(sop_index)
+
+        with Metrics.Stage('validate') as stage:
+
+            self.plan = validator.Validate(self.image_loader)
+
+            if Metrics.enabled:
+                stage.Count(studies_failed=len(StudyValidator.Failed(self.plan)))
+
+        self.__CloseSOPIndex(sop_index)
+
+        JsonUtils.Write(self.plan, self.validation_plan_path)
+
+        return self.plan
+
+    def __Skipped(self, patient: str, study: str) -> bool:
+
+        return self.plan.get(patient, {}).get(study, {}).get('status') == 'fail'
         
+    def __Export(self, image: sitk.Image, export_path: str, name: str, store: VolumeStore = None, prefix: str = '', rescale: tuple = None) -> str:
+        '''
+        Write the volume as export_path/name.nii.gz, or under prefix + name in the store.
+        Returns its location for nifti_files.json (store path/key for a store, see VolumeStore.Split)
+        '''
+
+        if store is None:
+
+            info = SitkUtils.WriteDICOM2Nifti(image, export_path, name, dtype=self.nifti_dtype, verify=self.verify_nifti, rescale=rescale)
+            path = os.path.join(export_path, f'{name}.nii.gz').replace('\\','/')
+
+            if info['verified'] is False:
+                self.logger.LogIssue('NiftiRoundTripMismatch', {path: f'Compact pixel type not read back bit-exact, written as {image.GetPixelIDTypeAsString()}'})
+
+            return path
+
+        # The studies in flight share the cohort store
+        with Metrics.Stage('write_store') as stage, self.store_lock:
+
+            store.Write(prefix + name, image)
+
+            if Metrics.enabled:
+                stage.Count(volumes_written=1)
+
+        return f'{store.path}/{prefix}{name}'.replace('\\','/')
+
+    def __Rescale(self, image: sitk.Image, slices: list, factor: float = 1.0) -> tuple or None:
+        '''
+        (RescaleSlope, RescaleIntercept) x factor of a volume GDCM read as float64 (slope or intercept not an integer),
+        for the compact .nii.gz of its stored values. None for the stores, the original pixel type and multi-frame files
+        '''
+        if self.output_format != 'nifti' or self.nifti_dtype == 'original' or image.GetPixelID() != sitk.sitkFloat64 \
+           or any( 'frame' in entry for entry in slices ):
+            return None
+
+        rescale = SitkUtils.SeriesRescale([ entry['path'] for entry in slices ], self.decode_workers)
+
+        return (rescale[0] * factor, rescale[1] * factor) if rescale is not None else None
+
     def ADCMicro2Nano(self, ADCITK: sitk.Image):
 
-        ADC_np = sitk.GetArrayFromImage(ADCITK).max()
+        ADC_np = sitk.GetArrayViewFromImage(ADCITK).max()
         
         if ADC_np <= 10:
 
@@ -594,7 +1034,7 @@ class DICOM2NII():
 
     def __LoadDWIMultiSeriesWithMissingSlice(self):
 
-        check_issues = JsonUtils.Load('issues/image_loader_issues.json')
+        check_issues = JsonUtils.Load(self.logger.issue_logger)
         exclude_dict = {}
 
         if "DWIMultiSeriesNotSameSliceNumber" in check_issues:
@@ -631,194 +1071,621 @@ class DICOM2NII():
                         exclude_dict[pat][stu] = temp[pat][stu][key]
 
         self.exclude_dict = exclude_dict
+
+    def __GetCropBox(self, patient: str, study: str, segment_dict: dict) -> tuple or None:
+        '''
+        Padded physical bounding box from the gland masks (TZ+CZ, PZ).
+        If no gland mask exists, every other available mask (e.g. lesions, SV) is used instead.
+        Returns None when the study has no non-empty mask, then the study is not cropped.
+        '''
+
+        gland_masks = [ segment_dict[label]['image'] for label in self.gland_labels if label in segment_dict ]
+
+        box = SitkUtils.GetPhysicalBoundingBox(gland_masks, self.crop_padding)
+
+        if box is None:
+
+            other_masks = [ SEGval['image'] for label, SEGval in segment_dict.items() if label not in self.gland_labels ]
+
+            box = SitkUtils.GetPhysicalBoundingBox(other_masks, self.crop_padding)
+
+            if box is not None:
+                self.logger.LogIssue("CropGlandMaskMissing",{f'{patient}_{study}':f'No {" or ".join(self.gland_labels)} mask, crop box computed from {list(segment_dict.keys())}'})
+
+        if box is None:
+            self.logger.LogIssue("CropSkipped",{f'{patient}_{study}':'No segmentation found, images are not cropped'})
+
+        return box
             
-    def Execute(self) -> dict:
+    def __VolumeBytes(self, records: list) -> dict:
+        '''
+        Size estimate of every series volume {series_uid: bytes}, slices x rows x columns x 4 (float32 after the rescale).
+        The matrix is taken from the SOP index, or the header of the first slice when the series is not indexed.
+        '''
+        sop_index = self.__OpenSOPIndex()
+
+        series = { record['meta']['series_uid']: record for record in records }
+        matrices = sop_index.Matrices(list(series)) if sop_index is not None else {}
+
+        self.__CloseSOPIndex(sop_index)
 
+        sizes = {}
+        for series_uid, record in series.items():
+
+            slices = list(record['dcm_path'].values())
+
+            if series_uid in matrices:
+                rows, columns = max( matrices[series_uid], key=matrices[series_uid].get )
+
+            else:
+                header = DCMUtils.ReadSlice(slices[0]['path'], stop_before_pixels=True, specific_tags=['Rows', 'Columns'])
+                rows, columns = header.get('Rows', 0), header.get('Columns', 0)
+
+            sizes[series_uid] = len(slices) * (rows or 0) * (columns or 0) * 4
+
+        return sizes
+
+    def __StudyVolumes(self, image_loader: dict) -> dict:
+        '''
+        {(patient, study): (bytes of every series volume (__VolumeBytes), bytes of one uint8 mask on the T2 grid, labels)}
+        '''
+        records = [ record for pval in image_loader.values() for stval in pval.values()
+                    for sequence, bvalues in stval.items() if sequence != 'SEG'
+                    for record in bvalues.values() if 'dcm_path' in record and record['dcm_path'] ]
+
+        sizes = self.__VolumeBytes(records)
+
+        studies = {}
+        for patient, pval in image_loader.items():
+
+            for study, stval in pval.items():
+
+                volumes = [ sizes.get(record['meta']['series_uid'], 0)
+                            for sequence, bvalues in stval.items() if sequence != 'SEG'
+                            for record in bvalues.values() if 'dcm_path' in record and record['dcm_path'] ]
+
+                # uint8 masks on the T2 grid
+                mask = sizes.get(stval['T2']['N/A']['meta']['series_uid'], 0) // 4 if 'T2' in stval else 0
+
+                studies[(patient, study)] = (volumes, mask, len(stval.get('SEG', {})))
+
+        return studies
+
+    def EstimateStudyMemory(self, image_loader: dict = None) -> dict:
+        '''
+        Estimated peak of every study {(patient, study): bytes} from the manifest (or image_loader, part of it), with the
+        model of WorkPlanner.StudyPeakBytes: the largest volume and its copy, plus the masks of the T2.
+        '''
+        image_loader = self.image_loader if image_loader is None else image_loader
+
+        return {    key: WorkPlanner.StudyPeakBytes(volumes, mask, labels, self.crop_to_gland)
+                    for key, (volumes, mask, labels) in self.__StudyVolumes(image_loader).items()
+        }
+
+    def EstimateStudyCost(self, image_loader: dict = None) -> dict:
+        '''
+        Relative export time of every study {(patient, study): voxels}, the voxels of its volumes and of its masks as the
+        export cost of WorkPlanner.StudyCosts
+        '''
+        image_loader = self.image_loader if image_loader is None else image_loader
+
+        return {    key: sum(volumes) // 4 + mask * labels
+                    for key, (volumes, mask, labels) in self.__StudyVolumes(image_loader).items()
+        }
+
+    def __DWIBValues(self, patient: str, study: str, DWIdict: dict) -> list:
+        '''
+        b-values of the DWI to export, only the largest one with keep_max_bvalue
+        '''
+        Bvalues = list(DWIdict.keys())
+
+        if not self.keep_max_bvalue:
+            return Bvalues
+
+        count_Unknown = 0
+        for b in Bvalues:
+
+            if 'Unknown' in b:
+                count_Unknown += 1
+        
+        if len(Bvalues) == 1:
+
+            bval = Bvalues[0]
+
+        elif count_Unknown == len(Bvalues):
+
+            bval = None
+
+            if patient in self.exclude_dict:
+
+                if study in self.exclude_dict[patient]:
+
+                    bval = self.exclude_dict[patient][study]
+
+            if not bval:
+
+                bval = Bvalues[-1]
+
+        else:
+
+            bval = '0'
+
+            for b in Bvalues:
+
+                if 'Unknown' not in b:
+
+                    if '-' in b:
+                        self.logger.LogIssue("SameBValueFound",{f"{patient}_{study}": f"Has {b} and {b.split('-')[0]} inside, check image_loader.json"})
+
+                    elif int(b) > int(bval):
+
+                        bval = b
+
+        return [bval]
+
+    def __ExportStudy(self, patient: str, study: str, stval: dict, cohort_store: VolumeStore = None) -> tuple:
+        '''
+        Load, crop and write the volumes of the study one at a time, every volume is released once written.
+        Returns (nifti_files.json entry of the study, crop_boxes.json entry (empty when not cropped), largest bytes of the
+        volumes held at once)
+        '''
         extract_folder = 'nii_files'
+        export_path = os.path.join(extract_folder, patient, study)
+
+        held = {}
+        peak = [0]
+
+        def Hold(name: str, image: sitk.Image) -> sitk.Image:
+
+            held[name] = image.GetNumberOfPixels() * image.GetNumberOfComponentsPerPixel() * image.GetSizeOfPixelComponent()
+            peak[0] = max( peak[0], sum(held.values()) )
+
+            return image
+
+        def Export(name: str, image: sitk.Image, series_uid: str, rescale: tuple = None) -> None:
+
+            if crop_box is not None:
+                image, crop_dict[name] = SitkUtils.CropToPhysicalBox(image, crop_box)
+                Hold(f'{name} cropped', image)
+
+            with Metrics.Series(series_uid):
+                entry[name] = self.__Export(image, export_path, name, store, prefix, rescale)
+
+            held.pop(name, None)
+            held.pop(f'{name} cropped', None)
+
+        def Stream(name: str, slices: list, series_uid: str) -> bool:
+            '''
+            Write the volume slab by slab, False when it has to be loaded whole
+            '''
+            if not self.stream_slices or store is not None or crop_box is not None or self.verify_nifti:
+                return False
+
+            with Metrics.Series(series_uid):
+                info = SitkUtils.StreamDICOM2Nifti(slices, export_path, name, 'LPS', self.nifti_dtype, self.stream_slices, self.decode_workers)
+
+            if info is None:
+                return False
+
+            peak[0] = max( peak[0], sum(held.values()) + info['peak_bytes'] )
+            entry[name] = os.path.join(export_path, f'{name}.nii.gz').replace('\\','/')
+
+            return True
+
+        if self.output_format == 'nifti':
+            os.makedirs(export_path, exist_ok=True)
+            store, prefix = None, ''
+
+        elif self.store_per_study:
+            store, prefix = VolumeStore(export_path + self.store_suffixes[self.output_format]), ''
+
+        else:
+            store, prefix = cohort_store, f'{patient}/{study}/'
+
+        entry = {}
+        segment_dict = {}
+        masks = {}
+        crop_box = None
+        crop_dict = {}
+
+        if 'T2' in stval:
+
+            segment_dict = stval.get('SEG', {})
+
+            if not segment_dict:
+                self.missing_seg_list.append([patient, study])
+
+            # The crop box needs every mask, they are kept until they are written
+            if self.crop_to_gland:
+
+                masks = { seg: { **SEGval, 'image': Hold(seg, SitkUtils.LoadSingleFile(SEGval['nii_path'], 'LPS')) }
+                          for seg, SEGval in segment_dict.items() }
+
+                crop_box = self.__GetCropBox(patient, study, masks)
+
+            T2series = stval['T2']['N/A']['meta']['series_uid']
+
+            T2slices = list(stval['T2']['N/A']['dcm_path'].values())
+
+            if not Stream('T2', T2slices, T2series):
+
+                with Metrics.Series(T2series):
+                    T2 = Hold('T2', SitkUtils.LoadSlices(T2slices, 'LPS', self.decode_workers))
+
+                Export('T2', T2, T2series, self.__Rescale(T2, T2slices))
+                del T2
+
+        if 'ADC' in stval:
+
+            ADCseries = stval['ADC']['N/A']['meta']['series_uid']
+            rescale_type = stval['ADC']['N/A']['meta'].get('rescale_type')
+            ADCslices = list(stval['ADC']['N/A']['dcm_path'].values())
+
+            with Metrics.Series(ADCseries):
+                ADC = Hold('ADC', SitkUtils.LoadSlices(ADCslices, 'LPS', self.decode_workers))
+
+            max_value = sitk.GetArrayViewFromImage(ADC).max()
+            factor = 1.0
+            
+            if (rescale_type == "10^-3 mm^2/s") or (max_value < 10):
+                
+                self.logger.LogIssue("ADCRescaleTypeMicro",{f'{patient}_{study}':f'Max Value is {max_value}, dicom tag rescale type is {rescale_type}'})
+
+                # Both are held while rescaling
+                rescaled = Hold('ADC rescaled', self.ADCMicro2Nano(ADC))
+                factor = 1000.0 if rescaled is not ADC else 1.0
+
+                ADC = rescaled
+                held['ADC'] = held.pop('ADC rescaled')
+
+            Export('ADC', ADC, ADCseries, self.__Rescale(ADC, ADCslices, factor))
+            del ADC
+
+        if 'DWI' in stval:
+
+            DWIdict = stval['DWI']
+            DWIseries = DWIdict[list(DWIdict.keys())[0]]['meta']['series_uid']
+
+            for bval in self.__DWIBValues(patient, study, DWIdict):
+
+                if Stream(f'DWI_{bval}', list(DWIdict[bval]['dcm_path'].values()), DWIseries):
+                    continue
+
+                DWIslices = list(DWIdict[bval]['dcm_path'].values())
+
+                with Metrics.Series(DWIseries):
+                    DWI = Hold(f'DWI_{bval}', SitkUtils.LoadSlices(DWIslices, 'LPS', self.decode_workers))
+
+                Export(f'DWI_{bval}', DWI, DWIseries, self.__Rescale(DWI, DWIslices))
+                del DWI
+
+        if 'DCE' in stval:
+
+            DCEseries = stval['DCE']['N/A']['meta']['series_uid']
+            DCEslices = list(stval['DCE']['N/A']['dcm_path'].values())
+
+            if not Stream('DCE', DCEslices, DCEseries):
+
+                with Metrics.Series(DCEseries):
+                    DCE = Hold('DCE', SitkUtils.LoadSlices(DCEslices, 'LPS', self.decode_workers))
+
+                Export('DCE', DCE, DCEseries, self.__Rescale(DCE, DCEslices))
+                del DCE
+
+        for seg, SEGval in segment_dict.items():
+
+            if seg in masks:
+                mask = masks.pop(seg)['image']
+
+            else:
+                mask = Hold(seg, SitkUtils.LoadSingleFile(SEGval['nii_path'], 'LPS'))
+
+            Export(seg, mask, SEGval['meta']['seg_series_uid'])
+            del mask
+
+        if store is not None and store is not cohort_store:
+            store.Close()
+
+        return entry, crop_dict, peak[0]
+
+    def __Begin(self) -> None:
 
-        nii_dict = {}
         self.missing_seg_list = []
         self.largest_bvalue = {}
+        self.study_memory = {}
         self.__LoadDWIMultiSeriesWithMissingSlice()
 
-        for patient,pval in tqdm(self.image_loader.items(),desc = 'Extract to .nii.gz ', colour='CYAN'):
-            
-            if patient not in nii_dict:
-                
-                nii_dict[patient] = {}
+        # Written again by this run when it crops, a file of an earlier run would not match nifti_files.json
+        if os.path.isfile(self.crop_boxes_path):
+            os.remove(self.crop_boxes_path)
 
-            for study,stval in pval.items():
+    def __CohortStore(self) -> VolumeStore or None:
 
-                T2dict = {}
-                segment_dict = {}
-                if 'T2' in stval:
-                    nii_dict[patient][study] = {}
-    
-                    T2dict = stval['T2']['N/A']['dcm_path']
-                    T2series = stval['T2']['N/A']['meta']['series_uid']
-    
-                    T2_list_path = [T2dict[pos]['path'] for pos in T2dict]
-                    T2 = SitkUtils.LoadImageByFolder(T2_list_path, 'LPS')
-    
-                    if 'SEG' in stval:
-                        segment_dict = stval['SEG']
-                    else:
-                        segment_dict = {}
-                    
-                    if  not segment_dict:
-                        self.missing_seg_list.append([patient, study])
-    
-                    label_list = [seg for seg in segment_dict ]
-    
-                    for seg in label_list:
-                            seg_path = segment_dict[seg]['nii_path']
-                            segment_dict[seg]['image'] = SitkUtils.LoadSingleFile(seg_path, 'LPS')
+        extract_folder = 'nii_files'
 
+        if self.output_format != 'nifti' and not self.store_per_study:
+            return VolumeStore( ShardUtils.ShardPath(extract_folder + self.store_suffixes[self.output_format], self.shard) )
 
-                ADCdict = {}
-                if 'ADC' in stval:
+        return None
 
-                    ADCdict = stval['ADC']['N/A']['dcm_path']
-                    ADCseries = stval['ADC']['N/A']['meta']['series_uid']
+    def __Validator(self, sop_index: SOPIndex = None) -> StudyValidator:
 
-                    rescale_type = None
-                    if 'rescale_type' in stval['ADC']['N/A']['meta']:
-                        rescale_type = stval['ADC']['N/A']['meta']['rescale_type']
-                        
+        return StudyValidator(  checks = self.validation_checks,
+                                keep_max_bvalue = self.keep_max_bvalue,
+                                issues = JsonUtils.Load(self.logger.issue_logger),
+                                sop_index = sop_index )
 
-                    
-                    ADC_list_path = [ADCdict[pos]['path'] for pos in ADCdict]
+    def __ExportStudies(self, studies, estimates: dict, cohort_store: VolumeStore = None, total: int = None) -> None:
+        '''
+        Convert the (patient, study, stval) of studies, taken one by one as they are admitted (a list, or a generator fed
+        by the scan). nifti_files.json is written after every study, in the order of self.image_loader.
+        '''
+        entries = {}
+        crops = {}
+        progress = tqdm(total=total, desc = 'Extract to .nii.gz ', colour='CYAN')
 
-                    ADC = SitkUtils.LoadImageByFolder(ADC_list_path, 'LPS')
-                    
-                    max_value = sitk.GetArrayFromImage(ADC).max()
-                    
-                    if (rescale_type == "10^-3 mm^2/s") or (max_value < 10):
-                        
-                        self.logger.LogIssue("ADCRescaleTypeMicro",{f'{patient}_{study}':f'Max Value is {max_value}, dicom tag rescale type is {rescale_type}'})
-                        ADC = self.ADCMicro2Nano(ADC)
+        def Run(patient: str, study: str, stval: dict) -> None:
 
-                DWIdict = {}
-                if 'DWI' in stval:
+            entry, crop, peak = self.__ExportStudy(patient, study, stval, cohort_store)
 
-                    if self.keep_max_bvalue:
-                        
-                        DWIdict = stval['DWI']
-                        Bvalues = list(DWIdict.keys())
-                        DWIseries = stval['DWI'][Bvalues[0]]['meta']['series_uid']
+            with self.entries_lock:
 
-                        count_Unknown = 0
-                        for b in Bvalues:
+                self.study_memory[f'{patient}_{study}'] = { 'peak_bytes': peak, 'estimated_bytes': estimates.get((patient, study)) }
+                Metrics.Add('study_memory', f'{patient}_{study}', peak_memory_bytes=peak)
 
-                            if 'Unknown' in b:
-                                count_Unknown += 1
-                        
-                        if len(Bvalues) == 1:
+                if entry or 'T2' in stval:
+                    entries[(patient, study)] = entry
 
-                            bval = Bvalues[0]
+                if crop:
+                    crops[(patient, study)] = crop
 
-                        elif count_Unknown == len(Bvalues):
+                # Patients and studies in manifest order, whatever order the studies finish in
+                nii_dict = {    patient: { study: entries[(patient, study)] for study in pval if (patient, study) in entries }
+                                for patient, pval in self.image_loader.items()
+                }
 
-                            bval = None
+                with Metrics.Stage('write_manifest'):
 
-                            if patient in self.exclude_dict:
+                    JsonUtils.Write(nii_dict, self.nifti_files_path)
 
-                                if study in self.exclude_dict[patient]:
+                    if crops:
+                        JsonUtils.Write( {  patient: { study: crops[(patient, study)] for study in pval if (patient, study) in crops }
+                                            for patient, pval in self.image_loader.items()
+                                            if any( (patient, study) in crops for study in pval )
+                        }, self.crop_boxes_path )
 
-                                    bval = self.exclude_dict[patient][study]
+                progress.update()
 
-                            if not bval:
+        if self.study_workers <= 1:
 
-                                bval = Bvalues[-1]
+            for patient, study, stval in studies:
 
-                        else:
+                if self.prefetcher:
+                    self.prefetcher.Acquire(f'{patient}_{study}')
 
-                            bval = '0'
+                Run(patient, study, stval)
 
-                            for b in Bvalues:
+        else:
 
-                                if 'Unknown' not in b:
+            # A study starts when a worker is free and its estimate fits in the budget with the studies in flight,
+            # a study larger than the budget runs alone
+            budget = threading.Condition()
+            in_flight = {'studies': 0, 'bytes': 0}
 
-                                    if '-' in b:
-                                        self.logger.LogIssue("SameBValueFound",{f"{patient}_{study}": f"Has {b} and {b.split('-')[0]} inside, check image_loader.json"})
+            def Admitted(estimate: int) -> bool:
 
-                                    elif int(b) > int(bval):
+                if in_flight['studies'] >= self.study_workers:
+                    return False
 
-                                        bval = b
+                return not self.max_memory or in_flight['studies'] == 0 or in_flight['bytes'] + estimate <= self.max_memory
 
-                        self.D = copy.deepcopy(DWIdict)
-                        self.bval = bval
-                        DWIdict = { bval:
-                                        {'path':    [
-                                                        path['path']  
-                                                        for path in DWIdict[bval]["dcm_path"].values()
-                                                    ]
-                                        }
-                        }
-                            
-                        DWI_list_path = DWIdict[bval]['path']
-                        DWIdict[bval]['image'] = SitkUtils.LoadImageByFolder(DWI_list_path, 'LPS')
-            
-                    else: #keep all available DWIs
-
-                        DWIdict = stval['DWI']
-                        Bvalues = list(DWIdict.keys())
-                        DWIseries = stval['DWI'][Bvalues[0]]['meta']['series_uid']
-
-                        DWIdict = { bvalue: 
-                                            {'path':
-                                                        [
-                                                            path['path']  
-                                                            for path in DWIdict[bvalue]["dcm_path"].values()
-                                                        ]
-                                            }
-                                    for bvalue in DWIdict
-                        }
-                        
-                        for bval in DWIdict:
-                            
-                            DWI_list_path = DWIdict[bval]['path']
-                            DWIdict[bval]['image'] = SitkUtils.LoadImageByFolder(DWI_list_path, 'LPS')
+            def RunBudgeted(patient: str, study: str, stval: dict, estimate: int) -> None:
 
-                DCEdict = {}
-                if 'DCE' in stval:
+                try:
+                    Run(patient, study, stval)
 
-                    DCEdict = stval['DCE']['N/A']['dcm_path']
-                    DCEseries = stval['DCE']['N/A']['meta']['series_uid']
-                    
-                    DCE_list_path = [DCEdict[pos]['path'] for pos in DCEdict]
+                finally:
+                    with budget:
+                        in_flight['studies'] -= 1
+                        in_flight['bytes'] -= estimate
+                        budget.notify_all()
 
-                    DCE = SitkUtils.LoadImageByFolder(DCE_list_path, 'LPS')
-                
- 
-                export_path = os.path.join(extract_folder, patient, study)
-                os.makedirs(export_path, exist_ok=True)
+            with ThreadPoolExecutor(max_workers=self.study_workers) as executor:
 
-                if T2dict:
-                    SitkUtils.WriteDICOM2Nifti(T2, export_path, 'T2')
-                    nii_dict[patient][study]['T2'] = os.path.join(export_path,'T2.nii.gz').replace('\\','/')
+                futures = []
+                for patient, study, stval in studies:
 
-                if ADCdict:
+                    estimate = estimates.get((patient, study), 0)
 
-                    SitkUtils.WriteDICOM2Nifti(ADC, export_path, 'ADC')
-                    nii_dict[patient][study]['ADC'] = os.path.join(export_path,'ADC.nii.gz').replace('\\','/')
+                    with budget:
+                        budget.wait_for( lambda: Admitted(estimate) )
+                        in_flight['studies'] += 1
+                        in_flight['bytes'] += estimate
 
-                if DWIdict:
-                    
-                    for bval,DWIval in DWIdict.items():
-                        SitkUtils.WriteDICOM2Nifti(DWIval['image'], export_path, f'DWI_{bval}')
-                        nii_dict[patient][study][f'DWI_{bval}'] = os.path.join(export_path,f'DWI_{bval}.nii.gz').replace('\\','/')
+                    if self.prefetcher:
+                        self.prefetcher.Acquire(f'{patient}_{study}')
+
+                    futures.append( executor.submit(RunBudgeted, patient, study, stval, estimate) )
+
+                for future in futures:
+                    future.result()
+
+        progress.close()
+
+    def Execute(self) -> dict:
+
+        self.__Begin()
+
+        if self.validate:
+            self.Validate()
+
+            for patient, study in StudyValidator.Failed(self.plan):
+                self.logger.LogIssue("StudySkipped",{f'{patient}_{study}': f"Failed the checks {list(self.plan[patient][study]['failed'])}, see validation_plan.json"})
+
+        studies = [ (patient, study, stval) for patient, pval in self.image_loader.items()
+                    for study, stval in pval.items() if not self.__Skipped(patient, study) ]
+
+        estimates = self.EstimateStudyMemory() if self.max_memory else {}
+
+        # Longest first (LPT) as WorkPlanner.Schedule, a large study taken last would keep one worker busy alone.
+        # Prefetched in the same order, nifti_files.json stays in manifest order
+        if self.study_workers > 1:
+
+            costs = self.EstimateStudyCost()
+            studies = sorted( studies, key=lambda item: -costs.get((item[0], item[1]), 0) )
+
+        cohort_store = self.__CohortStore()
+
+        try:
+
+            if self.prefetcher:
+                #The frames of a multi-frame file share their path, the file is fetched once
+                self.prefetcher.Start( [    (f'{patient}_{study}', list( dict.fromkeys( slice_dict['path']
+                                                                        for sequence in stval.values()
+                                                                        for bvalue in sequence.values()
+                                                                        for slice_dict in bvalue.get('dcm_path', {}).values()
+                                                                    ) ))
+                                            for patient, study, stval in studies
+                ] )
+
+            self.__ExportStudies(studies, estimates, cohort_store, total=len(studies))
+
+        finally:
+
+            if cohort_store is not None:
+                cohort_store.Close()
+
+            if self.prefetcher:
+                self.prefetcher.Stop()
+
+    def ExecuteFused(self, loader: ImageLoader, queue_size: int = 4) -> None:
+        '''
+        Scan and export in one pass. loader.IterStudies runs in a thread and writes image_loader.json, its studies are
+        converted as they come through a queue of queue_size studies, the scan waits while the queue is full.
+        A study is converted shortly after its headers were read: its files are still in the page cache (the loader's
+        prefetcher reads them whole), the estimates and the checks take the matrices from the index the scan is filling.
+        image_loader.json, nifti_files.json and the issues are those of loader.GetImageLoader() then Execute().
+        The prefetcher of the extractor is not used and the studies are exported in scan order, not longest first, they
+        are not known in advance.
+        '''
+        self.__Begin()
+
+        self.image_loader = {}
+        self.plan = {}
+        # Open for the whole pass, the conversion reads it after the scan has ended
+        opened = loader.sop_index is None
+        self.shared_sop_index = loader.OpenSOPIndex()
+
+        prefetcher, self.prefetcher = self.prefetcher, None
+        head_bytes, loader.prefetch_head_bytes = loader.prefetch_head_bytes, None
+
+        scanned = queue.Queue(maxsize=max(queue_size, 1))
+        stop = threading.Event()
+        failure = []
+        estimates = {}
+
+        def Put(item) -> bool:
+
+            while not stop.is_set():
+
+                try:
+                    scanned.put(item, timeout=0.1)
+                    return True
+
+                except queue.Full:
+                    continue
+
+            return False
+
+        def Scan() -> None:
+
+            studies = loader.IterStudies(keep=False)
+
+            try:
+                with StudyJsonWriter(loader.image_loader_path) as writer:
+
+                    for patient, study, record in studies:
+
+                        stval = Manifest.StudyToJson(record)
+
+                        with Metrics.Stage('write_manifest'):
+                            writer.Write(patient, study, stval)
+
+                        if not Put( (patient, study, stval) ):
+                            break
+
+            except BaseException as error:
+                failure.append(error)
+
+            finally:
+                studies.close()
+                Put(None)
+
+        def Studies():
+
+            validator = self.__Validator(self.shared_sop_index) if self.validate else None
+
+            while True:
+
+                item = scanned.get()
+
+                if item is None:
+                    return
+
+                patient, study, stval = item
+
+                with self.entries_lock:
+                    self.image_loader.setdefault(patient, {})[study] = stval
+
+                # The slice counts of the unknown b-values are logged when the study is scanned
+                if len(stval.get('DWI', {})) > 1 and all( 'Unknown' in bval for bval in stval['DWI'] ):
+                    self.__LoadDWIMultiSeriesWithMissingSlice()
+
+                if validator is not None:
+
+                    # The SEG references not found are logged when the study is scanned
+                    if 'SEG' in stval:
+                        validator.issues = JsonUtils.Load(self.logger.issue_logger)
+
+                    with Metrics.Stage('validate') as stage:
+
+                        self.plan.setdefault(patient, {})[study] = validator.ValidateStudy(stval)
+
+                        if Metrics.enabled:
+                            stage.Count(studies_failed=int(self.__Skipped(patient, study)))
+
+                    if self.__Skipped(patient, study):
+                        self.logger.LogIssue("StudySkipped",{f'{patient}_{study}': f"Failed the checks {list(self.plan[patient][study]['failed'])}, see validation_plan.json"})
+                        continue
+
+                if self.max_memory:
+                    estimates.update( self.EstimateStudyMemory({patient: {study: stval}}) )
+
+                yield patient, study, stval
+
+        cohort_store = self.__CohortStore()
+        producer = threading.Thread(target=Scan, name='scan', daemon=True)
+        producer.start()
+
+        try:
+            self.__ExportStudies(Studies(), estimates, cohort_store)
+
+        finally:
+            stop.set()
+            producer.join()
 
-                if DCEdict:
+            if cohort_store is not None:
+                cohort_store.Close()
 
-                    for bval,DCEval in DCEdict.items():
-                        SitkUtils.WriteDICOM2Niifty(DCEdict['image'], export_path, f'DCE')
-                        nii_dict[patient][study][f'DCE'] = os.path.join(export_path,f'DCE.nii.gz').replace('\\','/')
+            self.shared_sop_index = None
+            self.prefetcher = prefetcher
 
-                if segment_dict:
+            if opened:
+                loader.Close()
+            loader.prefetch_head_bytes = head_bytes
 
-                    for seg,SEGval in segment_dict.items():
-                        SitkUtils.WriteDICOM2Nifti(SEGval['image'], export_path, f'{seg}')
-                        nii_dict[patient][study][f'{seg}'] = os.path.join(export_path,f'{seg}.nii.gz').replace('\\','/')
+        if failure:
+            raise failure[0]
 
-                JsonUtils.Write(nii_dict, 'nifti_files.json')
+        if self.validate:
+            JsonUtils.Write(self.plan, self.validation_plan_path)
@@ -1,20 +1,33 @@
 import os
+import threading
 from pathlib import Path
 from .utils import JsonUtils
 
 class IssueLogger:
 
-    def __init__(self, reset: bool = False) -> None:
+    # One lock per log file, the loggers of the threads may share it
+    locks = {}
+    locks_lock = threading.Lock()
 
-        self.issue_logger = 'issues/image_loader_issues.json'
+    def __init__(self, reset: bool = False, issue_logger: Path = 'issues/image_loader_issues.json') -> None:
 
-        os.makedirs('issues',exist_ok=True)
+        self.issue_logger = str(issue_logger)
+
+        with IssueLogger.locks_lock:
+            self.lock = IssueLogger.locks.setdefault(os.path.abspath(self.issue_logger), threading.Lock())
+
+        os.makedirs(os.path.dirname(self.issue_logger) or '.',exist_ok=True)
 
         if reset:
             
             JsonUtils.Write({}, self.issue_logger)
         
     def LogIssue(self, issue:str, message:str):
+
+        with self.lock:
+            self.__LogIssue(issue, message)
+
+    def __LogIssue(self, issue:str, message:str):
         
         is_log = JsonUtils.Load(self.issue_logger)
         
@@ -0,0 +1,180 @@
+import os
+import sys
+from collections import OrderedDict
+from collections.abc import Mapping
+import numpy as np
+
+
+class SeriesRecord(Mapping):
+    '''
+    Slices of one sequence/b-value of the manifest, ordered by their main plane origin.
+
+    The main plane origin and ImagePositionPatient of the slices are one NumPy array (N x 4) and the paths are
+    one directory plus the interned file names,
+    the dict of every slice ({'path', 'ImagePositionPatient'} under the main plane origin) is only built on request.
+    Reads like the old entry: record['meta'], record['dcm_path'][position]['path'].
+    Slices which are frames of Enhanced (multi-frame) files also have their frame index, record['dcm_path'][position]['frame'].
+    '''
+
+    __slots__ = ('meta', 'directory', 'names', 'coordinates', 'max_mean', 'frames')
+
+    def __init__(self, meta: dict, paths: list, positions: list, origins: list, frames: list = None) -> None:
+
+        self.meta = meta
+        self.coordinates = np.empty((len(paths), 4), dtype=np.float64)
+        self.coordinates[:, 0] = positions
+        self.coordinates[:, 1:] = origins if len(paths) else 0
+        self.max_mean = None
+        self.__SetPaths(paths)
+
+        # None for single slice files, the layout of the json is unchanged for them
+        self.frames = tuple(frames) if frames is not None and any( frame is not None for frame in frames ) else None
+
+    @property
+    def positions(self) -> np.ndarray:
+        '''
+        Main plane origin of the slices, sorted
+        '''
+        return self.coordinates[:, 0]
+
+    @property
+    def origins(self) -> np.ndarray:
+        '''
+        ImagePositionPatient of the slices
+        '''
+        return self.coordinates[:, 1:]
+
+    def __SetPaths(self, paths: list) -> None:
+
+        directories = { os.path.dirname(path) for path in paths }
+
+        # The slices of a series share their folder, only the file names are stored (the same across series)
+        if len(directories) == 1:
+            self.directory = sys.intern(directories.pop())
+            self.names = tuple( sys.intern(os.path.basename(path)) for path in paths )
+
+        else:
+            self.directory = None
+            self.names = tuple(paths)
+
+    def __getitem__(self, key):
+
+        if key == 'meta':
+            return self.meta
+
+        if key == 'dcm_path':
+            return self.DcmPath()
+
+        raise KeyError(key)
+
+    def __iter__(self):
+
+        return iter(('meta', 'dcm_path'))
+
+    def __len__(self) -> int:
+
+        return 2
+
+    def __repr__(self) -> str:
+
+        return f'SeriesRecord({self.meta.get("series_uid")}, {self.Count()} slices)'
+
+    def Count(self) -> int:
+        '''
+        Number of slices
+        '''
+        return len(self.names)
+
+    def Index(self, position: float) -> int:
+        '''
+        Index of the slice at the main plane origin, KeyError if there is none
+        '''
+        index = int(np.searchsorted(self.positions, float(position)))
+
+        if index >= len(self.positions) or self.positions[index] != float(position):
+            raise KeyError(position)
+
+        return index
+
+    def Path(self, index: int) -> str:
+
+        if not self.directory:
+            return self.names[index]
+
+        return f'{self.directory}/{self.names[index]}'
+
+    def Paths(self) -> list:
+
+        return [ self.Path(index) for index in range(self.Count()) ]
+
+    def Frame(self, index: int) -> int or None:
+        '''
+        Frame of the slice inside its file, None if the file is a single slice
+        '''
+        return self.frames[index] if self.frames is not None else None
+
+    def SetPath(self, index: int, path: str, max_mean: str = None, frame: int = None) -> None:
+
+        if self.directory is not None and os.path.dirname(path) == self.directory:
+            self.names = self.names[:index] + (sys.intern(os.path.basename(path)),) + self.names[index + 1:]
+
+        else:
+            paths = self.Paths()
+            paths[index] = path
+            self.__SetPaths(paths)
+
+        if frame is not None:
+            self.frames = self.frames[:index] + (frame,) + self.frames[index + 1:]
+
+        if max_mean is not None:
+
+            if self.max_mean is None:
+                self.max_mean = [None] * self.Count()
+
+            self.max_mean[index] = max_mean
+
+    def DcmPath(self) -> OrderedDict:
+        '''
+        The slices as stored in image_loader.json, ordered by the main plane origin
+        '''
+        dcm_path = OrderedDict()
+
+        for index, (position, *origin) in enumerate(self.coordinates.tolist()):
+
+            dcm_path[position] = {  'path': self.Path(index),
+                                    'ImagePositionPatient': ','.join( map(str, origin) )
+            }
+
+            if self.frames is not None:
+                dcm_path[position]['frame'] = self.frames[index]
+
+            if self.max_mean is not None and self.max_mean[index] is not None:
+                dcm_path[position]['max_mean'] = self.max_mean[index]
+
+        return dcm_path
+
+    def ToJson(self) -> dict:
+
+        return {'meta': self.meta, 'dcm_path': self.DcmPath()}
+
+
+class Manifest(dict):
+    '''
+    patient -> study -> sequence -> b-value -> SeriesRecord (SEG labels stay plain dicts)
+    '''
+
+    def to_json(self) -> dict:
+        '''
+        Plain dicts, identical to the image_loader.json written before the records
+        '''
+        return {    patient: { study: Manifest.StudyToJson(stval) for study, stval in pval.items() }
+                    for patient, pval in self.items()
+        }
+
+    @staticmethod
+    def StudyToJson(study: dict) -> dict:
+
+        return {    sequence: { bvalue: entry.ToJson() if isinstance(entry, SeriesRecord) else entry
+                                for bvalue, entry in bvalues.items() }
+                    for sequence, bvalues in study.items()
+        }
@@ -0,0 +1,199 @@
+import os
+import time
+import threading
+from pathlib import Path
+from .utils import JsonUtils
+
+
+class _NullStage:
+    '''
+    Returned when metrics are disabled, every hook is a no-op
+    '''
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def Count(self, **counters):
+        pass
+
+
+_NULL_STAGE = _NullStage()
+
+
+class _Stage:
+
+    def __init__(self, stage: str, series: str or None) -> None:
+
+        self.stage = stage
+        self.series = series
+        self.counters = {}
+
+    def __enter__(self):
+
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+
+        self.counters['seconds'] = time.perf_counter() - self.start
+        self.counters['calls'] = 1
+        Metrics.Add(self.stage, self.series, **self.counters)
+
+        return False
+
+    def Count(self, **counters):
+
+        for key, value in counters.items():
+            self.counters[key] = self.counters.get(key, 0) + value
+
+
+class _SeriesScope:
+
+    def __init__(self, series: str) -> None:
+
+        self.series = series
+
+    def __enter__(self):
+
+        self.previous = getattr(Metrics.local, 'series', None)
+        Metrics.local.series = self.series
+        return self
+
+    def __exit__(self, *exc):
+
+        Metrics.local.series = self.previous
+        return False
+
+
+class Metrics:
+    '''
+    Wall time and counters (files, bytes read/written, volumes written) per stage and per series.
+    Disabled by default: Stage and Series return a shared no-op context, so the hooks cost one attribute lookup.
+
+    with Metrics.Series(series_uid):
+        with Metrics.Stage('header_parse') as stage:
+            ...
+            stage.Count(files=1, bytes_read=size)
+    '''
+
+    enabled = False
+    stages = {}
+    series = {}
+    lock = threading.Lock()
+    local = threading.local()
+
+    # peak_ counters keep the largest value instead of the sum
+    counter_names = ['calls', 'seconds', 'files', 'bytes_read', 'bytes_written', 'volumes_written', 'peak_memory_bytes']
+
+    @classmethod
+    def Enable(cls, reset: bool = True) -> None:
+
+        if reset:
+            cls.Reset()
+
+        cls.enabled = True
+
+    @classmethod
+    def Disable(cls) -> None:
+
+        cls.enabled = False
+
+    @classmethod
+    def Reset(cls) -> None:
+
+        with cls.lock:
+            cls.stages = {}
+            cls.series = {}
+
+    @classmethod
+    def Stage(cls, stage: str, series: str = None):
+        '''
+        Context manager that times the stage, series defaults to the one set by Series
+        '''
+        if not cls.enabled:
+            return _NULL_STAGE
+
+        return _Stage(stage, series or getattr(cls.local, 'series', None))
+
+    @classmethod
+    def Series(cls, series: str):
+        '''
+        Every stage inside the context is also accounted to this series
+        '''
+        if not cls.enabled:
+            return _NULL_STAGE
+
+        return _SeriesScope(series)
+
+    @classmethod
+    def Add(cls, stage: str, series: str = None, **counters) -> None:
+
+        if not cls.enabled:
+            return
+
+        with cls.lock:
+
+            totals = [ cls.stages.setdefault(stage, dict.fromkeys(cls.counter_names, 0)) ]
+
+            if series:
+                totals.append( cls.series.setdefault(series, {}).setdefault(stage, dict.fromkeys(cls.counter_names, 0)) )
+
+            for total in totals:
+                for key, value in counters.items():
+                    total[key] = max(total.get(key, 0), value) if key.startswith('peak_') else total.get(key, 0) + value
+
+    @staticmethod
+    def FileSize(files: list or tuple or str) -> int:
+
+        if isinstance(files, (str, Path)):
+            files = [files]
+
+        return sum( os.path.getsize(file) for file in files )
+
+    @classmethod
+    def Report(cls) -> dict:
+
+        with cls.lock:
+
+            return {    'stages': { stage: dict(values) for stage, values in cls.stages.items() },
+                        'series': { series: { stage: dict(values) for stage, values in stages.items() }
+                                    for series, stages in cls.series.items() }
+            }
+
+    @classmethod
+    def WriteJson(cls, path: Path) -> None:
+
+        JsonUtils.Write(cls.Report(), path)
+
+    @classmethod
+    def WritePrometheus(cls, path: Path, job: str = 'procanload') -> None:
+        '''
+        Prometheus text format for the node exporter textfile collector (per stage, series are only in the json report).
+        Written to a temporary file and renamed, the collector must not read a half written file.
+        '''
+
+        report = cls.Report()['stages']
+
+        lines = []
+        for counter in cls.counter_names:
+
+            name = f'procanload_stage_{counter}'
+            lines.append(f'# HELP {name} ProCanLoad {counter.replace("_", " ")} per stage of the last run')
+            lines.append(f'# TYPE {name} gauge')
+
+            for stage, values in report.items():
+                lines.append(f'{name}{{job="{job}",stage="{stage}"}} {values.get(counter, 0)}')
+
+        lines.append('# HELP procanload_last_run_timestamp_seconds Unix time the metrics were written')
+        lines.append('# TYPE procanload_last_run_timestamp_seconds gauge')
+        lines.append(f'procanload_last_run_timestamp_seconds{{job="{job}"}} {time.time()}')
+
+        temp_path = f'{path}.{os.getpid()}.tmp'
+
+        with open(temp_path, 'w') as f:
+            f.write('\n'.join(lines) + '\n')
+
+        os.replace(temp_path, path)
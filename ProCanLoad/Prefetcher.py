@@ -0,0 +1,248 @@
+import os
+import time
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, wait
+from .Metrics import Metrics
+
+
+class Prefetcher:
+    '''
+    Read-ahead for slow or networked storage. While one series (or study) is processed, the files of the next
+    ones are read by a bounded thread pool, so the page cache is warm when SimpleITK/pydicom open them.
+
+    prefetcher = Prefetcher(window_series=2, window_bytes=256*2**20)
+
+    with prefetcher.Start([(key, files), ...]):
+        for key, files in plan:
+            prefetcher.Acquire(key)
+            ...
+
+    window_series: how many items ahead of the current one are scheduled
+    window_bytes: no new item is scheduled while the prefetched and not yet consumed bytes exceed it
+    workers: threads issuing the reads
+    mode: 'read' reads the files and discards the data, 'fadvise' asks the kernel with posix_fadvise(WILLNEED)
+          and returns immediately. 'fadvise' falls back to 'read' where it is not available (e.g. Windows).
+    '''
+
+    def __init__(self,  window_series: int = 2,
+                        window_bytes: int = 256 * 2**20,
+                        workers: int = 4,
+                        mode: str = 'read'
+    ) -> None:
+
+        if mode not in ('read', 'fadvise'):
+            raise ValueError(f'mode must be "read" or "fadvise", not {mode!r}')
+
+        self.window_series = window_series
+        self.window_bytes = window_bytes
+        self.workers = workers
+        self.mode = mode if hasattr(os, 'posix_fadvise') else 'read'
+
+        self.chunk_size = 2**20
+        self.lock = threading.Lock()
+        self.executor = None
+        self.ResetStats()
+
+    def ResetStats(self) -> None:
+
+        self.stats = {  'series': 0,
+                        'files': 0,
+                        'bytes': 0,
+                        'errors': 0,
+                        'fetch_seconds': 0.0,
+                        'fetch_wall_seconds': 0.0,
+                        'wait_seconds': 0.0,
+        }
+
+        # Fetch interval being extended, the ones before it are counted in fetch_wall_seconds
+        self.cover = None
+
+    def Stats(self) -> dict:
+        '''
+        fetch_seconds: time the workers spent on the files of the consumed items, summed over the workers
+        fetch_wall_seconds: wall-clock time during which at least one of these files was being fetched
+        wait_seconds: time Acquire blocked because the prefetch of the item was not finished
+        hidden_seconds: fetch_wall_seconds - wait_seconds, the wall-clock read time taken off the critical path
+        '''
+        with self.lock:
+            stats = dict(self.stats)
+            cover = self.cover
+
+        if cover is not None:
+            stats['fetch_wall_seconds'] += cover[1] - cover[0]
+
+        stats['hidden_seconds'] = max(stats['fetch_wall_seconds'] - stats['wait_seconds'], 0.0)
+
+        return stats
+
+    def Start(self, plan: list, head_bytes: int = None):
+        '''
+        plan: ordered [(key, [files])], the order in which Acquire will be called
+        head_bytes: only the first bytes of each file are fetched (header scan), None for the whole file
+        '''
+        self.Stop()
+
+        self.plan = OrderedDict( (key, list(files or [])) for key, files in plan )
+        self.order = list(self.plan.keys())
+        self.index = { key: index for index, key in enumerate(self.order) }
+        self.head_bytes = head_bytes
+
+        self.futures = {}
+        self.fetched_bytes = {}
+        self.next_index = 0
+
+        self.executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='prefetch')
+        self.__Schedule(0)
+
+        return self
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+
+        self.Stop()
+        return False
+
+    def Stop(self) -> None:
+
+        if self.executor is None:
+            return
+
+        for futures in self.futures.values():
+            for future in futures:
+                future.cancel()
+
+        self.executor.shutdown(wait=True)
+        self.executor = None
+
+    def Acquire(self, key) -> None:
+        '''
+        Called before the item is processed. Waits for its prefetch, releases the items before it
+        and schedules the next ones inside the window.
+        '''
+        if self.executor is None or key not in self.plan:
+            return
+
+        index = self.index[key]
+
+        # Consumed items do not count for the byte window any more
+        for previous in list(self.futures):
+
+            if self.index[previous] >= index:
+                continue
+
+            self.fetched_bytes.pop(previous, None)
+            self.futures.pop(previous, None)
+
+        futures = self.futures.pop(key, None)
+
+        if futures is None:
+            self.__Schedule(index + 1)
+            return
+
+        start = time.perf_counter()
+        wait(futures)
+        waited = time.perf_counter() - start
+
+        fetched_bytes, fetch_seconds, errors = 0, 0.0, 0
+        intervals = []
+        for future in futures:
+
+            if future.cancelled():
+                continue
+
+            size, fetch_start, fetch_end, error = future.result()
+            fetched_bytes += size
+            fetch_seconds += fetch_end - fetch_start
+            errors += error
+            intervals.append( (fetch_start, fetch_end) )
+
+        self.fetched_bytes.pop(key, None)
+
+        with self.lock:
+            self.stats['series'] += 1
+            self.stats['files'] += len(futures)
+            self.stats['bytes'] += fetched_bytes
+            self.stats['errors'] += errors
+            self.stats['fetch_seconds'] += fetch_seconds
+            self.stats['wait_seconds'] += waited
+
+            for interval in sorted(intervals):
+                self.__Cover(*interval)
+
+        Metrics.Add('prefetch', calls=1, files=len(futures), bytes_read=fetched_bytes, seconds=fetch_seconds)
+
+        self.__Schedule(index + 1)
+
+    def __Cover(self, start: float, end: float) -> None:
+        '''
+        Add a fetch interval to the wall-clock time. The pool starts the files in the order they were submitted and the
+        items are consumed in that order, so the intervals come in the order of their start (up to the threads racing)
+        '''
+        if self.cover is None:
+            self.cover = [start, end]
+
+        elif start > self.cover[1]:
+            self.stats['fetch_wall_seconds'] += self.cover[1] - self.cover[0]
+            self.cover = [start, end]
+
+        else:
+            self.cover[1] = max(self.cover[1], end)
+
+    def __Schedule(self, current: int) -> None:
+
+        self.next_index = max(self.next_index, current)
+
+        while self.next_index < len(self.order) and self.next_index <= current + self.window_series:
+
+            # The byte window is checked against what is already fetched and not consumed,
+            # at least one item ahead is always scheduled
+            if self.futures and sum(self.fetched_bytes.values()) >= self.window_bytes:
+                break
+
+            key = self.order[self.next_index]
+            self.fetched_bytes[key] = 0
+            self.futures[key] = [ self.executor.submit(self.__Fetch, key, file) for file in self.plan[key] ]
+            self.next_index += 1
+
+    def __Fetch(self, key, file: str) -> tuple:
+        '''
+        Returns (bytes, start, end, error), missing files are reported by the reader itself later
+        '''
+        start = time.perf_counter()
+        size = 0
+
+        try:
+            if self.mode == 'fadvise':
+
+                fd = os.open(file, os.O_RDONLY)
+                try:
+                    size = os.fstat(fd).st_size if self.head_bytes is None else min(os.fstat(fd).st_size, self.head_bytes)
+                    os.posix_fadvise(fd, 0, size, os.POSIX_FADV_WILLNEED)
+                finally:
+                    os.close(fd)
+
+            else:
+
+                limit = self.head_bytes
+                with open(file, 'rb', buffering=0) as f:
+
+                    buffer = bytearray(self.chunk_size if limit is None else min(self.chunk_size, limit))
+                    while limit is None or size < limit:
+
+                        read = f.readinto(buffer)
+                        if not read:
+                            break
+
+                        size += read
+
+        except OSError:
+            return size, start, time.perf_counter(), 1
+
+        with self.lock:
+            if key in self.fetched_bytes:
+                self.fetched_bytes[key] += size
+
+        return size, start, time.perf_counter(), 0
@@ -0,0 +1,153 @@
+import os
+import sqlite3
+import threading
+from pathlib import Path
+
+
+class SOPIndex:
+    '''
+    Persistent SOP Instance UID -> file index (SQLite), filled by ImageLoader while the headers are scanned.
+    The index is global: a series that is scanned again replaces its own rows, the rest of the archive is kept.
+
+    index = SOPIndex('sop_index.sqlite')
+    rows = index.Lookup(sop_uids)                  # {sop_uid: {'path', 'patient_id', 'study_uid', 'series_uid', 'position', 'rows', 'columns'}}
+    rows = index.Lookup(sop_uids, series_uid)      # only the instances stored in that series
+    sizes = index.Matrices(series_uids)            # {series_uid: {(rows, columns): count}}
+    '''
+
+    fields = ['sop_uid', 'path', 'patient_id', 'study_uid', 'series_uid', 'position', 'rows', 'columns']
+
+    def __init__(self, path: Path = 'sop_index.sqlite') -> None:
+
+        self.path = str(path)
+
+        if os.path.dirname(self.path):
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+
+        # One connection shared by the threads of the process, the lock serialises the statements
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(self.path, check_same_thread=False)
+
+        with self.lock, self.connection:
+
+            self.connection.execute('''CREATE TABLE IF NOT EXISTS instances (
+                                            sop_uid     TEXT NOT NULL,
+                                            path        TEXT NOT NULL,
+                                            patient_id  TEXT,
+                                            study_uid   TEXT,
+                                            series_uid  TEXT,
+                                            position    REAL,
+                                            n_rows      INTEGER,
+                                            n_columns   INTEGER,
+                                            PRIMARY KEY (sop_uid, path)
+                                        ) WITHOUT ROWID''')
+            self.connection.execute('CREATE INDEX IF NOT EXISTS instances_series ON instances (series_uid)')
+
+    def Close(self) -> None:
+
+        with self.lock:
+            self.connection.close()
+
+    def AddSeries(self, series_uid: str, instances: list) -> None:
+        '''
+        Replace the rows of the series.
+        instances: [(sop_uid, path, patient_id, study_uid, position, rows, columns)]
+        '''
+        with self.lock, self.connection:
+
+            self.connection.execute('DELETE FROM instances WHERE series_uid = ?', (series_uid,))
+            self.connection.executemany('INSERT OR REPLACE INTO instances VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                                        [ (sop_uid, path, patient_id, study_uid, series_uid, position, rows, columns)
+                                          for sop_uid, path, patient_id, study_uid, position, rows, columns in instances ])
+
+    def __Select(self, query: str, uids: list, parameters: tuple = ()) -> list:
+        '''
+        The uids are loaded once in a temporary table and joined, any number of them in one query
+        '''
+        with self.lock:
+
+            self.connection.execute('CREATE TEMP TABLE IF NOT EXISTS lookup (uid TEXT PRIMARY KEY)')
+            self.connection.execute('DELETE FROM lookup')
+            self.connection.executemany('INSERT OR IGNORE INTO lookup VALUES (?)', ( (uid,) for uid in uids ))
+
+            rows = self.connection.execute(query, parameters).fetchall()
+
+            self.connection.execute('DELETE FROM lookup')
+            self.connection.commit()
+
+        return rows
+
+    def Lookup(self, sop_uids: list, series_uid: str = None) -> dict:
+        '''
+        Batch lookup. Missing SOP Instance UIDs are not in the result.
+        An instance stored in more than one place returns the first path (use series_uid to choose the series).
+        '''
+        query = '''SELECT i.sop_uid, i.path, i.patient_id, i.study_uid, i.series_uid, i.position, i.n_rows, i.n_columns
+                   FROM lookup l JOIN instances i ON i.sop_uid = l.uid'''
+        parameters = ()
+
+        if series_uid is not None:
+            query += ' WHERE i.series_uid = ?'
+            parameters = (series_uid,)
+
+        result = {}
+        for row in self.__Select(query + ' ORDER BY i.sop_uid, i.path', sop_uids, parameters):
+            result.setdefault( row[0], dict( zip(self.fields[1:], row[1:]) ) )
+
+        return result
+
+    def Duplicates(self, series_uids: list = None) -> dict:
+        '''
+        SOP Instance UIDs stored in more than one series folder, {sop_uid: [paths]}.
+        If series_uids is given, only instances which have a copy inside these series.
+        '''
+        query = '''SELECT sop_uid, path FROM instances WHERE sop_uid IN (
+                        SELECT sop_uid FROM instances GROUP BY sop_uid HAVING COUNT(DISTINCT series_uid) > 1 )'''
+
+        if series_uids is not None:
+            query += ' AND sop_uid IN (SELECT i.sop_uid FROM instances i JOIN lookup l ON i.series_uid = l.uid)'
+
+        duplicates = {}
+        for sop_uid, path in self.__Select(query + ' ORDER BY sop_uid, path', series_uids or []):
+            duplicates.setdefault(sop_uid, []).append(path)
+
+        return duplicates
+
+    def Matrices(self, series_uids: list) -> dict:
+        '''
+        Matrix sizes of the instances of every series, {series_uid: {(rows, columns): number of instances}}.
+        Series without indexed instances are not in the result.
+        '''
+        query = '''SELECT i.series_uid, i.n_rows, i.n_columns, COUNT(*)
+                   FROM lookup l JOIN instances i ON i.series_uid = l.uid
+                   GROUP BY i.series_uid, i.n_rows, i.n_columns'''
+
+        matrices = {}
+        for series_uid, rows, columns, count in self.__Select(query, series_uids):
+            matrices.setdefault(series_uid, {})[ (rows, columns) ] = count
+
+        return matrices
+
+    @staticmethod
+    def Merge(paths: list, output: Path) -> list:
+        '''
+        Combine the indexes of the shards, rows of the same instance and path are kept once.
+        Returns the series of the shards, the series their scans indexed
+        '''
+        index = SOPIndex(output)
+        series_uids = {}
+
+        with index.lock:
+
+            for path in paths:
+
+                index.connection.execute('ATTACH DATABASE ? AS shard', (str(path),))
+                index.connection.execute('INSERT OR REPLACE INTO instances SELECT * FROM shard.instances')
+                index.connection.commit()
+
+                series_uids.update( dict.fromkeys( uid for uid, in index.connection.execute('SELECT DISTINCT series_uid FROM shard.instances') ) )
+                index.connection.execute('DETACH DATABASE shard')
+
+        index.Close()
+
+        return list(series_uids)
@@ -2,19 +2,25 @@ import os
 from pathlib import Path
 import SimpleITK as sitk
 import pydicom
+from pydicom.multival import MultiValue
 import pandas as pd
 import numpy as np
 
 from .utils import DataFrameUtils
 from .sitk_utils import SitkUtils
+from .pydicom_utils import DCMUtils
 from .IssueLogger import IssueLogger
+from .Metrics import Metrics
+from .SOPIndex import SOPIndex
 
 class SegmentationLoader():
 
     def __init__(self,  images_directory_path: Path,
                         parquet_series: Path or pd.DataFrame,
                         parquet_segmentations: Path or pd.DataFrame,
-                        reset_logger:bool = False
+                        reset_logger:bool = False,
+                        issue_logger: Path = 'issues/image_loader_issues.json',
+                        sop_index: Path or SOPIndex = None
 
     ) -> None:
         
@@ -22,7 +28,10 @@ class SegmentationLoader():
         self.parquet_series = parquet_series
         self.parquet_segmentations = parquet_segmentations
 
-        self.logger = IssueLogger(reset = reset_logger)
+        # With the index of ImageLoader, the referenced slices are found without reading the T2 files
+        self.sop_index = SOPIndex(sop_index) if isinstance(sop_index, (str, Path)) else sop_index
+
+        self.logger = IssueLogger(reset = reset_logger, issue_logger = issue_logger)
 
 
     @staticmethod
@@ -64,14 +73,74 @@ class SegmentationLoader():
         
         return label_dict
 
+    def __IndexReferencedSlices(self, seg: pydicom.Dataset) -> tuple:
+        '''
+        Slices referenced by the segmentation frames, looked up in the SOP index in one call.
+        Returns ({sop_uid: location in the source image}, [rows, columns]), empty if the series is not indexed.
+        '''
+        # The index has one row per file, the frames of a multi-frame source are located from its header
+        if self.sop_index is None or self.multi_frame:
+            return {}, None
+
+        referenced = [  ref_per_frame[0x0008, 0x9124][0][0x0008, 0x2112][0][0x008,0x1155].value
+                        for ref_per_frame in seg[0x5200, 0x9230] ]
+
+        indexed = self.sop_index.Lookup(referenced, series_uid = self.series)
+        path_location = { path: loc for loc, path in reversed( list( enumerate(self.image_list_path) ) ) }
+
+        sop_location = { sop_uid: path_location[row['path']] for sop_uid, row in indexed.items() if row['path'] in path_location }
+
+        if not sop_location:
+            return {}, None
+
+        row = indexed[ next(iter(sop_location)) ]
+
+        return sop_location, [row['rows'], row['columns']]
+
+    def __FrameLocations(self) -> tuple:
+        '''
+        Multi-frame source image: location of every (SOP Instance UID, frame number) inside the source image.
+        Each file is read once, header only. Returns ({(sop_uid, frame number): location}, [rows, columns])
+        '''
+        headers = {}
+        sop_location = {}
+
+        for loc, image_slice in enumerate(self.image_slices):
+
+            if image_slice['path'] not in headers:
+                headers[image_slice['path']] = DCMUtils.ReadSlice(image_slice['path'], stop_before_pixels=True)
+
+            header = headers[image_slice['path']]
+            sop_location.setdefault( (header.SOPInstanceUID, image_slice.get('frame', 0) + 1), loc )
+
+        return sop_location, [header.Rows, header.Columns]
+
+    def __ReferenceKey(self, ref_per_frame: pydicom.Dataset):
+        '''
+        Key of the source slice referenced by a segmentation frame: the SOP Instance UID, with the
+        Referenced Frame Number if the source image is multi-frame
+        '''
+        source = ref_per_frame[0x0008, 0x9124][0][0x0008, 0x2112][0]
+
+        if not self.multi_frame:
+            return source[0x008,0x1155].value
+
+        frame_number = source.get((0x0008,0x1160))
+        frame_number = frame_number.value if frame_number is not None else 1
+
+        if isinstance(frame_number, (MultiValue, list)):
+            frame_number = frame_number[0]
+
+        return source[0x008,0x1155].value, int(frame_number)
+
     def MatchSliceIDSeg2Img(self, series_dict):
 
 
         self.study = series_dict['meta']['study_uid']
         self.series = series_dict['meta']['series_uid']
 
-        self.df = DataFrameUtils.Read(self.parquet_series)
-        self.df_seg = DataFrameUtils.Read(self.parquet_segmentations)
+        self.df = DataFrameUtils.Read(self.parquet_series, columns=['patient_id', 'series_uid'], filters=[('series_uid', '==', self.series)])
+        self.df_seg = DataFrameUtils.Read(self.parquet_segmentations, columns=['source_series_uid', 'derived_series_uid'], filters=[('source_series_uid', '==', self.series)])
         
         self.seg_series = self.df_seg[ self.df_seg.source_series_uid == self.series].derived_series_uid.iloc[0]
 
@@ -81,25 +150,49 @@ class SegmentationLoader():
         image_dict_path = series_dict['dcm_path'].copy()
         self.test_origin = float( list(image_dict_path.keys())[0] )
         self.image_list_path = [path['path'] for  path in image_dict_path.values()]
+        self.image_slices = list(image_dict_path.values())
+        self.multi_frame = any( 'frame' in image_slice for image_slice in self.image_slices )
         
-        #Load image slice 1 by 1 and get slice unique id
-        sop_uid_list = []
+        #Load segmentation
+        segmentation_path = os.path.join(self.images_directory_path, self.patient, self.study, self.seg_series, 'image-001.dcm')
+        with Metrics.Stage('seg_decode', self.seg_series) as stage:
+
+            seg = pydicom.dcmread(segmentation_path)
+            seg_im = seg.pixel_array
+
+            if Metrics.enabled:
+                stage.Count(files=1, bytes_read=Metrics.FileSize(segmentation_path))
+
+        #Location of each slice unique id (SOP UID) inside the source image
+        sop_location, xysize = self.__IndexReferencedSlices(seg)
+
+        if not sop_location and self.multi_frame:
+
+            with Metrics.Stage('seg_reference_read', self.series) as stage:
+
+                sop_location, xysize = self.__FrameLocations()
+
+                if Metrics.enabled:
+                    stage.Count(files=len(set(self.image_list_path)), bytes_read=Metrics.FileSize(list(set(self.image_list_path))))
 
-        for image_path in self.image_list_path:    
-   
-            image = sitk.ReadImage(image_path)
-            sop_uid = image.GetMetaData("0008|0018")
-            sop_uid_list.append(sop_uid)
+        elif not sop_location:
+
+            #Load image slice 1 by 1 and get slice unique id
+            with Metrics.Stage('seg_reference_read', self.series) as stage:
+
+                for loc, image_path in enumerate(self.image_list_path):
+
+                    image = sitk.ReadImage(image_path)
+                    sop_location.setdefault(image.GetMetaData("0008|0018"), loc)
+
+                if Metrics.enabled:
+                    stage.Count(files=len(self.image_list_path), bytes_read=Metrics.FileSize(self.image_list_path))
+
+            xysize = list(image.GetSize()[::-1][1:3]) # Only x,y needed
 
         xyzsize = [len(self.image_list_path)]  # Slices from source image
-        xysize = list(image.GetSize()[::-1][1:3]) # Only x,y needed
         xyzsize.extend(xysize) 
 
-        #Load segmentation
-        segmentation_path = os.path.join(self.images_directory_path, self.patient, self.study, self.seg_series, 'image-001.dcm')
-        seg = pydicom.dcmread(segmentation_path)
-        seg_im = seg.pixel_array
-
         labels = self.CreateLabelDict(seg)
         labels = self.CorrectLabelDict2Ref(seg, labels)
 
@@ -108,15 +201,15 @@ class SegmentationLoader():
 
         for slice_seg, ref_per_frame in enumerate(seg[0x5200, 0x9230]):
                 
-            ref_sop_uid = ref_per_frame[0x0008, 0x9124][0][0x0008, 0x2112][0][0x008,0x1155].value
+            ref_sop_uid = self.__ReferenceKey(ref_per_frame)
 
             ref_seg_encoded = ref_per_frame[0x0062, 0x000a][0][ 0x0062, 0x000b].value #Hot-encoded of label
 
             label_name = labels[ref_seg_encoded]
 
-            if ref_sop_uid in sop_uid_list:
+            if ref_sop_uid in sop_location:
 
-                loc_in_image = sop_uid_list.index(ref_sop_uid) #Find location of reference seg's slice inside source image's slices
+                loc_in_image = sop_location[ref_sop_uid] #Find location of reference seg's slice inside source image's slices
 
                 if label_name not in self.segment_dict:
                     
@@ -137,7 +230,8 @@ class SegmentationLoader():
 
     def WriteSegmentation(self):
 
-        imageITK = SitkUtils.LoadImageByFolder(self.image_list_path)
+        with Metrics.Series(self.series):
+            imageITK = SitkUtils.LoadSlices(self.image_slices)
         assert self.test_origin in imageITK.GetOrigin(), f"Origin mismatch when loading images \n first slice location: {self.test_origin}\n loaded_image: {imageITK.GetOrigin()}"
 
         segment_labels = { }
@@ -201,7 +295,12 @@ class SegmentationLoader():
             mask_itk.CopyInformation(imageITK)
             mask_itk = sitk.Cast(mask_itk, sitk.sitkUInt8)
 
-            sitk.WriteImage(mask_itk, output)
+            with Metrics.Stage('seg_write', self.seg_series) as stage:
+
+                sitk.WriteImage(mask_itk, output)
+
+                if Metrics.enabled:
+                    stage.Count(volumes_written=1, bytes_written=Metrics.FileSize(output))
 
         return segment_labels, zero_mask
         
@@ -0,0 +1,238 @@
+import os
+import sys
+import struct
+import threading
+import numpy as np
+import SimpleITK as sitk
+from .sitk_utils import SitkUtils
+
+try:
+    from multiprocessing import shared_memory, resource_tracker
+
+except ImportError:
+    # Python 3.7
+    shared_memory = resource_tracker = None
+
+try:
+    import fcntl
+
+except ImportError:
+    # Windows, a block is freed by the system once its last handle is closed
+    fcntl = None
+
+
+class SharedVolume:
+    '''
+    Volume (z, y, x) in a named shared memory block with its geometry, handed between processes without copying the voxels.
+    Pickling it (a ProcessPoolExecutor result, a multiprocessing.Queue item) sends only the name of the block, the shape,
+    the type, the geometry and meta, the receiving process maps the same block.
+
+    def Worker(path):                                   # in a worker process
+        volume = SharedVolume.FromImage(SitkUtils.LoadSingleFile(path, 'LPS'), meta={'label': 'PZ'})
+        return volume.Handoff()                         # the pickled copy takes the reference of the worker
+
+    with executor.submit(Worker, path).result() as volume:   # in the coordinator
+        volume.array                                    # np.ndarray on the shared block, no copy
+        image = volume.Image()                          # sitk.Image with the geometry (a copy)
+
+    volume = SharedVolume.Empty(shape, np.uint8, origin, spacing, direction)   # filled in place, e.g. by a decoder
+
+    References: the count is kept in the block, one for the volume created and one for every pickled copy, except the
+    first copy pickled after Handoff which takes the reference of the volume. Release (or the end of a with block) drops
+    the reference of this copy and unmaps it, the last one unlinks the block.
+    The blocks are left out of the resource tracker of multiprocessing, which would unlink a block when the worker which
+    created it exits. A copy pickled and never loaded, or a process killed, leaves its block (in /dev/shm on Linux).
+    multiprocessing.shared_memory needs Python 3.8.
+    '''
+
+    # Reference count (int64) at the start of the block, the voxels start at the next cache line
+    header_size = 64
+
+    # The fcntl locks are per process, the threads of a process take this one first
+    lock = threading.Lock()
+
+    def __init__(self, block, shape: tuple, dtype: np.dtype, origin: tuple, spacing: tuple, direction: tuple, meta: dict = None) -> None:
+
+        self.block = block
+        self.name = block.name
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(dtype)
+        self.origin = tuple(origin)
+        self.spacing = tuple(spacing)
+        self.direction = tuple(direction)
+        self.meta = dict(meta or {})
+
+        # This copy holds one reference of the block, until it is released or handed off
+        self.referenced = True
+        self.handoff = False
+
+        self.array = np.ndarray(self.shape, dtype=self.dtype, buffer=block.buf, offset=SharedVolume.header_size)
+
+    @staticmethod
+    def __Open(name: str = None, size: int = 0):
+        '''
+        New block of size bytes, or the existing block name, not tracked
+        '''
+        if shared_memory is None:
+            raise ImportError('SharedVolume needs multiprocessing.shared_memory, available from Python 3.8')
+
+        if sys.version_info >= (3, 13):
+            return shared_memory.SharedMemory(name=name, create=name is None, size=size, track=False)
+
+        block = shared_memory.SharedMemory(name=name, create=name is None, size=size)
+
+        if os.name == 'posix':
+            resource_tracker.unregister(block._name, 'shared_memory')
+
+        return block
+
+    @staticmethod
+    def __Unlink(block) -> None:
+
+        # unlink unregisters the block, registered again so that the tracker does not warn about an unknown one
+        if sys.version_info < (3, 13) and os.name == 'posix':
+            resource_tracker.register(block._name, 'shared_memory')
+
+        block.unlink()
+
+    @staticmethod
+    def Empty(  shape: tuple,
+                dtype: np.dtype,
+                origin: tuple = (0.0, 0.0, 0.0),
+                spacing: tuple = (1.0, 1.0, 1.0),
+                direction: tuple = (1.0, 0.0, 0.0, 0.0, 1.0, 0.0, 0.0, 0.0, 1.0),
+                meta: dict = None
+    ) -> 'SharedVolume':
+        '''
+        New block of shape and dtype (zeros), one reference
+        '''
+        size = SharedVolume.header_size + int(np.prod(shape)) * np.dtype(dtype).itemsize
+
+        block = SharedVolume.__Open(size=size)
+        struct.pack_into('<q', block.buf, 0, 1)
+
+        return SharedVolume(block, shape, dtype, origin, spacing, direction, meta)
+
+    @staticmethod
+    def FromArray(volume: np.ndarray, origin: tuple = (0.0, 0.0, 0.0), spacing: tuple = (1.0, 1.0, 1.0),
+                  direction: tuple = (1.0, 0.0, 0.0, 0.0, 1.0, 0.0, 0.0, 0.0, 1.0), meta: dict = None) -> 'SharedVolume':
+        '''
+        Copy of volume in a new block, the only copy on the way to the other processes
+        '''
+        shared = SharedVolume.Empty(volume.shape, volume.dtype, origin, spacing, direction, meta)
+        shared.array[...] = volume
+
+        return shared
+
+    @staticmethod
+    def FromImage(image: sitk.Image, meta: dict = None) -> 'SharedVolume':
+
+        return SharedVolume.FromArray(  sitk.GetArrayViewFromImage(image), image.GetOrigin(), image.GetSpacing(),
+                                        image.GetDirection(), meta )
+
+    @staticmethod
+    def Attach(name: str, shape: tuple, dtype: str, origin: tuple, spacing: tuple, direction: tuple, meta: dict = None) -> 'SharedVolume':
+        '''
+        Map an existing block, its reference was counted when it was pickled
+        '''
+        block = SharedVolume.__Open(name)
+
+        return SharedVolume(block, shape, dtype, origin, spacing, direction, meta)
+
+    @staticmethod
+    def __Count(block, change: int) -> int:
+        '''
+        Add change to the reference count of the block, the new count
+        '''
+        fd = getattr(block, '_fd', -1)
+
+        with SharedVolume.lock:
+
+            locked = False
+            if fcntl is not None and fd >= 0:
+
+                try:
+                    fcntl.lockf(fd, fcntl.LOCK_EX, 8, 0)
+                    locked = True
+
+                except OSError:
+                    # No record locks on shared memory here (e.g. macOS), only the threads are serialised
+                    pass
+
+            try:
+                count = struct.unpack_from('<q', block.buf, 0)[0] + change
+                struct.pack_into('<q', block.buf, 0, count)
+
+            finally:
+                if locked:
+                    fcntl.lockf(fd, fcntl.LOCK_UN, 8, 0)
+
+        return count
+
+    def References(self) -> int:
+
+        return SharedVolume.__Count(self.block, 0) if self.block is not None else 0
+
+    def Handoff(self) -> 'SharedVolume':
+        '''
+        The next copy pickled takes the reference of this one instead of a new one, e.g. the result of a worker process
+        '''
+        self.handoff = True
+
+        return self
+
+    def __reduce__(self):
+
+        if self.block is None:
+            raise ValueError(f'SharedVolume {self.name} was released')
+
+        # The reference of the copy, released by the process which loads it
+        if self.handoff and self.referenced:
+            self.handoff = self.referenced = False
+
+        else:
+            SharedVolume.__Count(self.block, 1)
+
+        return (SharedVolume.Attach, (self.name, self.shape, self.dtype.str, self.origin, self.spacing, self.direction, self.meta))
+
+    def Release(self) -> None:
+        '''
+        Drop the reference of this copy and unmap the block, it is unlinked with the last reference.
+        The array must not be used afterwards.
+        '''
+        if self.block is None:
+            return
+
+        block, self.block, self.array = self.block, None, None
+
+        if self.referenced and SharedVolume.__Count(block, -1) <= 0:
+            SharedVolume.__Unlink(block)
+
+        self.referenced = False
+
+        try:
+            block.close()
+
+        except BufferError:
+            # Views of the array are still alive, the mapping goes with them
+            pass
+
+    def Image(self, orientation: str = None) -> sitk.Image:
+        '''
+        sitk.Image of the volume with its geometry (a copy, the block can be released), reoriented with orientation
+        '''
+        return SitkUtils.ImageFromArray(self.array, self.origin, self.spacing, self.direction, orientation)
+
+    def __enter__(self):
+
+        return self
+
+    def __exit__(self, *exc):
+
+        self.Release()
+
+    def __repr__(self) -> str:
+
+        state = 'released' if self.block is None else f'{self.References()} references'
+
+        return f'SharedVolume({self.name}, {self.shape}, {self.dtype}, {state})'
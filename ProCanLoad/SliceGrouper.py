@@ -0,0 +1,214 @@
+import math
+from itertools import groupby
+from collections import Counter
+from pydicom.tag import Tag
+
+
+class SliceGrouper:
+    '''
+    Splits the slices of a DWI series into volumes from their headers, in one sort.
+
+    Slices with the same b-value and origin belong to different volumes (b, b-1, b-2, ...). The volumes are told apart
+    by the first header field that gives one distinct value per slice at every origin and as many values as volumes:
+    diffusion gradient direction, TemporalPositionIdentifier or AcquisitionNumber.
+    Pixels are compared (digest) only for slices at the same origin with the same header values, which are duplicates
+    when their pixels are identical. If no field separates the volumes, the k-th slice of every origin ordered by
+    InstanceNumber goes to the k-th volume. The result does not depend on the order of the files.
+    '''
+
+    gradient_tags = [ Tag(0x0018, 0x9089),     # Diffusion Gradient Orientation
+                      Tag(0x0019, 0x100e) ]    # Siemens private diffusion gradient direction
+
+    temporal_tag = Tag(0x0020, 0x0100)
+    acquisition_tag = Tag(0x0020, 0x0012)
+    instance_tag = Tag(0x0020, 0x0013)
+
+    header_fields = ['gradient', 'temporal', 'acquisition']
+
+    @staticmethod
+    def __Value(dcm_img, tag: Tag):
+
+        element = dcm_img.get(tag)
+
+        if element is None or element.value in (None, '', b''):
+            return None
+
+        value = element.value
+
+        if isinstance(value, bytes):
+            return value
+
+        try:
+            if isinstance(value, (list, tuple)) or hasattr(value, '__getitem__') and not isinstance(value, str):
+                return tuple( round(float(v), 4) for v in value )
+
+            return float(value)
+
+        except (TypeError, ValueError):
+            return str(value)
+
+    @staticmethod
+    def SliceInfo(order: int, file: str, dcm_img, bvalue: str, origin: tuple, main_origin: float, sop_uid: str, frame: int = None) -> dict:
+        '''
+        The header fields of the slice used for the grouping, order is the index of the slice in the series.
+        frame: index of the frame inside a multi-frame file (dcm_img is the frame of DCMUtils.GetFrames), None otherwise
+        '''
+        gradient = None
+        for tag in SliceGrouper.gradient_tags:
+
+            gradient = SliceGrouper.__Value(dcm_img, tag)
+            if gradient is not None:
+                break
+
+        instance = SliceGrouper.__Value(dcm_img, SliceGrouper.instance_tag)
+
+        return {    'order': order,
+                    'file': file,
+                    'frame': frame,
+                    'bvalue': bvalue,
+                    'origin': origin,
+                    'main_origin': main_origin,
+                    'sop': sop_uid,
+                    'gradient': gradient,
+                    'temporal': SliceGrouper.__Value(dcm_img, SliceGrouper.temporal_tag),
+                    'acquisition': SliceGrouper.__Value(dcm_img, SliceGrouper.acquisition_tag),
+                    'instance': instance if isinstance(instance, float) else float('inf'),
+        }
+
+    @staticmethod
+    def BValueKey(bvalue) -> tuple:
+        '''
+        Numeric order of b-values and volume names: '0' < '800' < '800-1' < '1400', the values which are not numbers
+        ('Unknown', 'Unknown-1', undecoded tags) last. Raw multi-valued tags ('1000000800\\8\\0\\0') by their first value.
+        '''
+        name, _, volume = str(bvalue).partition('-')
+        index = int(volume) if volume.isdigit() else 0
+
+        try:
+            number = float( name.split('\\')[0] )
+
+        except ValueError:
+            number = None
+
+        if number is None or not math.isfinite(number):
+            return (1, 0.0, name, index, str(bvalue))
+
+        return (0, number, '', index, str(bvalue))
+
+    @staticmethod
+    def __SortKey(value) -> tuple:
+        '''
+        None and mixed types are comparable
+        '''
+        return (value is None, type(value).__name__, value if value is not None else 0)
+
+    @staticmethod
+    def __HeaderKey(info: dict, fields: list) -> tuple:
+
+        return tuple( SliceGrouper.__SortKey(info[field]) for field in fields )
+
+    @staticmethod
+    def __DropDuplicates(at_origin: list, pixel_digest, duplicates: list) -> list:
+        '''
+        Slices at one origin: the same SOP Instance UID (and frame), or the same header values and identical pixels, are duplicates.
+        The first one by InstanceNumber and path is kept.
+        '''
+        kept = []
+        seen_sop = set()
+
+        for info in at_origin:
+
+            if info['sop'] and (info['sop'], info['frame']) in seen_sop:
+                duplicates.append(info)
+                continue
+
+            seen_sop.add( (info['sop'], info['frame']) )
+            kept.append(info)
+
+        header_keys = [ SliceGrouper.__HeaderKey(info, SliceGrouper.header_fields) for info in kept ]
+        counts = Counter(header_keys)
+
+        if len(counts) == len(kept):
+            return kept
+
+        # Headers are ambiguous, compare the pixels of the slices which share their header values
+        unique = []
+        digests = set()
+
+        for info, header_key in zip(kept, header_keys):
+
+            if counts[header_key] == 1:
+                unique.append(info)
+                continue
+
+            digest = (header_key, pixel_digest(info['file'], info['frame']))
+
+            if digest in digests:
+                duplicates.append(info)
+                continue
+
+            digests.add(digest)
+            unique.append(info)
+
+        return unique
+
+    @staticmethod
+    def Group(slices: list, pixel_digest) -> tuple:
+        '''
+        slices: SliceInfo of every file of the series
+        pixel_digest: (file, frame) -> hashable digest of the pixel data, only called for ambiguous slices
+        Returns ({volume name: [SliceInfo in file order]} by numeric b-value ('Unknown' last), then b, b-1, b-2...,
+                 [duplicated SliceInfo])
+        '''
+        duplicates = []
+        assigned = []
+
+        bvalues = sorted( { info['bvalue'] for info in slices }, key=SliceGrouper.BValueKey )
+        bvalue_order = { bvalue: index for index, bvalue in enumerate(bvalues) }
+
+        sort_key = lambda info: ( bvalue_order[info['bvalue']], info['origin'],
+                                  SliceGrouper.__HeaderKey(info, SliceGrouper.header_fields), info['instance'], info['file'] )
+
+        for bvalue, group in groupby(sorted(slices, key=sort_key), key=lambda info: info['bvalue']):
+
+            by_origin = [ SliceGrouper.__DropDuplicates(list(at_origin), pixel_digest, duplicates)
+                          for _, at_origin in groupby(group, key=lambda info: info['origin']) ]
+
+            n_volumes = max( len(at_origin) for at_origin in by_origin )
+
+            volume_of = None
+
+            if n_volumes > 1:
+
+                for field in SliceGrouper.header_fields:
+
+                    values = [ [ SliceGrouper.__SortKey(info[field]) for info in at_origin ] for at_origin in by_origin ]
+                    keys = { value for at_origin in values for value in at_origin }
+
+                    separates = len(keys) == n_volumes and all( len(set(at_origin)) == len(at_origin) for at_origin in values ) \
+                                and all( info[field] is not None for at_origin in by_origin for info in at_origin )
+
+                    if separates:
+
+                        rank = { key: index for index, key in enumerate(sorted(keys)) }
+                        volume_of = lambda info, k, field=field, rank=rank: rank[ SliceGrouper.__SortKey(info[field]) ]
+                        break
+
+            if volume_of is None:
+                # One volume, or the headers do not separate them: k-th slice of the origin by InstanceNumber
+                volume_of = lambda info, k: k
+
+            for at_origin in by_origin:
+
+                at_origin = sorted(at_origin, key=lambda info: (info['instance'], info['file']))
+
+                for k, info in enumerate(at_origin):
+                    assigned.append( (bvalue_order[bvalue], volume_of(info, k), info) )
+
+        volumes = {}
+        for b_index, volume, info in sorted(assigned, key=lambda item: (item[0], item[1], item[2]['order'])):
+
+            name = info['bvalue'] if volume == 0 else f"{info['bvalue']}-{volume}"
+            volumes.setdefault(name, []).append(info)
+
+        return volumes, sorted(duplicates, key=lambda info: info['order'])
@@ -0,0 +1,245 @@
+import numpy as np
+from .SOPIndex import SOPIndex
+from .pydicom_utils import DCMUtils
+
+
+class StudyValidator:
+    '''
+    Pre-flight checks of the studies from the manifest (image_loader.json) and the headers only, no pixel is read.
+    The checks of a series are vectorized over the ImagePositionPatient of its slices.
+
+    validator = StudyValidator(issues=JsonUtils.Load(issues_path), sop_index=index)
+    plan = validator.Validate(image_loader)     # {patient: {study: {'status': 'pass'|'fail', 'failed': {...}, 'warnings': {...}}}}
+
+    spacing:        the distance between neighbouring slices is uniform, a gap of ~2x the spacing is reported as missing slices
+    orientation:    the slices of a series are stacked along one line and in one main plane, the series of a study share their plane
+    slice_count:    the b-values of the DWI have the same number of slices
+    matrix:         the slices of a series have the same rows x columns (SOP index, or the headers when there is none)
+    seg_reference:  the SEG frames reference slices of the T2 and at least one mask was extracted
+    '''
+
+    checks = ['spacing', 'orientation', 'slice_count', 'matrix', 'seg_reference']
+
+    def __init__(self,
+                    checks: list = None,
+                    spacing_tolerance: float = 0.05,
+                    angle_tolerance: float = 1.0,
+                    keep_max_bvalue: bool = True,
+                    issues: dict = None,
+                    sop_index: SOPIndex = None
+    ) -> None:
+        '''
+        spacing_tolerance: relative deviation of a slice distance from the median distance of the series
+        angle_tolerance: degrees between the slice steps of a series
+        keep_max_bvalue: only one b-value is exported, a slice count mismatch is then a warning
+        issues: the issue log of the scan (SegmentationSliceReferenceNotFound)
+        '''
+
+        self.checks = list(checks) if checks is not None else list(StudyValidator.checks)
+
+        unknown = set(self.checks) - set(StudyValidator.checks)
+        if unknown:
+            raise ValueError(f'Unknown checks {sorted(unknown)}, use {StudyValidator.checks}')
+
+        self.spacing_tolerance = spacing_tolerance
+        self.angle_tolerance = angle_tolerance
+        self.keep_max_bvalue = keep_max_bvalue
+        self.issues = issues or {}
+        self.sop_index = sop_index
+
+    @staticmethod
+    def Origins(record: dict) -> np.ndarray:
+        '''
+        ImagePositionPatient of the slices (N x 3) in manifest order, from a SeriesRecord or its json
+        '''
+        if hasattr(record, 'origins'):
+            return record.origins
+
+        origins = [ slice_dict['ImagePositionPatient'].split(',') for slice_dict in record.get('dcm_path', {}).values() ]
+
+        return np.array(origins, dtype=np.float64).reshape(-1, 3)
+
+    @staticmethod
+    def CheckSpacing(origins: np.ndarray, tolerance: float = 0.05) -> dict:
+        '''
+        {problem: detail} of the distances between neighbouring slices, empty if uniform
+        '''
+        if len(origins) < 3:
+            return {}
+
+        steps = np.linalg.norm( np.diff(origins, axis=0), axis=1 )
+        median = float(np.median(steps))
+
+        if median == 0:
+            return {'RepeatedSlicePositions': f'{int((steps == 0).sum())} slices share the position of the previous one'}
+
+        problems = {}
+
+        gaps = steps > 1.5 * median
+        if gaps.any():
+            missing = int( np.round(steps[gaps] / median).sum() - gaps.sum() )
+            problems['MissingSlices'] = f'{max(missing, 1)} slices missing in {int(gaps.sum())} gaps, spacing {median:.3f} mm'
+
+        regular = steps[~gaps]
+        deviation = np.abs(regular - median) / median
+
+        if deviation.size and deviation.max() > tolerance:
+            problems['NonUniformSpacing'] = f'Slice distance {regular.min():.3f} to {regular.max():.3f} mm, median {median:.3f} mm'
+
+        return problems
+
+    @staticmethod
+    def CheckAlignment(origins: np.ndarray, angle_tolerance: float = 1.0) -> dict:
+        '''
+        The slice steps of the series are parallel (a single stack), empty if they are
+        '''
+        steps = np.diff(origins, axis=0)
+        lengths = np.linalg.norm(steps, axis=1)
+        steps = steps[lengths > 0] / lengths[lengths > 0, None]
+
+        if len(steps) < 2:
+            return {}
+
+        cosines = np.clip( np.abs(steps @ steps[0]), 0, 1 )
+        angle = float( np.degrees( np.arccos(cosines.min()) ) )
+
+        if angle > angle_tolerance:
+            return {'SlicesNotAligned': f'Slice steps differ by up to {angle:.1f} degrees'}
+
+        return {}
+
+    def __HeaderMatrices(self, records: dict) -> dict:
+        '''
+        {series_uid: {(rows, columns): count}} read from the headers, when there is no SOP index
+        '''
+        matrices = {}
+
+        for series_uid, record in records.items():
+
+            paths = dict.fromkeys( slice_dict['path'] for slice_dict in record['dcm_path'].values() )
+
+            for path in paths:
+
+                header = DCMUtils.ReadSlice(path, stop_before_pixels=True, specific_tags=['Rows', 'Columns'])
+                size = ( header.get('Rows'), header.get('Columns') )
+
+                matrices.setdefault(series_uid, {})
+                matrices[series_uid][size] = matrices[series_uid].get(size, 0) + 1
+
+        return matrices
+
+    def __Series(self, study: dict) -> dict:
+        '''
+        {(sequence, bvalue): record} of the image series of the study
+        '''
+        return {    (sequence, bvalue): record
+                    for sequence, bvalues in study.items() if sequence != 'SEG'
+                    for bvalue, record in bvalues.items() if 'dcm_path' in record
+        }
+
+    def ValidateStudy(self, study: dict) -> dict:
+        '''
+        {'status': 'pass'|'fail', 'failed': {check: {problem: detail}}, 'warnings': {check: {problem: detail}}}
+        '''
+        failed = {}
+        warnings = {}
+        series = self.__Series(study)
+
+        def Report(result: dict, check: str, name: str, problems: dict) -> None:
+
+            if problems:
+                result.setdefault(check, {}).update( { f'{name}: {problem}': detail for problem, detail in problems.items() } )
+
+        origins = { name: StudyValidator.Origins(record) for name, record in series.items() }
+        label = lambda name: name[0] if name[1] == 'N/A' else f'{name[0]}_{name[1]}'
+
+        if 'spacing' in self.checks:
+
+            for name, series_origins in origins.items():
+                Report(failed, 'spacing', label(name), StudyValidator.CheckSpacing(series_origins, self.spacing_tolerance))
+
+        if 'orientation' in self.checks:
+
+            planes = {}
+
+            for name, record in series.items():
+
+                plane = record['meta'].get('Image Main Plane', '')
+
+                if ',' in plane:
+                    Report(failed, 'orientation', label(name), {'MultiplePlanes': f'Slices in the planes {plane}'})
+
+                elif plane:
+                    planes.setdefault(plane, []).append(label(name))
+
+                Report(failed, 'orientation', label(name), StudyValidator.CheckAlignment(origins[name], self.angle_tolerance))
+
+            if len(planes) > 1:
+                warnings.setdefault('orientation', {})['PlaneMismatch'] = f'Series in different main planes {planes}'
+
+        if 'slice_count' in self.checks:
+
+            counts = { bvalue: len(origins[(sequence, bvalue)]) for sequence, bvalue in series if sequence == 'DWI' }
+
+            if len(set(counts.values())) > 1:
+
+                result = warnings if self.keep_max_bvalue else failed
+                result.setdefault('slice_count', {})['DWISliceCountMismatch'] = f'Slices per b-value {counts}'
+
+        if 'matrix' in self.checks:
+
+            records = { record['meta']['series_uid']: record for record in series.values() if 'series_uid' in record['meta'] }
+
+            if self.sop_index is not None:
+                matrices = self.sop_index.Matrices(list(records))
+
+                # Series scanned without the index
+                missing = { series_uid: record for series_uid, record in records.items() if series_uid not in matrices }
+                matrices.update( self.__HeaderMatrices(missing) )
+
+            else:
+                matrices = self.__HeaderMatrices(records)
+
+            names = { record['meta']['series_uid']: label(name) for name, record in series.items() if 'series_uid' in record['meta'] }
+
+            for series_uid, sizes in matrices.items():
+
+                if len(sizes) > 1:
+                    detail = ', '.join( f'{count} x {rows}x{columns}' for (rows, columns), count in sizes.items() )
+                    Report(failed, 'matrix', names[series_uid], {'MixedMatrixSize': f'Slices of {detail}'})
+
+        if 'seg_reference' in self.checks and 'SEG' in study:
+
+            segments = study['SEG']
+            not_found = self.issues.get('SegmentationSliceReferenceNotFound') or {}
+
+            if not segments:
+                failed.setdefault('seg_reference', {})['NoMaskExtracted'] = 'The SEG of the study gave no mask'
+
+            for seg_series in dict.fromkeys( segment['meta']['seg_series_uid'] for segment in segments.values() ):
+
+                if seg_series in not_found:
+                    failed.setdefault('seg_reference', {})['SegReferenceNotFound'] = f'{seg_series}: {not_found[seg_series]}'
+
+        return {    'status': 'fail' if failed else 'pass',
+                    'failed': failed,
+                    'warnings': warnings
+        }
+
+    def Validate(self, image_loader: dict) -> dict:
+        '''
+        Pass/fail plan of every study of the manifest, {patient: {study: ValidateStudy}}
+        '''
+        return {    patient: { study: self.ValidateStudy(stval) for study, stval in pval.items() }
+                    for patient, pval in image_loader.items()
+        }
+
+    @staticmethod
+    def Failed(plan: dict) -> list:
+        '''
+        [(patient, study)] of the failed studies of a plan
+        '''
+        return [    (patient, study)
+                    for patient, studies in plan.items()
+                    for study, result in studies.items() if result['status'] == 'fail'
+        ]
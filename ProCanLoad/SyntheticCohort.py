@@ -0,0 +1,516 @@
+import os
+import struct
+from pathlib import Path
+import numpy as np
+import pandas as pd
+import pydicom
+from pydicom.dataset import Dataset, FileMetaDataset
+from pydicom.sequence import Sequence
+from pydicom.uid import generate_uid, ExplicitVRLittleEndian, PYDICOM_IMPLEMENTATION_UID
+
+try:
+    from pydicom.pixels import pack_bits
+except ImportError: # pydicom < 3
+    from pydicom.pixel_data_handlers.numpy_handler import pack_bits
+
+
+MR_IMAGE_STORAGE = '1.2.840.10008.5.1.4.1.1.4'
+ENHANCED_MR_IMAGE_STORAGE = '1.2.840.10008.5.1.4.1.1.4.1'
+SEGMENTATION_STORAGE = '1.2.840.10008.5.1.4.1.1.66.4'
+
+
+class SyntheticCohort:
+    '''
+    Writes a synthetic cohort following the {image directory}/patient_id/study_uid/series_uid tree,
+    together with the matching ecrfs-series.parquet and segments.parquet.
+    Used for measuring the throughput of the loader, the sample DICOM_images has only six patients.
+    With enhanced=True every image series is one Enhanced MR file (all the frames, public b-value tag).
+    '''
+
+    def __init__(self,  output_directory: Path = 'synthetic',
+                        n_patients: int = 10,
+                        n_studies: int = 1,
+                        series_types: list = ('T2', 'ADC', 'DWI'),
+                        n_slices: int = 20,
+                        t2_matrix: int = 128,
+                        dwi_matrix: int = 64,
+                        bvalues: list = (0, 800, 1400),
+                        bvalue_encodings: list = ('public', 'siemens', 'ge_philips_multivalue', 'ge_philips_string', 'ge_philips_double', 'missing'),
+                        duplicate_slices: int = 0,
+                        enhanced: bool = False,
+                        labels: list = ('TZ+CZ', 'PZ', 'Lesion 1'),
+                        seed: int = 0
+    ) -> None:
+
+        self.output_directory = str(output_directory)
+        self.images_directory_path = os.path.join(self.output_directory, 'DICOM_images')
+        self.n_patients = n_patients
+        self.n_studies = n_studies
+        self.series_types = list(series_types)
+        self.n_slices = n_slices
+        self.t2_matrix = t2_matrix
+        self.dwi_matrix = dwi_matrix
+        self.bvalues = list(bvalues)
+        self.bvalue_encodings = list(bvalue_encodings)
+        self.duplicate_slices = duplicate_slices
+        self.enhanced = enhanced
+        self.labels = list(labels)
+        self.seed = seed
+
+        self.fov = 200.0 # mm, same for every series
+        self.slice_thickness = 3.0
+
+        self.rng = np.random.default_rng(seed)
+
+    @staticmethod
+    def GetManufacturers() -> dict:
+        # Manufacturer written for each b-value encoding
+        manufacturers = {   'public':                   'SIEMENS',
+                            'siemens':                  'SIEMENS',
+                            'ge_philips_multivalue':    'GE MEDICAL SYSTEMS',
+                            'ge_philips_string':        'Philips Medical Systems',
+                            'ge_philips_double':        'Philips Medical Systems',
+                            'missing':                  'Philips Medical Systems'
+        }
+
+        return manufacturers
+
+    def __Uid(self, *entropy) -> str:
+
+        return generate_uid(entropy_srcs=[str(self.seed)] + [str(e) for e in entropy])
+
+    @staticmethod
+    def __Save(ds: Dataset, path: Path) -> None:
+
+        if int(pydicom.__version__.split('.')[0]) >= 3:
+            ds.save_as(path, enforce_file_format=True)
+
+        else:
+            ds.is_little_endian = True
+            ds.is_implicit_VR = False
+            ds.save_as(path, write_like_original=False)
+
+    def __NewDataset(self, sop_class: str, sop_uid: str, patient: str, study: str, series: str, modality: str) -> Dataset:
+
+        file_meta = FileMetaDataset()
+        file_meta.MediaStorageSOPClassUID = sop_class
+        file_meta.MediaStorageSOPInstanceUID = sop_uid
+        file_meta.TransferSyntaxUID = ExplicitVRLittleEndian
+        file_meta.ImplementationClassUID = PYDICOM_IMPLEMENTATION_UID
+
+        ds = Dataset()
+        ds.file_meta = file_meta
+        ds.SOPClassUID = sop_class
+        ds.SOPInstanceUID = sop_uid
+        ds.PatientID = patient
+        ds.StudyInstanceUID = study
+        ds.SeriesInstanceUID = series
+        ds.Modality = modality
+
+        return ds
+
+    def __Anatomy(self, matrix: int) -> dict:
+        '''
+        Ellipsoid masks of the gland zones on a grid of n_slices x matrix x matrix
+        '''
+
+        z, y, x = np.meshgrid(  np.linspace(-1, 1, self.n_slices),
+                                np.linspace(-1, 1, matrix),
+                                np.linspace(-1, 1, matrix),
+                                indexing = 'ij'
+        )
+
+        gland = (x / 0.25) ** 2 + (y / 0.2) ** 2 + (z / 0.6) ** 2 <= 1
+        tz = (x / 0.15) ** 2 + ((y + 0.05) / 0.1) ** 2 + (z / 0.45) ** 2 <= 1
+
+        anatomy = {     'body': (x / 0.8) ** 2 + (y / 0.6) ** 2 <= 1,
+                        'TZ+CZ': tz,
+                        'PZ': gland & ~tz,
+                        'SV': ((np.abs(x) - 0.12) / 0.08) ** 2 + ((y + 0.25) / 0.05) ** 2 + ((z - 0.7) / 0.2) ** 2 <= 1,
+                        'Lesion 1': ((x - 0.1) / 0.05) ** 2 + ((y - 0.1) / 0.05) ** 2 + (z / 0.15) ** 2 <= 1,
+                        'Lesion 2': ((x + 0.1) / 0.04) ** 2 + ((y - 0.08) / 0.04) ** 2 + ((z - 0.2) / 0.1) ** 2 <= 1
+        }
+
+        return anatomy
+
+    def __Positions(self, matrix: int) -> tuple:
+
+        spacing = self.fov / matrix
+        first = np.array( [-self.fov / 2, -self.fov / 2, -self.n_slices * self.slice_thickness / 2] )
+        positions = [ first + [0, 0, k * self.slice_thickness] for k in range(self.n_slices) ]
+
+        return positions, spacing
+
+    def __EncodeBValue(self, ds: Dataset, bvalue: int, encoding: str) -> None:
+
+        if encoding == 'public':
+            ds.add_new( (0x0018, 0x9087), 'FD', float(bvalue) )
+
+        elif encoding == 'siemens':
+            ds.add_new( (0x0019, 0x0010), 'LO', 'SIEMENS MR HEADER' )
+            ds.add_new( (0x0019, 0x100c), 'IS', str(bvalue) )
+
+        elif encoding == 'ge_philips_multivalue':
+            # [(10^9+)bvalue,8,0,0] MultiValue
+            ds.add_new( (0x0043, 0x0010), 'LO', 'GEMS_PARM_01' )
+            ds.add_new( (0x0043, 0x1039), 'IS', [str(1000000000 + bvalue), '8', '0', '0'] )
+
+        elif encoding == 'ge_philips_string':
+            # Packed bytes (10^9+)bvalue\8\0\0
+            ds.add_new( (0x0043, 0x0010), 'LO', 'GEMS_PARM_01' )
+            ds.add_new( (0x0043, 0x1039), 'OB', f'{1000000000 + bvalue}\\8\\0\\0'.encode() )
+
+        elif encoding == 'ge_philips_double':
+            # Packed bytes, little endian double
+            ds.add_new( (0x0043, 0x0010), 'LO', 'GEMS_PARM_01' )
+            ds.add_new( (0x0043, 0x1039), 'OB', struct.pack('<d', float(bvalue)) )
+
+        elif encoding != 'missing':
+            raise ValueError(f'Unknown b-value encoding {encoding}')
+
+    def __WriteSlices(self, volumes: dict, patient: str, study: str, series: str, series_description: str,
+                      manufacturer: str, matrix: int, encoding: str = None, rescale_type: str = None) -> list:
+        '''
+        Write every volume of the series as one file per slice, volumes key is the b-value (None if not DWI).
+        File names are shuffled, as in the real data file order does not follow the slice order.
+        Returns the SOP Instance UIDs of the first volume, in slice order.
+        '''
+
+        if self.enhanced:
+            return self.__WriteEnhanced(volumes, patient, study, series, series_description, manufacturer, matrix, rescale_type)
+
+        series_path = os.path.join(self.images_directory_path, patient, study, series)
+        os.makedirs(series_path, exist_ok=True)
+
+        positions, spacing = self.__Positions(matrix)
+
+        n_files = len(volumes) * ( self.n_slices + min(self.duplicate_slices, self.n_slices) )
+        file_order = iter( self.rng.permutation(n_files) + 1 )
+
+        sop_uids = []
+        instance = 0
+
+        for acquisition, (bvalue, volume) in enumerate(volumes.items()):
+
+            for k in range(self.n_slices):
+
+                copies = 2 if k < self.duplicate_slices else 1
+
+                for copy in range(copies):
+
+                    instance += 1
+                    sop_uid = self.__Uid(series, bvalue, k, copy)
+
+                    ds = self.__NewDataset(MR_IMAGE_STORAGE, sop_uid, patient, study, series, 'MR')
+                    ds.Manufacturer = manufacturer
+                    ds.SeriesDescription = series_description
+                    ds.InstanceNumber = instance
+                    ds.AcquisitionNumber = acquisition + 1
+                    ds.ImagePositionPatient = [f'{p:.6f}' for p in positions[k]]
+                    ds.ImageOrientationPatient = [1, 0, 0, 0, 1, 0]
+                    ds.PixelSpacing = [f'{spacing:.6f}', f'{spacing:.6f}']
+                    ds.SliceThickness = self.slice_thickness
+                    ds.SpacingBetweenSlices = self.slice_thickness
+                    ds.SliceLocation = f'{positions[k][2]:.6f}'
+                    ds.Rows = matrix
+                    ds.Columns = matrix
+                    ds.SamplesPerPixel = 1
+                    ds.PhotometricInterpretation = 'MONOCHROME2'
+                    ds.BitsAllocated = 16
+                    ds.BitsStored = 12
+                    ds.HighBit = 11
+                    ds.PixelRepresentation = 0
+                    ds.PixelData = volume[k].astype(np.uint16).tobytes()
+
+                    if rescale_type:
+                        ds.RescaleType = rescale_type
+
+                    if bvalue is not None:
+                        self.__EncodeBValue(ds, bvalue, encoding)
+
+                    self.__Save(ds, os.path.join(series_path, f'image-{next(file_order):03d}.dcm'))
+
+                    if acquisition == 0 and copy == 0:
+                        sop_uids.append(sop_uid)
+
+        return sop_uids
+
+    def __WriteEnhanced(self, volumes: dict, patient: str, study: str, series: str, series_description: str,
+                        manufacturer: str, matrix: int, rescale_type: str = None) -> list:
+        '''
+        Write every volume of the series as the frames of one Enhanced MR file, in shuffled order.
+        The b-value is in the MR Diffusion Sequence of each frame, duplicate_slices is not used.
+        Returns (SOP Instance UID, frame number) of the first volume, in slice order.
+        '''
+
+        series_path = os.path.join(self.images_directory_path, patient, study, series)
+        os.makedirs(series_path, exist_ok=True)
+
+        positions, spacing = self.__Positions(matrix)
+        sop_uid = self.__Uid(series, 'enhanced')
+
+        ds = self.__NewDataset(ENHANCED_MR_IMAGE_STORAGE, sop_uid, patient, study, series, 'MR')
+        ds.Manufacturer = manufacturer
+        ds.SeriesDescription = series_description
+        ds.InstanceNumber = 1
+        ds.Rows = matrix
+        ds.Columns = matrix
+        ds.SamplesPerPixel = 1
+        ds.PhotometricInterpretation = 'MONOCHROME2'
+        ds.BitsAllocated = 16
+        ds.BitsStored = 12
+        ds.HighBit = 11
+        ds.PixelRepresentation = 0
+
+        orientation = Dataset()
+        orientation.ImageOrientationPatient = [1, 0, 0, 0, 1, 0]
+        measures = Dataset()
+        measures.PixelSpacing = [f'{spacing:.6f}', f'{spacing:.6f}']
+        measures.SliceThickness = self.slice_thickness
+        measures.SpacingBetweenSlices = self.slice_thickness
+        transformation = Dataset()
+        transformation.RescaleIntercept = 0
+        transformation.RescaleSlope = 1
+        transformation.RescaleType = rescale_type if rescale_type else 'US'
+
+        shared = Dataset()
+        shared.PlaneOrientationSequence = Sequence([orientation])
+        shared.PixelMeasuresSequence = Sequence([measures])
+        shared.PixelValueTransformationSequence = Sequence([transformation])
+        ds.SharedFunctionalGroupsSequence = Sequence([shared])
+
+        slices = [ (acquisition, bvalue, volume, k) for acquisition, (bvalue, volume) in enumerate(volumes.items()) for k in range(self.n_slices) ]
+        frame_order = self.rng.permutation(len(slices))
+
+        frames = []
+        per_frame = []
+        sop_uids = {}
+
+        for number, index in enumerate(frame_order, start=1):
+
+            acquisition, bvalue, volume, k = slices[index]
+
+            frames.append( volume[k].astype(np.uint16) )
+
+            position = Dataset()
+            position.ImagePositionPatient = [f'{p:.6f}' for p in positions[k]]
+
+            content = Dataset()
+            content.TemporalPositionIndex = acquisition + 1
+            content.InStackPositionNumber = k + 1
+
+            frame = Dataset()
+            frame.PlanePositionSequence = Sequence([position])
+            frame.FrameContentSequence = Sequence([content])
+
+            if bvalue is not None:
+
+                diffusion = Dataset()
+                diffusion.DiffusionBValue = float(bvalue)
+                diffusion.DiffusionDirectionality = 'ISOTROPIC' if bvalue else 'NONE'
+                frame.MRDiffusionSequence = Sequence([diffusion])
+
+            per_frame.append(frame)
+
+            if acquisition == 0:
+                sop_uids[k] = (sop_uid, number)
+
+        ds.PerFrameFunctionalGroupsSequence = Sequence(per_frame)
+        ds.NumberOfFrames = len(frames)
+        ds.PixelData = np.array(frames).tobytes()
+
+        self.__Save(ds, os.path.join(series_path, 'image-001.dcm'))
+
+        return [ sop_uids[k] for k in range(self.n_slices) ]
+
+    def __WriteSegmentation(self, anatomy: dict, patient: str, study: str, seg_series: str, source_series: str, sop_uids: list) -> None:
+        '''
+        One multi-frame binary SEG, one frame for each label and referenced T2 slice where the label is present
+        '''
+
+        series_path = os.path.join(self.images_directory_path, patient, study, seg_series)
+        os.makedirs(series_path, exist_ok=True)
+
+        positions, spacing = self.__Positions(self.t2_matrix)
+
+        ds = self.__NewDataset(SEGMENTATION_STORAGE, self.__Uid(seg_series), patient, study, seg_series, 'SEG')
+        ds.SeriesDescription = 'Synthetic_Lesions_Final'
+        ds.SegmentationType = 'BINARY'
+        ds.Rows = self.t2_matrix
+        ds.Columns = self.t2_matrix
+        ds.SamplesPerPixel = 1
+        ds.PhotometricInterpretation = 'MONOCHROME2'
+        ds.BitsAllocated = 1
+        ds.BitsStored = 1
+        ds.HighBit = 0
+        ds.PixelRepresentation = 0
+
+        segments = []
+        for number, label in enumerate(self.labels, start=1):
+
+            segment = Dataset()
+            segment.SegmentNumber = number
+            segment.SegmentLabel = label
+            segment.SegmentAlgorithmType = 'MANUAL'
+            segments.append(segment)
+
+        ds.SegmentSequence = Sequence(segments)
+
+        shared = Dataset()
+        orientation = Dataset()
+        orientation.ImageOrientationPatient = [1, 0, 0, 0, 1, 0]
+        measures = Dataset()
+        measures.PixelSpacing = [f'{spacing:.6f}', f'{spacing:.6f}']
+        measures.SliceThickness = self.slice_thickness
+        shared.PlaneOrientationSequence = Sequence([orientation])
+        shared.PixelMeasuresSequence = Sequence([measures])
+        ds.SharedFunctionalGroupsSequence = Sequence([shared])
+
+        frames = []
+        per_frame = []
+        for number, label in enumerate(self.labels, start=1):
+
+            for k in range(self.n_slices):
+
+                if not anatomy[label][k].any():
+                    continue
+
+                frames.append(anatomy[label][k])
+
+                source = Dataset()
+                source.ReferencedSOPClassUID = MR_IMAGE_STORAGE
+                if isinstance(sop_uids[k], tuple):
+                    # Frame of an Enhanced MR source
+                    source.ReferencedSOPInstanceUID, source.ReferencedFrameNumber = sop_uids[k]
+
+                else:
+                    source.ReferencedSOPInstanceUID = sop_uids[k]
+                derivation = Dataset()
+                derivation.SourceImageSequence = Sequence([source])
+
+                position = Dataset()
+                position.ImagePositionPatient = [f'{p:.6f}' for p in positions[k]]
+
+                identification = Dataset()
+                identification.ReferencedSegmentNumber = number
+
+                frame = Dataset()
+                frame.DerivationImageSequence = Sequence([derivation])
+                frame.PlanePositionSequence = Sequence([position])
+                frame.SegmentIdentificationSequence = Sequence([identification])
+                per_frame.append(frame)
+
+        ds.PerFrameFunctionalGroupsSequence = Sequence(per_frame)
+        ds.NumberOfFrames = len(frames)
+        ds.ReferencedSeriesSequence = Sequence([Dataset()])
+        ds.ReferencedSeriesSequence[0].SeriesInstanceUID = source_series
+
+        packed = pack_bits( np.array(frames, dtype=np.uint8) )
+        ds.PixelData = packed + b'\x00' if len(packed) % 2 else packed
+
+        self.__Save(ds, os.path.join(series_path, 'image-001.dcm'))
+
+    def Generate(self) -> dict:
+        '''
+        Write the cohort, returns the paths of the image directory and the parquet files (params.yaml keys)
+        '''
+
+        os.makedirs(self.images_directory_path, exist_ok=True)
+
+        series_rows = []
+        segment_rows = []
+
+        for p in range(self.n_patients):
+
+            patient = f'PCa-synthetic-{self.seed}-{p:05d}'
+            encoding = self.bvalue_encodings[p % len(self.bvalue_encodings)]
+            manufacturer = self.GetManufacturers()[encoding]
+
+            for s in range(self.n_studies):
+
+                study = self.__Uid(patient, s)
+                base_row = {    'provided_by': 'SYNTHETIC',
+                                'patient_id': patient,
+                                'study_uid': study,
+                                'manufacturer': manufacturer,
+                                'manufacturer_model_name': 'Synthetic',
+                                'use_case_form': 'UC1+2'
+                }
+
+                t2_anatomy = self.__Anatomy(self.t2_matrix)
+                dwi_anatomy = self.__Anatomy(self.dwi_matrix)
+
+                for sequence in self.series_types:
+
+                    series = self.__Uid(patient, s, sequence)
+
+                    if sequence == 'T2':
+
+                        anatomy = t2_anatomy
+                        volume = 50 + 250 * anatomy['body'] + 300 * (anatomy['TZ+CZ'] | anatomy['PZ']) - 150 * anatomy['Lesion 1']
+                        volume = volume + self.rng.normal(0, 10, volume.shape)
+
+                        sop_uids = self.__WriteSlices( {None: np.clip(volume, 0, 4095)}, patient, study, series,
+                                                        't2_tse_tra', manufacturer, self.t2_matrix)
+
+                        series_rows.append( dict(base_row, series_uid=series, user_series_type='T2AX',
+                                            catboost_series_type_heuristics='T2', series_description='t2_tse_tra', diffusion_bvalue='0') )
+
+                        if self.labels:
+
+                            seg_series = self.__Uid(patient, s, 'SEG')
+                            self.__WriteSegmentation(anatomy, patient, study, seg_series, series, sop_uids)
+
+                            segment_rows.append( {  'study_uid': study,
+                                                    'source_series_uid': series,
+                                                    'derived_series_uid': seg_series,
+                                                    'series_description': 't2_tse_tra_Lesions_Final',
+                                                    'labels': ','.join(self.labels),
+                                                    'method': 'MANUAL'
+                            } )
+
+                    elif sequence == 'ADC':
+
+                        anatomy = dwi_anatomy
+                        volume = 2500 * anatomy['body'] - 900 * (anatomy['TZ+CZ'] | anatomy['PZ']) - 800 * anatomy['Lesion 1']
+                        volume = volume + self.rng.normal(0, 20, volume.shape)
+
+                        self.__WriteSlices( {None: np.clip(volume, 0, 4095)}, patient, study, series,
+                                            'ep2d_diff_tra_ADC', manufacturer, self.dwi_matrix, rescale_type='10^-6 mm^2/s')
+
+                        series_rows.append( dict(base_row, series_uid=series, user_series_type='ADC',
+                                            catboost_series_type_heuristics='ADC', series_description='ep2d_diff_tra_ADC', diffusion_bvalue='-') )
+
+                    elif sequence == 'DWI':
+
+                        anatomy = dwi_anatomy
+                        adc = 2.5e-3 * anatomy['body'] - 0.9e-3 * (anatomy['TZ+CZ'] | anatomy['PZ']) - 0.8e-3 * anatomy['Lesion 1']
+
+                        volumes = {}
+                        for bvalue in self.bvalues:
+                            volume = 1500 * anatomy['body'] * np.exp(-bvalue * adc)
+                            volumes[bvalue] = np.clip( volume + self.rng.normal(0, 10, volume.shape), 0, 4095 )
+
+                        self.__WriteSlices( volumes, patient, study, series, 'ep2d_diff_tra', manufacturer, self.dwi_matrix, encoding=encoding)
+
+                        series_rows.append( dict(base_row, series_uid=series, user_series_type='DWI',
+                                            catboost_series_type_heuristics='DWI', series_description='ep2d_diff_tra',
+                                            diffusion_bvalue=','.join(map(str, self.bvalues))) )
+
+                    else:
+                        raise ValueError(f'Unknown series type {sequence}, use T2, ADC or DWI')
+
+        series_df = os.path.join(self.output_directory, 'ecrfs-series.parquet')
+        segments_df = os.path.join(self.output_directory, 'segments.parquet')
+
+        pd.DataFrame(series_rows).to_parquet(series_df)
+
+        if segment_rows:
+            pd.DataFrame(segment_rows).to_parquet(segments_df)
+        else:
+            segments_df = ''
+
+        return {    'series_df': series_df,
+                    'segments_df': segments_df,
+                    'images_dir': self.images_directory_path
+        }
@@ -0,0 +1,210 @@
+import os
+from pathlib import Path
+import numpy as np
+import SimpleITK as sitk
+
+
+class VolumeStore:
+    '''
+    Chunked, compressed store of the converted volumes, in Zarr directory format or HDF5, instead of one .nii.gz per volume.
+    Every volume is an array (z, y, x as sitk.GetArrayFromImage) under its key, e.g. patient/study/T2, with the geometry
+    (origin, spacing, direction of the LPS image) as attributes. A patch read decompresses only the chunks it overlaps.
+
+    store = VolumeStore('nii_files.zarr')                           # format from the suffix: .zarr, .h5 or .hdf5
+    store.Write(f'{patient}/{study}/T2', image)
+    patch = store.ReadPatch(f'{patient}/{study}/T2', start=(z, y, x), size=(d, h, w))
+    image = store.ReadImage(f'{patient}/{study}/T2', start, size)    # sitk.Image of the patch, with its geometry
+
+    zarr and h5py are optional dependencies, only the one of the store format is imported.
+    '''
+
+    formats = {'.zarr': 'zarr', '.h5': 'hdf5', '.hdf5': 'hdf5'}
+    modules = {'zarr': 'zarr', 'hdf5': 'h5py'}
+
+    def __init__(self, path: Path, mode: str = 'a', chunks: tuple = (8, 64, 64), compression_level: int = 4) -> None:
+        '''
+        mode: 'r' read only, 'a' read and write (created if missing)
+        chunks: chunk shape (z, y, x), clipped to the shape of each volume
+        '''
+
+        self.path = str(path)
+        self.format = VolumeStore.Format(self.path)
+        self.chunks = tuple(chunks)
+        self.compression_level = compression_level
+
+        self.module = VolumeStore.__Import(self.format)
+
+        if os.path.dirname(self.path) and mode != 'r':
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+
+        if self.format == 'zarr':
+            self.root = self.module.open_group(self.path, mode=mode)
+
+        else:
+            self.root = self.module.File(self.path, mode)
+
+    @staticmethod
+    def Format(path: Path) -> str:
+
+        suffix = os.path.splitext(str(path).rstrip('/'))[1].lower()
+
+        if suffix not in VolumeStore.formats:
+            raise ValueError(f'Unknown store format {suffix!r} of {path}, use one of {list(VolumeStore.formats)}')
+
+        return VolumeStore.formats[suffix]
+
+    @staticmethod
+    def __Import(store_format: str):
+        '''
+        The module of the format, with the package to install if it is missing
+        '''
+        module = VolumeStore.modules[store_format]
+
+        try:
+            return __import__(module)
+
+        except ImportError as e:
+            raise ImportError(f'The {store_format} store needs the optional dependency {module}, install it with: pip install {module}') from e
+
+    @staticmethod
+    def Split(location: str) -> tuple:
+        '''
+        nifti_files.json location of a stored volume -> (store path, key)
+        e.g. nii_files.zarr/patient/study/T2 -> (nii_files.zarr, patient/study/T2)
+        '''
+        parts = str(location).replace('\\', '/').split('/')
+
+        for index, part in enumerate(parts):
+
+            if os.path.splitext(part)[1].lower() in VolumeStore.formats:
+                return '/'.join(parts[:index + 1]), '/'.join(parts[index + 1:])
+
+        raise ValueError(f'{location} is not inside a {list(VolumeStore.formats)} store')
+
+    def Close(self) -> None:
+
+        if self.format == 'hdf5':
+            self.root.close()
+
+    def __enter__(self):
+
+        return self
+
+    def __exit__(self, *exc) -> None:
+
+        self.Close()
+
+    def __Group(self, key: str):
+        '''
+        Group of the key (created if missing) and the name of the array inside it
+        '''
+        *groups, name = key.strip('/').split('/')
+
+        group = self.root
+        for level in groups:
+            group = group.require_group(level)
+
+        return group, name
+
+    def Write(self, key: str, image: sitk.Image) -> None:
+        '''
+        Store the image under key, a volume already stored there is replaced
+        '''
+        volume = sitk.GetArrayViewFromImage(image)
+        chunks = tuple( min(chunk, size) for chunk, size in zip(self.chunks, volume.shape) )
+
+        group, name = self.__Group(key)
+
+        if self.format == 'zarr':
+
+            if hasattr(group, 'create_array'):
+                array = group.create_array(name, shape=volume.shape, chunks=chunks, dtype=volume.dtype, overwrite=True)
+
+            else: # zarr < 3
+                array = group.create_dataset(name, shape=volume.shape, chunks=chunks, dtype=volume.dtype, overwrite=True)
+
+            array[...] = volume
+
+        else:
+
+            if name in group:
+                del group[name]
+
+            array = group.create_dataset(name, data=volume, chunks=chunks, compression='gzip',
+                                         compression_opts=self.compression_level, shuffle=True)
+
+        array.attrs.update( {   'origin': list(image.GetOrigin()),
+                                'spacing': list(image.GetSpacing()),
+                                'direction': list(image.GetDirection())
+        } )
+
+    def Keys(self) -> list:
+        '''
+        Keys of the stored volumes
+        '''
+        keys = []
+
+        def Visit(group, prefix: str) -> None:
+
+            for name in sorted(group.keys()):
+
+                child = group[name]
+
+                if hasattr(child, 'shape'):
+                    keys.append(prefix + name)
+                else:
+                    Visit(child, prefix + name + '/')
+
+        Visit(self.root, '')
+
+        return keys
+
+    def __Array(self, key: str):
+
+        return self.root[key.strip('/')]
+
+    def Geometry(self, key: str) -> dict:
+        '''
+        shape (z, y, x), dtype, chunks and the origin, spacing, direction of the volume
+        '''
+        array = self.__Array(key)
+        geometry = { attribute: list(array.attrs[attribute]) for attribute in ('origin', 'spacing', 'direction') }
+
+        geometry.update( {  'shape': tuple(array.shape),
+                            'dtype': str(array.dtype),
+                            'chunks': tuple(array.chunks)
+        } )
+
+        return geometry
+
+    def ReadPatch(self, key: str, start: tuple = None, size: tuple = None) -> np.ndarray:
+        '''
+        Patch (z, y, x) from start, clipped to the volume. Only the chunks it overlaps are read and decompressed.
+        Without start and size the whole volume is read.
+        '''
+        array = self.__Array(key)
+
+        start = tuple(start) if start is not None else (0,) * len(array.shape)
+        size = tuple(size) if size is not None else tuple(array.shape)
+
+        return np.asarray( array[ tuple( slice(first, first + length) for first, length in zip(start, size) ) ] )
+
+    def ReadImage(self, key: str, start: tuple = None, size: tuple = None) -> sitk.Image:
+        '''
+        ReadPatch as sitk.Image, its origin is the physical point of the first voxel of the patch
+        '''
+        geometry = self.Geometry(key)
+        patch = self.ReadPatch(key, start, size)
+
+        image = sitk.GetImageFromArray(patch)
+        image.SetSpacing(geometry['spacing'])
+        image.SetDirection(geometry['direction'])
+
+        # numpy is z,y,x - sitk index is x,y,z
+        index = np.array( start[::-1] if start is not None else (0, 0, 0), dtype=np.float64 )
+        direction = np.array(geometry['direction']).reshape(3, 3)
+        origin = np.array(geometry['origin']) + direction @ (index * np.array(geometry['spacing']))
+
+        image.SetOrigin(origin.tolist())
+
+        return image
@@ -0,0 +1,269 @@
+import os
+import heapq
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from .utils import DataFrameUtils, JsonUtils
+from .file_utils import FileUtils
+from .SOPIndex import SOPIndex
+
+
+class WorkPlanner:
+    '''
+    Cost of every study for the header scan (ImageLoader.GetImageLoader) and the export (DICOM2NII.Execute), from the
+    parquet and the series directories (file counts and bytes) and the SOP Instance UID index of an earlier run (matrix sizes).
+    The patients are split across the workers largest first (LPT), the split is written as a shard plan for --shard.
+
+    planner = WorkPlanner('DICOM_images', 'data/ecrfs-series.parquet', 'data/segments.parquet', sop_index='sop_index.sqlite')
+    planner.Calibrate('metrics.json')           # optional, seconds per file/byte/voxel of an earlier run
+    plan = planner.Plan(workers=4)              # {'workers': [[patients]], 'seconds': [...], 'wall_seconds', 'peak_memory_bytes'}
+    planner.WritePlan(plan, 'shard_plan.json')  # ImageLoader(..., shard='i/4', shard_plan='shard_plan.json')
+
+    Cost model, per study:
+    scan seconds   = files x scan_seconds_per_file + SEG bytes x seg_seconds_per_byte (the SEG pixels are decoded in the scan)
+    export seconds = (image + mask voxels) x export_seconds_per_voxel
+    peak memory    = StudyPeakBytes, the model of DICOM2NII.EstimateStudyMemory: the volumes are released once written, the
+                     largest series (all its b-values, an upper bound for a DWI) x memory_bytes_per_voxel twice, plus the
+                     uint8 masks of the T2 (one at a time, every label with crop_to_gland)
+    '''
+
+    # Seconds per unit on a local disk, replaced by Calibrate
+    default_model = {   'scan_seconds_per_file':        2e-3,
+                        'seg_seconds_per_byte':         2e-8,
+                        'export_seconds_per_voxel':     5e-8,
+                        'memory_bytes_per_voxel':       4.0     # float32 after the rescale
+    }
+
+    scan_stages = ['header_parse', 'duplicate_check', 'dwi_grouping', 'seg_reference_read']
+    seg_stages = ['seg_decode', 'seg_write']
+    export_stages = ['load_volume', 'reorientation', 'write_nifti', 'write_store']
+
+    def __init__(self,  images_directory_path: Path,
+                        parquet_series: Path or 'pd.DataFrame',
+                        parquet_segmentations: Path or 'pd.DataFrame' = None,
+                        sop_index: Path or SOPIndex = 'sop_index.sqlite',
+                        io_workers: int = 8,
+                        crop_to_gland: bool = False
+    ) -> None:
+
+        self.images_directory_path = images_directory_path
+        self.parquet_series = parquet_series
+        self.parquet_segmentations = parquet_segmentations
+        self.io_workers = io_workers
+        self.crop_to_gland = crop_to_gland
+        self.model = dict(WorkPlanner.default_model)
+
+        # The index is only read, a missing file is not created
+        if isinstance(sop_index, (str, Path)):
+            sop_index = SOPIndex(sop_index) if os.path.isfile(sop_index) else None
+
+        self.sop_index = sop_index
+
+        self.series = self.__SeriesFeatures()
+
+    def __SeriesPath(self, patient: str, study: str, series: str) -> str:
+
+        return os.path.join(self.images_directory_path, patient, study, series).replace('\\','/')
+
+    @staticmethod
+    def __Bytes(files: list) -> int:
+
+        return sum( os.path.getsize(file) for file in files )
+
+    def __SeriesFeatures(self) -> dict:
+        '''
+        {series_uid: {'patient', 'study', 'seg', 'files', 'bytes', 'voxels', 'mask_voxels', 'labels', 'source'}}
+        mask_voxels of an image series are the voxels of the masks exported on it (labels of its SEG x its voxels)
+        '''
+        df = DataFrameUtils.Read(self.parquet_series, columns=['patient_id', 'study_uid', 'series_uid'])
+
+        series = {  uid: {'patient': patient, 'study': study, 'seg': False, 'labels': 0, 'source': None}
+                    for patient, study, uid in zip(df.patient_id, df.study_uid, df.series_uid)
+        }
+
+        if self.parquet_segmentations is not None:
+
+            df_seg = DataFrameUtils.Read(self.parquet_segmentations, columns=['source_series_uid', 'derived_series_uid', 'labels'])
+
+            for source, derived, labels in zip(df_seg.source_series_uid, df_seg.derived_series_uid, df_seg.labels):
+
+                if source in series:
+                    series[derived] = { 'patient': series[source]['patient'], 'study': series[source]['study'], 'seg': True,
+                                        'labels': len(str(labels).split(',')) if labels else 0, 'source': source }
+
+        paths = { uid: self.__SeriesPath(info['patient'], info['study'], uid) for uid, info in series.items() }
+        listings = FileUtils.ListSeriesDirectories(paths.values(), workers=self.io_workers)
+
+        # One stat per file, in a pool as the listing (network filesystems)
+        with ThreadPoolExecutor(max_workers=max(self.io_workers, 1)) as executor:
+            sizes = dict( zip( paths, executor.map(lambda uid: WorkPlanner.__Bytes(listings[paths[uid]] or []), paths) ) )
+
+        matrices = self.sop_index.Matrices( [ uid for uid, info in series.items() if not info['seg'] ] ) if self.sop_index else {}
+
+        for uid, info in series.items():
+
+            info['files'] = len(listings[paths[uid]] or [])
+            info['bytes'] = sizes[uid]
+
+            # Matrix of the instances in the index, 16 bit pixels from the bytes otherwise.
+            # The larger of both: the index counts a multi-frame file once, compressed files are smaller than their pixels.
+            indexed = sum( rows * columns * count for (rows, columns), count in matrices.get(uid, {}).items() if rows and columns )
+            info['voxels'] = 0 if info['seg'] else max( indexed, info['bytes'] // 2 )
+            info['mask_voxels'] = 0
+
+        for info in series.values():
+
+            if info['seg']:
+                series[info['source']]['mask_voxels'] += info['labels'] * series[info['source']]['voxels']
+
+        return series
+
+    def Calibrate(self, metrics: Path or dict) -> dict:
+        '''
+        Seconds per file, SEG byte and voxel from the per series report of Metrics (--metrics-json) of an earlier run.
+        Only the series of this cohort with the stages recorded are used, the rest of the model is kept.
+        '''
+        report = JsonUtils.Load(metrics) if not isinstance(metrics, dict) else metrics
+        report = report.get('series', {})
+
+        def Fit(stages: list, feature: str, seg: bool or None) -> float or None:
+
+            seconds = units = 0
+
+            for uid, stage_metrics in report.items():
+
+                info = self.series.get(uid)
+
+                if info is None or seg is not None and info['seg'] != seg or not any( stage in stage_metrics for stage in stages ):
+                    continue
+
+                seconds += sum( stage_metrics[stage]['seconds'] for stage in stages if stage in stage_metrics )
+
+                # The masks of a SEG are written under the SEG series and counted with the voxels of its source series
+                units += info[feature] + ( info['mask_voxels'] if feature == 'voxels' else 0 )
+
+            return seconds / units if units else None
+
+        fitted = {  'scan_seconds_per_file':    Fit(WorkPlanner.scan_stages, 'files', False),
+                    'seg_seconds_per_byte':     Fit(WorkPlanner.seg_stages, 'bytes', True),
+                    'export_seconds_per_voxel': Fit(WorkPlanner.export_stages, 'voxels', None)
+        }
+
+        self.model.update( { name: value for name, value in fitted.items() if value } )
+
+        return self.model
+
+    @staticmethod
+    def StudyPeakBytes(volume_bytes: list, mask_bytes: int = 0, labels: int = 0, crop_to_gland: bool = False) -> int:
+        '''
+        Peak of the export of one study (DICOM2NII): the volumes are released once written, the largest one is held with
+        its copy (rescale, reorientation). The uint8 masks of mask_bytes are written one at a time, the labels are held
+        together when they are kept for the crop box.
+        '''
+        return 2 * max(volume_bytes, default=0) + mask_bytes * ( labels if crop_to_gland else min(labels, 1) )
+
+    def StudyCosts(self) -> dict:
+        '''
+        {(patient, study): {'scan_seconds', 'export_seconds', 'seconds', 'memory_bytes'}} in parquet order
+        '''
+        studies = {}
+
+        for uid, info in self.series.items():
+
+            study = studies.setdefault( (info['patient'], info['study']), { 'files': 0, 'seg_bytes': 0, 'voxels': 0, 'mask_voxels': 0,
+                                                                            'volumes': [], 'mask': 0, 'labels': 0 } )
+
+            if info['seg']:
+                study['seg_bytes'] += info['bytes']
+                study['labels'] += info['labels']
+                study['mask'] = max( study['mask'], self.series[info['source']]['voxels'] )
+
+            else:
+                study['files'] += info['files']
+                study['voxels'] += info['voxels']
+                study['mask_voxels'] += info['mask_voxels']
+                study['volumes'].append(info['voxels'])
+
+        costs = {}
+        for key, study in studies.items():
+
+            scan = study['files'] * self.model['scan_seconds_per_file'] + study['seg_bytes'] * self.model['seg_seconds_per_byte']
+            export = (study['voxels'] + study['mask_voxels']) * self.model['export_seconds_per_voxel']
+
+            costs[key] = {  'scan_seconds': scan,
+                            'export_seconds': export,
+                            'seconds': scan + export,
+                            'memory_bytes': int( WorkPlanner.StudyPeakBytes( [ voxels * self.model['memory_bytes_per_voxel'] for voxels in study['volumes'] ],
+                                                                             study['mask'], study['labels'], self.crop_to_gland ) )
+            }
+
+        return costs
+
+    @staticmethod
+    def Schedule(costs: dict, workers: int) -> list:
+        '''
+        Longest processing time first: the items are taken by decreasing cost, each one goes to the least loaded worker.
+        costs: {item: seconds}. Returns [[items] of every worker]
+        '''
+        loads = [ (0.0, worker) for worker in range(workers) ]
+        assigned = [ [] for _ in range(workers) ]
+
+        for item in sorted(costs, key=lambda item: (-costs[item], str(item))):
+
+            load, worker = heapq.heappop(loads)
+            assigned[worker].append(item)
+            heapq.heappush(loads, (load + costs[item], worker))
+
+        return assigned
+
+    def Plan(self, workers: int = 1) -> dict:
+        '''
+        Patients of every worker, largest first. A patient is not split, its studies are in one shard.
+        wall_seconds is the estimated time of the slowest worker, peak_memory_bytes the largest study of every worker
+        summed (the workers running on one machine).
+        '''
+        studies = self.StudyCosts()
+
+        patients = {}
+        for (patient, study), cost in studies.items():
+            patients.setdefault(patient, []).append(cost)
+
+        seconds = { patient: sum( cost['seconds'] for cost in costs ) for patient, costs in patients.items() }
+        memory = { patient: max( cost['memory_bytes'] for cost in costs ) for patient, costs in patients.items() }
+
+        assigned = WorkPlanner.Schedule(seconds, workers)
+
+        worker_seconds = [ sum( seconds[patient] for patient in group ) for group in assigned ]
+        worker_memory = [ max( [ memory[patient] for patient in group ], default=0 ) for group in assigned ]
+
+        return {    'workers': assigned,
+                    'seconds': worker_seconds,
+                    'memory_bytes': worker_memory,
+                    'wall_seconds': max(worker_seconds, default=0.0),
+                    'serial_seconds': sum(worker_seconds),
+                    'peak_memory_bytes': int( np.sum(worker_memory) ),
+                    'studies': len(studies),
+                    'model': dict(self.model)
+        }
+
+    @staticmethod
+    def WritePlan(plan: dict, path: Path = 'shard_plan.json') -> None:
+        '''
+        {patient: worker} for ShardUtils.InShard, patients missing from it fall back to the sha1 split
+        '''
+        JsonUtils.Write( {  'shards': len(plan['workers']),
+                            'patients': { patient: worker for worker, group in enumerate(plan['workers']) for patient in group }
+        }, path )
+
+    @staticmethod
+    def Summary(plan: dict) -> str:
+
+        lines = [ f"{plan['studies']} studies on {len(plan['workers'])} workers, largest first" ]
+
+        for worker, (group, seconds, memory) in enumerate(zip(plan['workers'], plan['seconds'], plan['memory_bytes'])):
+            lines.append(f'worker {worker}: {len(group):5d} patients  {seconds:10.1f} s  peak {memory / 2**20:8.1f} MiB')
+
+        lines.append(f"estimated wall time {plan['wall_seconds']:.1f} s (serial {plan['serial_seconds']:.1f} s), "
+                     f"peak memory {plan['peak_memory_bytes'] / 2**20:.1f} MiB")
+
+        return '\n'.join(lines)
@@ -1,6 +1,61 @@
-from .ImageLoader import ImageLoader, DICOM2NII
-from .IssueLogger import IssueLogger
-from .SegmentationLoader import SegmentationLoader
-from .sitk_utils import SitkUtils
-from .pydicom_utils import DCMUtils
-from .utils import DataFrameUtils, JsonUtils, GetDirectionDict
\ No newline at end of file
+import sys
+import importlib
+from types import ModuleType
+
+# Public name -> submodule. Imported on first access, so SimpleITK, pydicom, pandas and tqdm
+# are loaded only by the code paths that use them (e.g. not for main.py --help or reading a manifest).
+_exports = {    'ImageLoader':          '.ImageLoader',
+                'DICOM2NII':            '.ImageLoader',
+                'IssueLogger':          '.IssueLogger',
+                'Prefetcher':           '.Prefetcher',
+                'Manifest':             '.Manifest',
+                'SeriesRecord':         '.Manifest',
+                'SOPIndex':             '.SOPIndex',
+                'VolumeStore':          '.VolumeStore',
+                'SharedVolume':         '.SharedVolume',
+                'StudyValidator':       '.StudyValidator',
+                'WorkPlanner':          '.WorkPlanner',
+                'Metrics':              '.Metrics',
+                'SegmentationLoader':   '.SegmentationLoader',
+                'SitkUtils':            '.sitk_utils',
+                'NiftiUtils':           '.nifti_utils',
+                'FileUtils':            '.file_utils',
+                'DCMUtils':             '.pydicom_utils',
+                'DataFrameUtils':       '.utils',
+                'JsonUtils':            '.utils',
+                'GetDirectionDict':     '.utils',
+                'ShardUtils':           '.utils',
+                'StudyJsonWriter':      '.utils',
+                'SyntheticCohort':      '.SyntheticCohort'
+}
+
+__all__ = list(_exports)
+
+
+class _LazyPackage(ModuleType):
+
+    def __getattr__(self, name):
+
+        if name not in _exports:
+            raise AttributeError(f"module {self.__name__!r} has no attribute {name!r}")
+
+        value = getattr( importlib.import_module(_exports[name], self.__name__), name )
+        super().__setattr__(name, value)
+
+        return value
+
+    def __setattr__(self, name, value):
+
+        # Importing e.g. ProCanLoad.ImageLoader binds the submodule on the package,
+        # keep the class there instead, as the eager "from .ImageLoader import ImageLoader" did.
+        if name in _exports and isinstance(value, ModuleType) and value.__name__ == f'{self.__name__}.{name}':
+            value = getattr(value, name)
+
+        super().__setattr__(name, value)
+
+    def __dir__(self):
+
+        return sorted( set(super().__dir__()) | set(_exports) )
+
+
+sys.modules[__name__].__class__ = _LazyPackage
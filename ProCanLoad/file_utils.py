@@ -0,0 +1,44 @@
+import os
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+
+
+class FileUtils:
+
+    @staticmethod
+    def ListSeriesFiles(series_path: Path) -> list or None:
+        '''
+        Files inside a series directory, one os.scandir without opening any file. Hidden files and
+        subdirectories are skipped, paths are sorted by name so the order does not depend on the filesystem.
+        The geometric order is given later by the header extractor (ImageLoader.OrderFileSeries).
+        Returns None if the directory does not exist.
+        '''
+        try:
+            with os.scandir(series_path) as entries:
+
+                files = [   entry.path.replace('\\','/')
+                            for entry in entries
+                            if not entry.name.startswith('.') and entry.is_file()
+                ]
+
+        except (FileNotFoundError, NotADirectoryError):
+            return None
+
+        return sorted(files)
+
+    @staticmethod
+    def ListSeriesDirectories(series_paths: list, workers: int = 8) -> dict:
+        '''
+        Enumerate all the series directories in one pass. On network filesystems every scandir is a
+        round-trip, a thread pool keeps several of them in flight.
+        Returns {series_path: [files] or None if missing}
+        '''
+        series_paths = list(series_paths)
+
+        if workers <= 1 or len(series_paths) <= 1:
+            return { path: FileUtils.ListSeriesFiles(path) for path in series_paths }
+
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            listings = executor.map(FileUtils.ListSeriesFiles, series_paths)
+
+            return dict( zip(series_paths, listings) )
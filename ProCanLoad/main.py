@@ -1,24 +1,61 @@
 import os
 from pathlib import Path
-import yaml
-import importlib.util
 import argparse
 import warnings
 
  
 package_name = 'ProCanLoad'
- 
-if importlib.util.find_spec(package_name) is None:
-    os.system('pip install git+https://github.com/HarryKalantzopoulos/ProCanLoad.git')
 
-from ProCanLoad.ImageLoader import ImageLoader, DICOM2NII
+
+def ImportPackage():
+    '''
+    Imported only when the conversion runs, --help does not pay for SimpleITK, pydicom, pandas and tqdm.
+    The package is installed from github only if it is missing.
+    '''
+    try:
+        import ProCanLoad
+
+    except ModuleNotFoundError as e:
+
+        if e.name != package_name:
+            raise
+
+        os.system('pip install git+https://github.com/HarryKalantzopoulos/ProCanLoad.git')
+        import ProCanLoad
+
+    return ProCanLoad
 
 
 def dicom2nii(series: Path = '', 
               segmentations:Path = '', 
-              images_directory_path:Path = '' 
+              images_directory_path:Path = '',
+              crop_to_gland: bool = False,
+              metrics_json: Path = '',
+              metrics_prom: Path = '',
+              shard: str = '',
+              shard_plan: Path = '',
+              row_filters: dict = None,
+              prefetch_series: int = 0,
+              prefetch_mb: int = 256,
+              decode_workers: int = 1,
+              output_format: str = 'nifti',
+              store_per_study: bool = False,
+              validate: bool = False,
+              study_workers: int = 1,
+              max_memory_mb: int = 0,
+              seg_workers: int = 1,
+              nifti_dtype: str = 'auto',
+              verify_nifti: bool = False,
+              fused: bool = False,
+              fused_queue: int = 4,
+              stream_slices: int = 0
             ):
     
+    import yaml
+
+    ProCanLoad = ImportPackage()
+    ImageLoader, DICOM2NII, Metrics = ProCanLoad.ImageLoader, ProCanLoad.DICOM2NII, ProCanLoad.Metrics
+
     inputs = 'params.yaml'
     
     if os.path.isfile(inputs):
@@ -55,23 +92,113 @@ def dicom2nii(series: Path = '',
             segmentations = ''
             warnings.warn("Segmentation FileNotFound, proceed without extracting seg images!")
 
+    if metrics_json or metrics_prom:
+        Metrics.Enable()
+
+    shard = shard or None
+    shard_plan = shard_plan or None
+    row_filters = row_filters or {}
+
+    # Read-ahead for network storage, off by default
+    prefetcher = ProCanLoad.Prefetcher(window_series=prefetch_series, window_bytes=prefetch_mb * 2**20) if prefetch_series else None
+
     if segmentations:
         loader = ImageLoader(
                             images_directory_path = images_directory_path,
                             parquet_series = series,
-                            parquet_segmentations = segmentations
+                            parquet_segmentations = segmentations,
+                            seg_workers = seg_workers,
+                            shard = shard,
+                            shard_plan = shard_plan,
+                            prefetcher = prefetcher,
+                            **row_filters
                             )
     else:
         loader = ImageLoader(
                             images_directory_path= images_directory_path,
-                            parquet_series=series
+                            parquet_series=series,
+                            shard = shard,
+                            shard_plan = shard_plan,
+                            prefetcher = prefetcher,
+                            **row_filters
                             )
 
-    loader.GetImageLoader()
+    # Fused: the studies are converted while the next ones are scanned, image_loader.json is written along the way
+    if not fused:
+        loader.GetImageLoader()
 
-    extractor = DICOM2NII(image_loader='image_loader.json')
+    extractor = DICOM2NII(image_loader={} if fused else loader.image_loader_path, crop_to_gland=crop_to_gland, shard=shard, prefetcher=prefetcher,
+                          decode_workers=decode_workers, output_format=output_format, store_per_study=store_per_study,
+                          validate=validate, study_workers=study_workers, max_memory=max_memory_mb * 2**20 or None,
+                          nifti_dtype=nifti_dtype, verify_nifti=verify_nifti, stream_slices=stream_slices)
     
-    extractor.Execute()
+    if fused:
+        extractor.ExecuteFused(loader, queue_size=fused_queue)
+
+    else:
+        extractor.Execute()
+
+    if prefetcher:
+        stats = prefetcher.Stats()
+        print(f"Prefetched {stats['files']} files ({stats['bytes'] / 2**20:.1f} MiB), "
+              f"hid {stats['hidden_seconds']:.2f} s of {stats['fetch_wall_seconds']:.2f} s read time (wall-clock)")
+
+    if extractor.study_memory:
+        study, memory = max( extractor.study_memory.items(), key=lambda item: item[1]['peak_bytes'] )
+        print(f"Largest study peak {memory['peak_bytes'] / 2**20:.1f} MiB ({study}), every study in the metrics (study_memory)")
+
+    if metrics_json:
+        Metrics.WriteJson(metrics_json)
+
+    if metrics_prom:
+        Metrics.WritePrometheus(metrics_prom)
+
+
+def plan_work(workers: int, series: Path = '', segmentations: Path = '', images_directory_path: Path = '',
+              calibrate: Path = '', output: Path = 'shard_plan.json', dry_run: bool = False, crop_to_gland: bool = False):
+    '''
+    Estimate the cost of every study and split the patients largest first across the workers, written to output for
+    --shard-plan. With dry_run only the estimated wall time and peak memory are printed.
+    '''
+    import yaml
+
+    ProCanLoad = ImportPackage()
+
+    inputs = yaml.safe_load( open('params.yaml') ) if os.path.isfile('params.yaml') else {}
+
+    series = series if os.path.isfile(series) else inputs.get('series_df', '')
+    segmentations = segmentations if os.path.isfile(segmentations) else inputs.get('segments_df', '')
+    images_directory_path = images_directory_path if os.path.isdir(images_directory_path) else inputs.get('images_dir', '')
+
+    if not os.path.isfile(series) or not os.path.isdir(images_directory_path):
+        raise FileNotFoundError(f'{series} or {images_directory_path}')
+
+    planner = ProCanLoad.WorkPlanner(images_directory_path, series, segmentations if os.path.isfile(segmentations) else None, crop_to_gland=crop_to_gland)
+
+    if calibrate:
+        planner.Calibrate(calibrate)
+
+    plan = planner.Plan(workers)
+    print(planner.Summary(plan))
+
+    if not dry_run:
+        planner.WritePlan(plan, output)
+        print(f'Shard plan written to {output}, run the shards with --shard i/{workers} --shard-plan {output}')
+
+
+def merge_shards(count: int, series: Path = ''):
+    '''
+    Combine the outputs of the --shard i/N runs into image_loader.json, nifti_files.json and the issues file.
+    The series parquet (argument or params.yaml) is used to keep the patient order of a single-node run.
+    '''
+    import yaml
+
+    ProCanLoad = ImportPackage()
+
+    if not os.path.isfile(series) and os.path.isfile('params.yaml'):
+        series = yaml.safe_load( open('params.yaml') ).get('series_df', '')
+
+    ProCanLoad.ShardUtils.Merge(count, series if os.path.isfile(series) else None)
 
 
 if __name__ == '__main__':
@@ -81,10 +208,57 @@ if __name__ == '__main__':
     parser.add_argument("--series", type=str, help="path/to/ecrfs-series-{version}.parquet", default='')
     parser.add_argument("--segments", type=str, help="path/to/segments-{version}.parquet", default='')
     parser.add_argument("--image-dir", type=str, help="path/to/{image directory}", default='')
+    parser.add_argument("--crop-to-gland", action='store_true', help="crop the extracted images and masks to the padded gland bounding box")
+    parser.add_argument("--metrics-json", type=str, help="path/to/metrics.json, per stage and per series timings and counters", default='')
+    parser.add_argument("--metrics-prom", type=str, help="path/to/procanload.prom, textfile for the node exporter", default='')
+    parser.add_argument("--shard", type=str, help="i/N, process only the patients of shard i out of N, outputs are written per shard", default='')
+    parser.add_argument("--shard-plan", type=str, help="path/to/shard_plan.json of --plan-shards, split of the patients by cost", default='')
+    parser.add_argument("--plan-shards", type=int, help="N, estimate the cost of the studies, write shard_plan.json for N shards (largest first) and exit", default=0)
+    parser.add_argument("--dry-run", action='store_true', help="print the estimated wall time and peak memory (of --plan-shards N workers, or one) and exit")
+    parser.add_argument("--calibrate", type=str, help="path/to/metrics.json of an earlier run (--metrics-json), calibrates the cost estimate", default='')
+    parser.add_argument("--merge-shards", type=int, help="N, merge the outputs of the N shards and exit", default=0)
+    parser.add_argument("--patients", type=str, help="comma separated patient_ids to process", default='')
+    parser.add_argument("--studies", type=str, help="comma separated study_uids to process", default='')
+    parser.add_argument("--series-types", type=str, help="comma separated user_series_type values to process (e.g. T2AX,ADC,DWI)", default='')
+    parser.add_argument("--provided-by", type=str, help="comma separated provided_by values to process", default='')
+    parser.add_argument("--manufacturer", type=str, help="comma separated manufacturer values to process", default='')
+    parser.add_argument("--prefetch-series", type=int, help="read ahead the files of the next N series/studies (0 disables)", default=0)
+    parser.add_argument("--prefetch-mb", type=int, help="read-ahead window in MiB", default=256)
+    parser.add_argument("--output-format", type=str, choices=['nifti', 'zarr', 'hdf5'], help="nii.gz files, or a chunked zarr/hdf5 store (optional dependency)", default='nifti')
+    parser.add_argument("--store-per-study", action='store_true', help="one zarr/hdf5 store per study instead of one for the cohort")
+    parser.add_argument("--validate", action='store_true', help="header-only checks before the export, failed studies are skipped (validation_plan.json)")
+    parser.add_argument("--seg-workers", type=int, help="threads extracting the segmentations, alongside the header scan when > 1", default=1)
+    parser.add_argument("--study-workers", type=int, help="studies converted at once (threads)", default=1)
+    parser.add_argument("--max-memory-mb", type=int, help="memory budget of the studies in flight, estimated from the manifest (0: no budget)", default=0)
+    parser.add_argument("--decode-workers", type=int, help="threads decoding the slices of a volume, for compressed (JPEG 2000, JPEG-LS) series", default=1)
+    parser.add_argument("--nifti-dtype", type=str, help="pixel type of the .nii.gz: auto (smallest lossless integer type), original, or e.g. int16", default='auto')
+    parser.add_argument("--verify-nifti", action='store_true', help="read every .nii.gz back, bit-exact check of the pixel type chosen")
+    parser.add_argument("--fused", action='store_true', help="scan and export in one pass, the studies are converted while the next ones are scanned")
+    parser.add_argument("--fused-queue", type=int, help="scanned studies waiting for the export in --fused mode, the scan pauses when it is full", default=4)
+    parser.add_argument("--stream-nifti", type=int, help="N, write the T2, DWI and DCE .nii.gz N slices at a time from the DICOM files, without the volume in memory (0 disables)", default=0)
     args = parser.parse_args()
 
+    row_filters = { key: [value.strip() for value in values.split(',')]
+                    for key, values in [('patients', args.patients),
+                                        ('studies', args.studies),
+                                        ('series_types', args.series_types),
+                                        ('provided_by', args.provided_by),
+                                        ('manufacturer', args.manufacturer)]
+                    if values
+    }
+
     series_arg = args.series
     segments_arg = args.segments
     images_arg = args.image_dir
 
-    dicom2nii(series_arg, segments_arg, images_arg)
+    if args.merge_shards:
+        merge_shards(args.merge_shards, series_arg)
+
+    elif args.plan_shards or args.dry_run:
+        plan_work(max(args.plan_shards, 1), series_arg, segments_arg, images_arg, args.calibrate, dry_run=args.dry_run, crop_to_gland=args.crop_to_gland)
+
+    else:
+        dicom2nii(series_arg, segments_arg, images_arg, args.crop_to_gland, args.metrics_json, args.metrics_prom, args.shard, args.shard_plan, row_filters,
+                  args.prefetch_series, args.prefetch_mb, args.decode_workers,
+                  args.output_format, args.store_per_study, args.validate, args.study_workers, args.max_memory_mb,
+                  args.seg_workers, args.nifti_dtype, args.verify_nifti, args.fused, args.fused_queue, args.stream_nifti)
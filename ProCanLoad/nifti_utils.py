@@ -0,0 +1,396 @@
+import os
+from pathlib import Path
+import gzip
+import struct
+import tempfile
+import numpy as np
+import SimpleITK as sitk
+
+
+class NiftiUtils():
+    '''
+    .nii.gz writer which stores a volume in the smallest integer type that holds its values exactly.
+    Float volumes (GDCM rescale, the ADC x 1000) are stored as integers when their values are integers, or as
+    integers with scl_slope/scl_inter when they lie on a grid (intercept + k x slope) a reader restores bit-exact.
+    Given rescale, the DICOM RescaleSlope/RescaleIntercept of a series GDCM rescaled, its stored values are written with
+    them as scl_slope/scl_inter when the readers restore the volume bit-exact (RescalePlan). A slope which is not a float32
+    (e.g. 11.441269841269786) cannot be, the volume keeps its float64 pixels.
+
+    info = NiftiUtils.Write(image, 'T2.nii.gz')                  # {'dtype', 'slope', 'intercept', 'compacted', 'verified'}
+    info = NiftiUtils.Write(image, 'T2.nii.gz', dtype='int16')   # explicit type, ValueError if the values do not fit
+    info = NiftiUtils.Write(image, 'T2.nii.gz', verify=True)     # read back, written again as is if it differs
+    info = NiftiUtils.Write(image, 'T2.nii.gz', rescale=(0.5, -1024.0))   # DICOM stored values when lossless, 'rescaled'
+
+    The volumes are written by SimpleITK, except the scaled ones: SimpleITK does not write scl_slope/scl_inter, their header
+    is the one it writes for the geometry of the image with the size and the scaling set in it.
+    '''
+
+    integer_types = [ np.dtype(dtype) for dtype in (np.uint8, np.int8, np.uint16, np.int16, np.uint32, np.int32) ]
+
+    # NIfTI-1 header, followed by the 4 bytes of the (empty) extension
+    header_size = 352
+    dim_offset = 42
+    scaling_offset = 112
+
+    # Template headers by pixel type and geometry, the volumes of a study share them
+    headers = {}
+
+    @staticmethod
+    def IntegerType(low: float, high: float, dtypes: list = None) -> np.dtype or None:
+        '''
+        First of dtypes (smallest first by default) which holds low..high, None if none does
+        '''
+        for dtype in dtypes or NiftiUtils.integer_types:
+
+            dtype = np.dtype(dtype)
+
+            if dtype.kind in 'iu' and np.iinfo(dtype).min <= low and high <= np.iinfo(dtype).max:
+                return dtype
+
+        return None
+
+    @staticmethod
+    def Statistics(volume: np.ndarray, statistics: dict = None, values: bool = False) -> dict:
+        '''
+        What Compact decides from, of a volume or of its slabs one call after the other (statistics of the previous ones):
+        {'dtype', 'size', 'low', 'high', 'finite', 'integral', 'values', 'kinds'}
+        values: the sorted distinct values of the float slabs are kept, otherwise CompactPlan takes them from the volume
+        '''
+        if statistics is None:
+            statistics = {  'dtype': volume.dtype, 'size': 0, 'low': None, 'high': None, 'finite': True, 'integral': True,
+                            'values': np.empty(0, dtype=volume.dtype) if values else None, 'kinds': set() }
+
+        statistics['dtype'] = np.result_type(statistics['dtype'], volume.dtype)
+        statistics['kinds'].add(volume.dtype.kind)
+
+        if not volume.size:
+            return statistics
+
+        statistics['size'] += volume.size
+
+        low, high = volume.min(), volume.max()
+        statistics['low'] = low if statistics['low'] is None else min(statistics['low'], low)
+        statistics['high'] = high if statistics['high'] is None else max(statistics['high'], high)
+
+        if volume.dtype.kind == 'f' and statistics['finite']:
+
+            statistics['finite'] = bool( np.isfinite(volume).all() )
+
+            if statistics['finite'] and statistics['integral']:
+                statistics['integral'] = np.array_equal(volume, np.rint(volume))
+
+            if statistics['finite'] and statistics['values'] is not None:
+                statistics['values'] = np.union1d(statistics['values'], volume)
+
+        return statistics
+
+    @staticmethod
+    def RescalePlan(values: np.ndarray, rescale: tuple, dtypes: list = None) -> dict or None:
+        '''
+        Plan of a volume GDCM rescaled (values: its sorted distinct values) from the DICOM stored values,
+        k = (value - intercept) / slope, with rescale (slope, intercept) as scl_slope/scl_inter.
+        Lossless only: the scaling of the header is float32, so slope and intercept must be float32 values and the values
+        the readers restore must be those of the volume, bit-exact. None otherwise or when k does not fit in dtypes.
+        '''
+        slope, intercept = ( np.float64(value) for value in rescale )
+
+        if not np.isfinite(slope) or slope == 0 or not np.isfinite(intercept) \
+           or np.float32(slope) != slope or np.float32(intercept) != intercept:
+            return None
+
+        k = np.rint( (values - intercept) / slope )
+        dtype = NiftiUtils.IntegerType(float(k.min()), float(k.max()), dtypes)
+
+        if dtype is None:
+            return None
+
+        restored = ( k * slope + intercept ).astype(np.float32)
+
+        if not np.array_equal(restored, values):
+            return None
+
+        return {    'dtype': dtype, 'slope': float(slope), 'intercept': float(intercept),
+                    'values': values, 'k': k.astype(dtype), 'rescaled': True }
+
+    @staticmethod
+    def CompactPlan(statistics: dict, dtypes: list = None, volume: np.ndarray = None, rescale: tuple = None) -> dict or None:
+        '''
+        {'dtype', 'slope', 'intercept'} of Compact from the statistics, with the grid ('values', 'k') of a scaled volume.
+        volume: the distinct values are taken from it when they were not kept in the statistics
+        rescale: (RescaleSlope, RescaleIntercept) of the DICOM files, RescalePlan when the values are on no exact grid
+        '''
+        if not statistics['size']:
+            return None
+
+        kind = np.dtype(statistics['dtype']).kind
+
+        if kind in 'iu':
+
+            dtype = NiftiUtils.IntegerType(int(statistics['low']), int(statistics['high']), dtypes)
+
+            return {'dtype': dtype, 'slope': 1.0, 'intercept': 0.0} if dtype is not None else None
+
+        if kind != 'f' or not statistics['finite']:
+            return None
+
+        if statistics['integral']:
+
+            dtype = NiftiUtils.IntegerType(float(statistics['low']), float(statistics['high']), dtypes)
+
+            if dtype is not None:
+                return {'dtype': dtype, 'slope': 1.0, 'intercept': 0.0}
+
+        values = statistics['values'] if statistics['values'] is not None else np.unique(volume)
+
+        if len(values) < 2:
+            return None
+
+        # Step of the grid from the closest values, or from the range once the number of steps is known
+        intercept = np.float32(values[0])
+        step = np.diff(values).min()
+        slopes = [ np.float32(step), np.float32( (values[-1] - values[0]) / max(np.rint((values[-1] - values[0]) / step), 1) ) ]
+
+        for slope in dict.fromkeys(slopes):
+
+            if not slope > 0 or intercept != values[0]:
+                continue
+
+            k = np.rint( (values - np.float64(intercept)) / np.float64(slope) )
+            dtype = NiftiUtils.IntegerType(0, float(k[-1]), dtypes)
+
+            if dtype is None:
+                continue
+
+            restored = ( k * np.float64(slope) + np.float64(intercept) ).astype(np.float32)
+
+            if np.array_equal(restored, values):
+                return {'dtype': dtype, 'slope': float(slope), 'intercept': float(intercept), 'values': values, 'k': k.astype(dtype)}
+
+        if rescale is not None:
+            return NiftiUtils.RescalePlan(values, rescale, dtypes)
+
+        return None
+
+    @staticmethod
+    def Apply(plan: dict, volume: np.ndarray) -> np.ndarray:
+        '''
+        The stored values of the volume (or of a slab) for a plan of CompactPlan
+        '''
+        if 'values' in plan:
+            return plan['k'][ np.searchsorted(plan['values'], volume) ]
+
+        if plan.get('exact'):
+
+            stored = volume.astype(plan['dtype'])
+
+            if not np.array_equal(stored, volume):
+                raise ValueError(f"The {volume.dtype} volume cannot be written as {plan['dtype']} without loss")
+
+            return stored
+
+        return volume.astype(plan['dtype'], copy=False)
+
+    @staticmethod
+    def Compact(volume: np.ndarray, dtypes: list = None) -> tuple or None:
+        '''
+        (stored, slope, intercept) with volume == stored x slope + intercept exactly, computed as the readers apply
+        scl_slope/scl_inter (double, cast to float32 when scaled). stored is of the first of dtypes which holds it.
+        None if there is none, e.g. float values without a common step.
+        '''
+        plan = NiftiUtils.CompactPlan(NiftiUtils.Statistics(volume), dtypes, volume)
+
+        if plan is None:
+            return None
+
+        return NiftiUtils.Apply(plan, volume), plan['slope'], plan['intercept']
+
+    @staticmethod
+    def Header(image: sitk.Image, dtype: np.dtype, slope: float = 1.0, intercept: float = 0.0) -> bytes:
+        '''
+        Header (and empty extension) of image stored as dtype, as SimpleITK writes it, with scl_slope/scl_inter
+        '''
+        return NiftiUtils.GeometryHeader(image.GetSize(), image.GetOrigin(), image.GetSpacing(), image.GetDirection(), dtype, slope, intercept)
+
+    @staticmethod
+    def GeometryHeader(size: tuple, origin: tuple, spacing: tuple, direction: tuple, dtype: np.dtype, slope: float = 1.0, intercept: float = 0.0) -> bytes:
+        '''
+        Header of a volume of size (x, y, z) and geometry which is not loaded (WriteSlabs)
+        '''
+        dtype = np.dtype(dtype)
+        origin, spacing, direction = ( tuple( float(value) for value in values ) for values in (origin, spacing, direction) )
+        key = ( dtype.str, origin, spacing, direction )
+
+        template = NiftiUtils.headers.get(key)
+
+        if template is None:
+
+            # A single voxel of the geometry, only its size differs from the header of the volume
+            single = sitk.GetImageFromArray( np.zeros((1, 1, 1), dtype=dtype) )
+            single.SetOrigin(origin)
+            single.SetSpacing(spacing)
+            single.SetDirection(direction)
+
+            with tempfile.TemporaryDirectory() as directory:
+
+                path = os.path.join(directory, 'header.nii')
+                sitk.WriteImage(single, path)
+
+                with open(path, 'rb') as file:
+                    template = file.read(NiftiUtils.header_size)
+
+            if len(NiftiUtils.headers) > 256:
+                NiftiUtils.headers.clear()
+
+            NiftiUtils.headers[key] = template
+
+        header = bytearray(template)
+        header[NiftiUtils.dim_offset:NiftiUtils.dim_offset + 6] = struct.pack('<3h', *size)
+        header[NiftiUtils.scaling_offset:NiftiUtils.scaling_offset + 8] = struct.pack('<2f', slope, intercept)
+
+        return bytes(header)
+
+    @staticmethod
+    def StorePlan(statistics: dict, dtype: str or np.dtype, volume: np.ndarray = None, rescale: tuple = None) -> dict or None:
+        '''
+        Plan (CompactPlan) of the volume of the statistics written for dtype, None to write it as it is.
+        ValueError if its values do not fit in an explicit integer type.
+        '''
+        if dtype == 'original':
+            return None
+
+        if dtype == 'auto':
+
+            plan = NiftiUtils.CompactPlan(statistics, None, volume, rescale)
+
+            if plan is None or plan['dtype'].itemsize >= np.dtype(statistics['dtype']).itemsize:
+                return None
+
+            return plan
+
+        dtype = np.dtype(dtype)
+
+        # Checked by Apply, slab by slab
+        if dtype.kind == 'f':
+            return {'dtype': dtype, 'slope': 1.0, 'intercept': 0.0, 'exact': True}
+
+        plan = NiftiUtils.CompactPlan(statistics, [dtype], volume, rescale)
+
+        if plan is None:
+            raise ValueError(f"The {statistics['dtype']} volume ({statistics['low']} to {statistics['high']}) cannot be written as {dtype} without loss")
+
+        return plan
+
+    @staticmethod
+    def __Stored(volume: np.ndarray, dtype: str or np.dtype, rescale: tuple = None) -> tuple or None:
+        '''
+        (stored, slope, intercept, rescaled) to write for dtype, None to write the volume as it is
+        '''
+        plan = NiftiUtils.StorePlan(NiftiUtils.Statistics(volume), dtype, volume, rescale)
+
+        if plan is None:
+            return None
+
+        return NiftiUtils.Apply(plan, volume), plan['slope'], plan['intercept'], plan.get('rescaled', False)
+
+    @staticmethod
+    def Write(image: sitk.Image, path: Path, dtype: str or np.dtype = 'auto', verify: bool = False, compression_level: int = 1,
+              rescale: tuple = None) -> dict:
+        '''
+        Write image to path (.nii.gz, or .nii uncompressed).
+        dtype: 'auto' the smallest lossless integer type (kept as is when not smaller), 'original' as sitk.WriteImage,
+               or a numpy type, ValueError if the values do not fit in it.
+        verify: read the file back and compare it with the image, written with its own type if it differs.
+        compression_level: zlib level of a scaled volume (WriteScaled), the rest is written by SimpleITK.
+        rescale: (RescaleSlope, RescaleIntercept) of the DICOM series the image was read from, see RescalePlan.
+                 info['rescaled'] is True when the file holds the stored values (read back bit-exact).
+        '''
+        path = str(path)
+        volume = sitk.GetArrayViewFromImage(image)
+
+        stored = None
+        if dtype != 'original' and image.GetDimension() == 3 and image.GetNumberOfComponentsPerPixel() == 1:
+            stored = NiftiUtils.__Stored(volume, dtype, rescale)
+
+        if stored is None:
+
+            sitk.WriteImage(image, path)
+            return {'dtype': str(volume.dtype), 'slope': 1.0, 'intercept': 0.0, 'compacted': False, 'verified': None, 'rescaled': False}
+
+        stored, slope, intercept, rescaled = stored
+
+        if slope == 1.0 and intercept == 0.0:
+
+            compact = sitk.GetImageFromArray(stored)
+            compact.CopyInformation(image)
+
+            sitk.WriteImage(compact, path)
+
+        else:
+            NiftiUtils.WriteScaled(image, path, stored, slope, intercept, compression_level)
+
+        info = {'dtype': str(stored.dtype), 'slope': slope, 'intercept': intercept, 'compacted': True, 'verified': None, 'rescaled': rescaled}
+
+        if verify:
+
+            info['verified'] = NiftiUtils.Verify(image, path)
+
+            if not info['verified']:
+                sitk.WriteImage(image, path)
+                info.update( {'dtype': str(volume.dtype), 'slope': 1.0, 'intercept': 0.0, 'compacted': False, 'rescaled': False} )
+
+        return info
+
+    @staticmethod
+    def WriteScaled(image: sitk.Image, path: Path, stored: np.ndarray, slope: float, intercept: float, compression_level: int = 1) -> None:
+        '''
+        Write stored with scl_slope/scl_inter and the geometry of image, SimpleITK does not write the scaling.
+        Level 1 of zlib gives about the size of the SimpleITK writer, a higher level is much slower for little gain.
+        '''
+        NiftiUtils.WriteSlabs(path, NiftiUtils.Header(image, stored.dtype, slope, intercept), [stored], compression_level)
+
+    @staticmethod
+    def WriteSlabs(path: Path, header: bytes, slabs, compression_level: int = 1) -> int:
+        '''
+        Write the header then the slabs (z, y, x arrays of the type of the header, in the order of z) one after the other,
+        only one slab is held at a time. Returns the bytes of the voxels. A file left incomplete by an error is removed.
+        '''
+        path = str(path)
+        written = 0
+
+        try:
+            with open(path, 'wb') as file:
+
+                # Fixed mtime, the same volume gives the same file
+                stream = gzip.GzipFile(filename='', mode='wb', fileobj=file, compresslevel=compression_level, mtime=0) if path.endswith('.gz') else file
+
+                with stream:
+
+                    stream.write(header)
+
+                    for slab in slabs:
+
+                        data = np.ascontiguousarray(slab, dtype=slab.dtype.newbyteorder('<'))
+                        stream.write(data.data)
+                        written += data.nbytes
+
+        except BaseException:
+
+            if os.path.isfile(path):
+                os.remove(path)
+
+            raise
+
+        return written
+
+    @staticmethod
+    def Verify(image: sitk.Image, path: Path) -> bool:
+        '''
+        The file read back with SimpleITK has the values (whatever their type) and the geometry of the image
+        '''
+        written = sitk.ReadImage(str(path))
+
+        return  written.GetSize() == image.GetSize() \
+                and np.array_equal( sitk.GetArrayViewFromImage(written), sitk.GetArrayViewFromImage(image) ) \
+                and np.allclose(written.GetOrigin(), image.GetOrigin(), atol=1e-4) \
+                and np.allclose(written.GetSpacing(), image.GetSpacing(), atol=1e-4) \
+                and np.allclose(written.GetDirection(), image.GetDirection(), atol=1e-4)
@@ -1,15 +1,23 @@
 import pydicom
 import numpy as np
 import struct
+import functools
+from pydicom.multival import MultiValue
+from pydicom.tag import Tag
+from pydicom.dataset import Dataset
 from pathlib import Path
 from .utils import GetDirectionDict
 
 class DCMUtils():
 
     @staticmethod
-    def ReadSlice(path: Path) -> pydicom.FileDataset:
+    def ReadSlice(path: Path, stop_before_pixels: bool = False, specific_tags: list = None) -> pydicom.FileDataset:
+        '''
+        stop_before_pixels: header only, Pixel Data is not read from disk
+        specific_tags: only these elements are parsed (e.g. ['Rows', 'Columns'])
+        '''
 
-        return pydicom.dcmread(path)
+        return pydicom.dcmread(path, stop_before_pixels=stop_before_pixels, specific_tags=specific_tags)
     
     @staticmethod
     def GetBvaluesTags():
@@ -22,47 +30,172 @@ class DCMUtils():
         
         return bvalues_tags
     
-    def DecodeBValue(bval: bytes):
+    # Tags of GetBvaluesTags as pydicom Tags, the tuples are not converted on every slice (None is the missing value).
+    # The staticmethod is called through __func__, it is not callable in the class body before Python 3.10
+    _bvalue_tags = [ Tag(tag) for tag in GetBvaluesTags.__func__() if tag is not None ]
+    _manufacturer_tag = Tag(0x0008,0x0070)
 
-        if '\\x' in str(bval):
+    # Bytes which repr() shows as \xNN: the value is a packed little endian double
+    _packed_bytes = frozenset( set(range(0x20)) - {0x09, 0x0a, 0x0d} ) | frozenset(range(0x7f, 0x100))
 
-            # Undecoded values, little endian
-            val = struct.unpack('<d',bval)[0]
-            return str(int(val)),'DecodedInt'
-        
-        elif '\\' in str(bval):
-            #format masked: (10^9+)bvalue//8//...
-            b_str = bval.decode().split('\\')[0]
-            val = b_str[-4:]
-            return int(val),'Bytes2String2Int'
+    # Bytes which repr() shows with a backslash: (10^9+)bvalue\8\0\0
+    _masked_bytes = frozenset({0x5c, 0x09, 0x0a, 0x0d})
 
-        else:
-            return str(int(bval)),'Bytes2Int'
+    @staticmethod
+    def BValueEncoding(bval) -> str:
+        '''
+        Name of the encoding of the raw value, the key of DCMUtils.bvalue_decoders
+        '''
+        if isinstance(bval, bytes):
+
+            if not DCMUtils._packed_bytes.isdisjoint(bval):
+                return 'DecodedInt'
+
+            if not DCMUtils._masked_bytes.isdisjoint(bval):
+                return 'Bytes2String2Int'
+
+            return 'Bytes2Int'
+
+        if isinstance(bval, (MultiValue, list, tuple)):
+            #[(10^9+)bvalue,8,...] but MultiValue object!!!
+            return 'MultiValue2String'
+
+        return 'normal'
+
+    bvalue_decoders = { # Undecoded values, little endian
+                        'DecodedInt':           lambda bval: str( int( struct.unpack('<d', bval)[0] ) ),
+                        #format masked: (10^9+)bvalue//8//...
+                        'Bytes2String2Int':     lambda bval: str( int( bval.decode().split('\\')[0][-4:] ) ),
+                        'Bytes2Int':            lambda bval: str( int(bval) ),
+                        'MultiValue2String':    lambda bval: str( bval[0] )[-4:],
+                        'normal':               lambda bval: str( int(bval) ),
+    }
+
+    @staticmethod
+    @functools.lru_cache(maxsize=None)
+    def DecodeRawBValue(tag: tuple, raw, manufacturer: str = None) -> tuple:
+        '''
+        Memoized on (tag, raw value, manufacturer): a series has a few distinct raw values,
+        each one is decoded once per run, the rest of the slices are a dict lookup.
+        raw: bytes or hashable value, MultiValue as tuple
+        '''
+        message = DCMUtils.BValueEncoding(raw)
+
+        return DCMUtils.bvalue_decoders[message](raw), message
 
+    @staticmethod
+    def DecodeBValue(bval: bytes):
+
+        return DCMUtils.DecodeRawBValue(None, bval)
+
+    @staticmethod
     def GetBValue(dcm_image: pydicom.FileDataset):
 
-        bvalues_tags = DCMUtils.GetBvaluesTags()
-        b_iter = iter(bvalues_tags)
-        b_tag = next(b_iter)
-        
-        while (b_tag not in dcm_image):
-            b_tag = next(b_iter)
-            if b_tag is None:
+        for b_tag in DCMUtils._bvalue_tags:
+
+            if b_tag in dcm_image:
                 break
 
-        if b_tag == None:
-            return b_tag,'Unknown'
+        else:
+            return None,'Unknown'
         
         bvalue = dcm_image[b_tag].value
 
-        if isinstance(bvalue,bytes):
-            
-            value, message = DCMUtils.DecodeBValue(bvalue)
-            return value, message
-        
-        elif isinstance(eval(str(bvalue)),list):
-            #[(10^9+)bvalue,8,...] but MultiValue object!!!
-            b_list = eval(str(bvalue))
-            return str(b_list[0])[-4:],'MultiValue2String'
+        if isinstance(bvalue, (MultiValue, list)):
+            bvalue = tuple(bvalue)
+
+        try:
+            hash(bvalue)
+
+        except TypeError:
+            # Value types of older pydicom versions may not be hashable, decoded without the cache
+            return DCMUtils.DecodeRawBValue.__wrapped__(b_tag, bvalue)
+
+        manufacturer = dcm_image.get(DCMUtils._manufacturer_tag)
+
+        return DCMUtils.DecodeRawBValue(b_tag, bvalue, manufacturer.value if manufacturer else None)
+
+    # Enhanced (multi-frame) objects: Shared and Per-frame Functional Groups Sequence
+    _shared_groups_tag = Tag(0x5200,0x9229)
+    _per_frame_groups_tag = Tag(0x5200,0x9230)
+
+    @staticmethod
+    def IsMultiFrame(dcm_image: pydicom.FileDataset) -> bool:
+        '''
+        Enhanced MR and the like, every frame is described by the Per-frame Functional Groups
+        '''
+        return DCMUtils._per_frame_groups_tag in dcm_image
+
+    @staticmethod
+    def __FlattenGroup(item: Dataset, frame: Dataset) -> None:
+        '''
+        Elements of a functional group macro (and of its nested single item sequences) moved to the top level
+        '''
+        for element in item:
+
+            if element.VR != 'SQ':
+                frame[element.tag] = element
+
+            elif len(element.value) == 1:
+                DCMUtils.__FlattenGroup(element.value[0], frame)
+
+    @staticmethod
+    def GetFrames(dcm_image: pydicom.FileDataset) -> list:
+        '''
+        One dataset per frame which reads like a single slice file: the top level elements of the file,
+        then the shared and the per-frame functional groups flattened (ImagePositionPatient, ImageOrientationPatient,
+        PixelSpacing, DiffusionBValue, DiffusionGradientOrientation, RescaleSlope...).
+        InstanceNumber is the frame number and TemporalPositionIndex is copied to TemporalPositionIdentifier.
+        '''
+        top = Dataset()
+        for element in dcm_image:
+
+            if element.VR != 'SQ' and element.tag != 0x7fe00010:
+                top[element.tag] = element
+
+        shared = dcm_image.get(DCMUtils._shared_groups_tag)
+        shared = shared.value[0] if shared is not None and len(shared.value) else Dataset()
+
+        frames = []
+        for number, per_frame in enumerate(dcm_image[DCMUtils._per_frame_groups_tag].value, start=1):
+
+            frame = Dataset()
+            frame.update(top)
+            DCMUtils.__FlattenGroup(shared, frame)
+            DCMUtils.__FlattenGroup(per_frame, frame)
+
+            frame.InstanceNumber = number
+
+            if 'TemporalPositionIndex' in frame:
+                frame.TemporalPositionIdentifier = frame.TemporalPositionIndex
+
+            frames.append(frame)
+
+        return frames
+
+    @staticmethod
+    def GetFrameGeometry(frame: Dataset) -> tuple:
+        '''
+        ImagePositionPatient and the direction (as sitk.Image.GetDirection) of a frame of GetFrames
+        '''
+        origin = tuple( float(value) for value in frame.ImagePositionPatient )
+
+        row = np.array( frame.ImageOrientationPatient[0:3], dtype=np.float64 )
+        column = np.array( frame.ImageOrientationPatient[3:6], dtype=np.float64 )
+        normal = np.cross(row, column)
+
+        direction = tuple( np.stack([row, column, normal], axis=1).ravel().tolist() )
+
+        return origin, direction
+
+    @staticmethod
+    def GetRawBValue(dcm_image: Dataset) -> str:
+        '''
+        B-value as stored, as SitkUtils.GetBvalue returns it for a single slice file
+        '''
+        for b_tag in DCMUtils._bvalue_tags:
+
+            if b_tag in dcm_image:
+                return str( dcm_image[b_tag].value )
 
-        return str(int(bvalue)),'normal'
+        return 'N/A'
@@ -1,7 +1,11 @@
 import os
 from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
 import SimpleITK as sitk
+from .Metrics import Metrics
+from .pydicom_utils import DCMUtils
+from .nifti_utils import NiftiUtils
 
 class SitkUtils():
 
@@ -19,18 +23,209 @@ class SitkUtils():
         '''
 
 
-        reader=sitk.ImageSeriesReader()
+        with Metrics.Stage('load_volume') as stage:
+
+            reader=sitk.ImageSeriesReader()
 
-        reader.SetFileNames(image_list)
-        reader.MetaDataDictionaryArrayUpdateOn()
-        reader.LoadPrivateTagsOn()
-        ITK = reader.Execute()
+            reader.SetFileNames(image_list)
+            reader.MetaDataDictionaryArrayUpdateOn()
+            reader.LoadPrivateTagsOn()
+            ITK = reader.Execute()
+
+            if Metrics.enabled:
+                stage.Count(files=len(image_list), bytes_read=Metrics.FileSize(image_list))
 
         if orientation:
-             ITK = sitk.DICOMOrient(ITK,orientation)
+            with Metrics.Stage('reorientation'):
+                ITK = SitkUtils.Orient(ITK,orientation)
 
         return ITK
     
+    @staticmethod
+    def LoadSlices(slices: list, orientation: str = None, workers: int = 1) -> sitk.Image:
+        '''
+        Load the slices of a manifest entry ({'path'} or {'path', 'frame'} for the frames of multi-frame files),
+        ordered by the main plane origin.
+        workers > 1: the slice files are decoded in a thread pool (LoadImageThreaded)
+        '''
+
+        if any( 'frame' in entry for entry in slices ):
+            return SitkUtils.LoadFrames(slices, orientation)
+
+        if workers > 1 and len(slices) > 1:
+            return SitkUtils.LoadImageThreaded([entry['path'] for entry in slices], orientation, workers)
+
+        return SitkUtils.LoadImageByFolder([entry['path'] for entry in slices], orientation)
+
+    @staticmethod
+    def __DecodeSlice(path: Path) -> tuple:
+        '''
+        One slice file through GDCM (any transfer syntax, rescale slope/intercept applied as in ImageSeriesReader).
+        Returns the pixels (rows x columns) and the origin
+        '''
+
+        reader = sitk.ImageFileReader()
+        reader.SetFileName(path)
+        image = reader.Execute()
+
+        return sitk.GetArrayFromImage(image).reshape( image.GetHeight(), image.GetWidth() ), image.GetOrigin()
+
+    @staticmethod
+    def LoadImageThreaded(image_list: list or tuple, orientation: str = None, workers: int = 4) -> sitk.Image:
+        '''
+        Same volume as LoadImageByFolder, the slices are decoded concurrently and copied into one preallocated array.
+        Worth it for compressed transfer syntaxes (JPEG 2000, JPEG-LS), where ImageSeriesReader decodes one slice after another.
+
+        Each slice is read with the GDCM reader of ImageSeriesReader, so the rescale slope/intercept and pixel type are the same,
+        the VOI LUT / window is not applied by either. The volume has the pixel type of the first slice, unless a slice needs a
+        wider one (rescale changing along the series), then the volume is converted instead of truncating that slice.
+        Geometry as ImageSeriesReader: origin and direction of the first slice, slice spacing from the first to the last origin.
+        '''
+
+        with Metrics.Stage('load_volume') as stage:
+
+            # The first slice gives the size and pixel type of the buffer
+            first = sitk.ImageFileReader()
+            first.SetFileName(image_list[0])
+            first_image = first.Execute()
+            first_pixels = sitk.GetArrayFromImage(first_image).reshape( first_image.GetHeight(), first_image.GetWidth() )
+
+            # Filled in acquisition order, laid out in the orientation
+            volume = SitkUtils.OrientedEmpty( (len(image_list),) + first_pixels.shape, first_pixels.dtype, first_image.GetDirection(), orientation )
+            volume[0] = first_pixels
+
+            origins = [first_image.GetOrigin()] + [None] * (len(image_list) - 1)
+            wider = {}
+
+            def Decode(index: int) -> None:
+
+                pixels, origins[index] = SitkUtils.__DecodeSlice(image_list[index])
+
+                if pixels.shape != volume.shape[1:]:
+                    raise ValueError(f'Slice size {pixels.shape} of {image_list[index]} is not the size of the series {volume.shape[1:]}')
+
+                if np.can_cast(pixels.dtype, volume.dtype, casting='safe'):
+                    volume[index] = pixels
+
+                else:
+                    wider[index] = pixels
+
+            with ThreadPoolExecutor(max_workers=workers) as pool:
+                # list() raises the exception of a slice, if any
+                list( pool.map(Decode, range(1, len(image_list))) )
+
+            if wider:
+
+                volume = volume.astype( np.result_type(volume.dtype, *[pixels.dtype for pixels in wider.values()]) )
+
+                for index, pixels in wider.items():
+                    volume[index] = pixels
+
+            if Metrics.enabled:
+                stage.Count(files=len(image_list), bytes_read=Metrics.FileSize(image_list))
+
+        spacing = list(first_image.GetSpacing())
+        distance = np.linalg.norm( np.array(origins[-1]) - np.array(origins[0]) )
+
+        if distance > 0:
+            spacing[2] = distance / (len(image_list) - 1)
+
+        return SitkUtils.ImageFromArray(volume, first_image.GetOrigin(), spacing, first_image.GetDirection(), orientation)
+
+    @staticmethod
+    def RescaledPixelType(bits_stored: int, signed: bool, slope: float, intercept: float) -> np.dtype:
+        '''
+        Pixel type of the rescaled values, as chosen by GDCM for ImageSeriesReader:
+        float64 if slope or intercept is not an integer, else the smallest integer type which holds the stored range
+        '''
+
+        if slope != int(slope) or intercept != int(intercept):
+            return np.dtype(np.float64)
+
+        low, high = (-2 ** (bits_stored - 1), 2 ** (bits_stored - 1) - 1) if signed else (0, 2 ** bits_stored - 1)
+        low, high = sorted( (low * slope + intercept, high * slope + intercept) )
+
+        for dtype in ( (np.uint8, np.uint16, np.uint32) if low >= 0 else (np.int8, np.int16, np.int32) ):
+
+            if np.iinfo(dtype).min <= low and high <= np.iinfo(dtype).max:
+                return np.dtype(dtype)
+
+        return np.dtype(np.float64)
+
+    @staticmethod
+    def SeriesRescale(image_list: list or tuple, workers: int = 1) -> tuple or None:
+        '''
+        (RescaleSlope, RescaleIntercept) of the slice files (headers only), None when they change along the series
+        '''
+
+        def Read(path: Path) -> tuple:
+
+            header = DCMUtils.ReadSlice(path, stop_before_pixels=True, specific_tags=['RescaleSlope', 'RescaleIntercept'])
+
+            return float(header.get('RescaleSlope', 1) or 1), float(header.get('RescaleIntercept', 0) or 0)
+
+        with ThreadPoolExecutor(max_workers=max(workers, 1)) as pool:
+            rescales = set( pool.map(Read, image_list) )
+
+        return rescales.pop() if len(rescales) == 1 else None
+
+    @staticmethod
+    def LoadFrames(slices: list, orientation: str = None) -> sitk.Image:
+        '''
+        Volume from the frames of Enhanced (multi-frame) DICOM files, every file is opened and read once.
+        slices: [{'path', 'frame'}] ordered by the main plane origin.
+        Rescale slope/intercept and the geometry follow ImageSeriesReader: the slice direction is the normal of the
+        first frame and the spacing between slices is the distance of the first and last frame over their number - 1.
+        '''
+
+        with Metrics.Stage('load_volume') as stage:
+
+            files = {}
+            for entry in slices:
+
+                if entry['path'] not in files:
+
+                    dcm_image = DCMUtils.ReadSlice(entry['path'])
+                    pixels = dcm_image.pixel_array
+
+                    files[entry['path']] = ( DCMUtils.GetFrames(dcm_image) if DCMUtils.IsMultiFrame(dcm_image) else [dcm_image],
+                                             pixels.reshape( (-1,) + pixels.shape[-2:] ),
+                                             dcm_image )
+
+            frames = [ files[entry['path']][0][entry.get('frame') or 0] for entry in slices ]
+
+            dcm_image = files[slices[0]['path']][2]
+            slopes = [ float(frame.get('RescaleSlope', 1) or 1) for frame in frames ]
+            intercepts = [ float(frame.get('RescaleIntercept', 0) or 0) for frame in frames ]
+            signed = int(dcm_image.get('PixelRepresentation', 0)) == 1
+
+            dtype = np.result_type( *[ SitkUtils.RescaledPixelType(int(dcm_image.BitsStored), signed, slope, intercept)
+                                       for slope, intercept in zip(slopes, intercepts) ] )
+
+            first, direction = DCMUtils.GetFrameGeometry(frames[0])
+
+            volume = SitkUtils.OrientedEmpty( (len(slices),) + files[slices[0]['path']][1].shape[1:], dtype, direction, orientation )
+
+            for index, (entry, slope, intercept) in enumerate( zip(slices, slopes, intercepts) ):
+
+                pixels = files[entry['path']][1][entry.get('frame') or 0]
+                volume[index] = pixels * slope + intercept if slope != 1 or intercept != 0 else pixels
+
+            if Metrics.enabled:
+                stage.Count(files=len(files), bytes_read=Metrics.FileSize(list(files)))
+
+        last = np.array( DCMUtils.GetFrameGeometry(frames[-1])[0] )
+
+        if len(frames) > 1 and np.linalg.norm(last - first) > 0:
+            slice_spacing = np.linalg.norm(last - first) / (len(frames) - 1)
+
+        else:
+            slice_spacing = float( frames[0].get('SpacingBetweenSlices') or frames[0].get('SliceThickness') or 1.0 )
+
+        row_spacing, column_spacing = ( float(value) for value in frames[0].PixelSpacing )
+
+        return SitkUtils.ImageFromArray(volume, first, (column_spacing, row_spacing, slice_spacing), direction, orientation)
+
     @staticmethod
     def ReadImageInfo(filepath: Path) -> sitk.Image:
         '''
@@ -52,17 +247,152 @@ class SitkUtils():
         image = sitk.ReadImage(filepath)
         
         if orientation:
-             image = sitk.DICOMOrient(image,orientation)
+            with Metrics.Stage('reorientation'):
+                image = SitkUtils.Orient(image,orientation)
              
         return image
     
+    @staticmethod
+    def OrientationAxes(direction: tuple, orientation: str = 'LPS', min_cosine: float = 0.8) -> tuple or None:
+        '''
+        Permutation and flips of the axes which bring the direction (sitk.Image.GetDirection) to the orientation, as DICOMOrient.
+        Returns (axes, flips), the image axis of every output axis and whether it is reversed.
+        None when an axis is more than acos(min_cosine) (~37 degrees) from its closest patient axis, or the code is not valid.
+        '''
+        letters = { 'L': (0, 1), 'R': (0, -1), 'P': (1, 1), 'A': (1, -1), 'S': (2, 1), 'I': (2, -1) }
+
+        if len(orientation) != 3 or any( letter not in letters for letter in orientation.upper() ):
+            return None
+
+        targets = [ letters[letter] for letter in orientation.upper() ]
+        cosines = np.array(direction, dtype=np.float64).reshape(3, 3)
+
+        # Patient axis closest to every image axis (the columns of the direction)
+        closest = np.abs(cosines).argmax(axis=0)
+
+        if sorted(closest) != [0, 1, 2] or sorted( axis for axis, _ in targets ) != [0, 1, 2] \
+           or np.abs(cosines).max(axis=0).min() < min_cosine:
+            return None
+
+        axes = [ int(np.flatnonzero(closest == axis)[0]) for axis, _ in targets ]
+        flips = [ bool( np.sign(cosines[closest[image_axis], image_axis]) != sign ) for image_axis, (_, sign) in zip(axes, targets) ]
+
+        return axes, flips
+
+    @staticmethod
+    def OrientArray(volume: np.ndarray, origin: tuple, spacing: tuple, direction: tuple, orientation: str = 'LPS') -> tuple or None:
+        '''
+        volume (z, y, x as sitk.GetArrayFromImage) and its geometry in the orientation, (volume, origin, spacing, direction).
+        The volume is a strided view, nothing is copied. The geometry is the one of DICOMOrient bit for bit: the origin is
+        the physical point of the first voxel, summed over the output axes as ITK does.
+        None when the direction is oblique (OrientationAxes).
+        '''
+        oriented = SitkUtils.OrientationAxes(direction, orientation)
+
+        if oriented is None:
+            return None
+
+        axes, flips = oriented
+        cosines = np.array(direction, dtype=np.float64).reshape(3, 3)
+        size = volume.shape[::-1]
+
+        # numpy is z,y,x - sitk index is x,y,z
+        view = volume[ tuple( slice(None, None, -1) if flips[axes.index(2 - axis)] else slice(None) for axis in range(3) ) ]
+        view = view.transpose( [ 2 - axes[2 - axis] for axis in range(3) ] )
+
+        spacing = [ float(spacing[image_axis]) for image_axis in axes ]
+        columns = [ -cosines[:, image_axis] if flip else cosines[:, image_axis] for image_axis, flip in zip(axes, flips) ]
+        index = [ size[image_axis] - 1 if flip else 0 for image_axis, flip in zip(axes, flips) ]
+
+        point = [ float(value) for value in origin ]
+        for row in range(3):
+            for axis, image_axis in enumerate(axes):
+                point[row] += cosines[row, image_axis] * spacing[axis] * index[axis]
+
+        direction = [ float(columns[axis][row]) for row in range(3) for axis in range(3) ]
+
+        return view, point, spacing, direction
+
+    @staticmethod
+    def Orient(image: sitk.Image, orientation: str = 'LPS') -> sitk.Image:
+        '''
+        sitk.DICOMOrient without its copy: the image itself when its axes are already in the orientation, one copy of a
+        strided view when they are permuted or flipped. DICOMOrient for oblique directions (and vector images).
+        '''
+        oriented = None
+
+        if image.GetDimension() == 3 and image.GetNumberOfComponentsPerPixel() == 1:
+            oriented = SitkUtils.OrientationAxes(image.GetDirection(), orientation)
+
+        if oriented is None:
+            return sitk.DICOMOrient(image, orientation)
+
+        if oriented == ([0, 1, 2], [False, False, False]):
+            return image
+
+        volume, origin, spacing, direction = SitkUtils.OrientArray( sitk.GetArrayViewFromImage(image), image.GetOrigin(),
+                                                                   image.GetSpacing(), image.GetDirection(), orientation )
+
+        return SitkUtils.ImageFromArray(volume, origin, spacing, direction)
+
+    @staticmethod
+    def OrientedEmpty(shape: tuple, dtype: np.dtype, direction: tuple, orientation: str = None) -> np.ndarray:
+        '''
+        Empty volume (z, y, x) to fill in acquisition order, a view of a buffer laid out in the orientation.
+        OrientArray of it is the buffer itself, so the image is made without reordering the voxels.
+        '''
+        oriented = SitkUtils.OrientationAxes(direction, orientation) if orientation else None
+
+        if oriented is None:
+            return np.empty(shape, dtype=dtype)
+
+        axes, flips = oriented
+        order = [ 2 - axes[2 - axis] for axis in range(3) ]
+
+        buffer = np.empty( tuple( shape[axis] for axis in order ), dtype=dtype )
+        volume = buffer.transpose( np.argsort(order) )
+
+        return volume[ tuple( slice(None, None, -1) if flips[axes.index(2 - axis)] else slice(None) for axis in range(3) ) ]
+
+    @staticmethod
+    def ImageFromArray(volume: np.ndarray, origin: tuple, spacing: tuple, direction: tuple, orientation: str = None) -> sitk.Image:
+        '''
+        sitk.Image of an assembled volume (z, y, x) and its geometry, reoriented while it is copied into the image
+        '''
+        oriented = None
+
+        if orientation:
+            with Metrics.Stage('reorientation'):
+                oriented = SitkUtils.OrientArray(volume, origin, spacing, direction, orientation)
+
+        if oriented is not None:
+            volume, origin, spacing, direction = oriented
+
+        # No copy when the volume was filled in the orientation (OrientedEmpty), GetImageFromArray of a strided view is slow
+        ITK = sitk.GetImageFromArray( np.ascontiguousarray(volume) )
+        ITK.SetOrigin(origin)
+        ITK.SetSpacing(spacing)
+        ITK.SetDirection(direction)
+
+        if orientation and oriented is None:
+            with Metrics.Stage('reorientation'):
+                ITK = sitk.DICOMOrient(ITK,orientation)
+
+        return ITK
+
     @staticmethod
     def GetImagePlane(image: sitk.Image) -> str:
             '''
             Get Image Plane orientation
             '''
 
-            directions = image.GetDirection()
+            return SitkUtils.GetDirectionPlane( image.GetDirection() )
+
+    @staticmethod
+    def GetDirectionPlane(directions: tuple) -> str:
+            '''
+            Image Plane orientation from the direction matrix (sitk.Image.GetDirection)
+            '''
 
             directions = (directions[0], directions[3], directions[6], directions[1], directions[4], directions[7])
 
@@ -101,7 +431,72 @@ class SitkUtils():
         return image.GetMetaData(tag)
     
     @staticmethod
-    def WriteDICOM2Nifti(image: sitk.Image or list,path2save: Path, sequence: str) -> None:
+    def GetPhysicalBoundingBox(masks: list, padding: float = 0.0) -> tuple or None:
+        '''
+        Physical (LPS) bounding box which encloses the non-zero voxels of all the masks, enlarged by padding (mm).
+        Returns (lower, upper) corners or None if every mask is empty.
+        '''
+
+        lower, upper = None, None
+
+        for mask in masks:
+
+            mask_np = sitk.GetArrayViewFromImage(mask)
+            nonzero = np.argwhere(mask_np > 0)
+
+            if not nonzero.size:
+                continue
+
+            # numpy is z,y,x - sitk index is x,y,z
+            idx_min = nonzero.min(axis=0)[::-1]
+            idx_max = nonzero.max(axis=0)[::-1]
+
+            corners = [ mask.TransformIndexToPhysicalPoint( [ int(idx_max[d]) if (c >> d) & 1 else int(idx_min[d]) for d in range(3) ] )
+                        for c in range(8) ]
+            corners = np.array(corners)
+
+            lower = corners.min(axis=0) if lower is None else np.minimum(lower, corners.min(axis=0))
+            upper = corners.max(axis=0) if upper is None else np.maximum(upper, corners.max(axis=0))
+
+        if lower is None:
+            return None
+
+        return lower - padding, upper + padding
+
+    @staticmethod
+    def CropToPhysicalBox(image: sitk.Image, box: tuple) -> tuple:
+        '''
+        Crop image to the index region that covers the physical box given by GetPhysicalBoundingBox.
+        Returns the cropped image and the crop information (index offset, size and new origin).
+        '''
+
+        lower, upper = box
+
+        corners = [ [ upper[d] if (c >> d) & 1 else lower[d] for d in range(3) ] for c in range(8) ]
+        indices = np.array( [ image.TransformPhysicalPointToContinuousIndex(corner) for corner in corners ] )
+
+        size = np.array(image.GetSize())
+        start = np.clip( np.floor( indices.min(axis=0) ).astype(int), 0, size - 1 )
+        stop = np.clip( np.ceil( indices.max(axis=0) ).astype(int) + 1, start + 1, size )
+
+        cropped = image[ int(start[0]):int(stop[0]), int(start[1]):int(stop[1]), int(start[2]):int(stop[2]) ]
+
+        crop_info = {   'index': start.tolist(),
+                        'size': list(cropped.GetSize()),
+                        'origin': list(cropped.GetOrigin())
+        }
+
+        return cropped, crop_info
+
+    @staticmethod
+    def WriteDICOM2Nifti(image: sitk.Image or list,path2save: Path, sequence: str, dtype: str = 'auto', verify: bool = False,
+                         rescale: tuple = None) -> dict:
+        '''
+        Write path2save/sequence.nii.gz, in the smallest lossless integer type by default (NiftiUtils.Write).
+        dtype: 'auto', 'original' (pixel type of the image) or a numpy type. verify: bit-exact read back check.
+        rescale: (RescaleSlope, RescaleIntercept) of a series GDCM rescaled to float64 (SeriesRescale), its stored values
+                 are written with them as scl_slope/scl_inter when it is lossless (NiftiUtils.RescalePlan)
+        '''
 
         os.makedirs(path2save, exist_ok=True)
 
@@ -114,7 +509,170 @@ class SitkUtils():
             ITKim = image
 
         path = os.path.join(path2save, sequence+'.nii.gz' )
-        sitk.WriteImage(ITKim, path)
+
+        with Metrics.Stage('write_nifti') as stage:
+
+            info = NiftiUtils.Write(ITKim, path, dtype=dtype, verify=verify, rescale=rescale)
+
+            if Metrics.enabled:
+                stage.Count(volumes_written=1, bytes_written=Metrics.FileSize(path))
+
+        return info
+
+    @staticmethod
+    def __SliceHeader(path: Path) -> tuple:
+        '''
+        Pixel type (after the rescale of GDCM), rows x columns and origin of one slice file, its pixels are not decoded
+        '''
+        reader = SitkUtils.ReadImageInfo(path)
+
+        if reader.GetNumberOfComponents() != 1:
+            return None, None, None
+
+        dtype = sitk.GetArrayViewFromImage( sitk.Image([1, 1], reader.GetPixelID()) ).dtype
+
+        return dtype, tuple(reader.GetSize()[1::-1]), reader.GetOrigin()
+
+    @staticmethod
+    def StreamDICOM2Nifti(slices: list, path2save: Path, sequence: str, orientation: str = 'LPS', dtype: str = 'auto',
+                          slab_slices: int = 8, workers: int = 1) -> dict or None:
+        '''
+        WriteDICOM2Nifti of LoadSlices(slices, orientation) without the volume in memory. The pixel type, size and origin
+        of the slices come from their headers, then the slices are decoded slab_slices at a time (in a pool of workers
+        threads), converted, reoriented and compressed after the header. 'original' and an explicit type which needs no
+        grid are written in that one pass; 'auto' (and an integer type for float slices) decodes the slices once more
+        before, for the statistics of the stored type. Nothing is written but the output.
+        The .nii inside the .nii.gz is the one written from the whole volume, byte for byte (with the rescale of
+        SeriesRescale when the slices are float64).
+        Returns the info of NiftiUtils.Write with 'peak_bytes' (slab buffers held at once), None when the volume has to be
+        loaded whole: frames of multi-frame files, an oblique direction or an orientation which moves the slice axis,
+        slices of different sizes or with several components, or float and integer slices in one series.
+        '''
+        slices = list(slices)
+
+        if not slices or any( 'frame' in entry for entry in slices ):
+            return None
+
+        image_list = [ entry['path'] for entry in slices ]
+
+        first = SitkUtils.ReadImageInfo(image_list[0])
+        first_direction = first.GetDirection()
+
+        if orientation:
+
+            oriented = SitkUtils.OrientationAxes(first_direction, orientation)
+
+            # The slabs are written in the order of the slices, the slice axis must stay the last one
+            if oriented is None or oriented[0][2] != 2:
+                return None
+
+        with Metrics.Stage('load_volume'):
+
+            with ThreadPoolExecutor(max_workers=max(workers, 1)) as pool:
+                headers = list( pool.map(SitkUtils.__SliceHeader, image_list) )
+
+        slice_shape = tuple(first.GetSize()[1::-1])
+
+        if any( slice_dtype is None or shape != slice_shape for slice_dtype, shape, _ in headers ):
+            return None
+
+        kinds = { slice_dtype.kind for slice_dtype, _, _ in headers }
+
+        if 'f' in kinds and len(kinds) > 1:
+            return None
+
+        volume_dtype = np.result_type( *[ slice_dtype for slice_dtype, _, _ in headers ] )
+
+        def Decoded(starts):
+
+            with ThreadPoolExecutor(max_workers=max(workers, 1)) as pool:
+
+                for start in starts:
+
+                    decoded = list( pool.map(SitkUtils.__DecodeSlice, image_list[start:start + slab_slices]) )
+
+                    for (pixels, _), (slice_dtype, shape, _), path in zip(decoded, headers[start:], image_list[start:]):
+
+                        if pixels.dtype != slice_dtype or pixels.shape != shape:
+                            raise ValueError(f'{path} decodes to {pixels.dtype} {pixels.shape}, its header gives {slice_dtype} {shape}')
+
+                    yield np.stack( [ pixels for pixels, _ in decoded ] ).astype(volume_dtype, copy=False)
+
+        starts = range(0, len(image_list), slab_slices)
+
+        if dtype == 'original':
+            plan = None
+
+        elif dtype != 'auto' and not ( np.dtype(dtype).kind in 'iu' and volume_dtype.kind == 'f' ):
+            # Checked by Apply, slab by slab, as StorePlan does for a float type
+            plan = {'dtype': np.dtype(dtype), 'slope': 1.0, 'intercept': 0.0, 'exact': True}
+
+        else:
+
+            with Metrics.Stage('load_volume') as stage:
+
+                statistics = None
+                for slab in Decoded(starts):
+                    statistics = NiftiUtils.Statistics(slab, statistics, values=True)
+
+                if Metrics.enabled:
+                    stage.Count(files=len(image_list), bytes_read=Metrics.FileSize(image_list))
+
+            # GDCM rescaled the slices with a slope or intercept which is not an integer
+            rescale = SitkUtils.SeriesRescale(image_list, workers) if volume_dtype == np.float64 else None
+
+            plan = NiftiUtils.StorePlan(statistics, dtype, rescale=rescale)
+
+        # Geometry of LoadImageThreaded: the first slice, the slice spacing from the first to the last origin
+        spacing = list(first.GetSpacing())
+        distance = np.linalg.norm( np.array(headers[-1][2]) - np.array(headers[0][2]) )
+
+        if distance > 0:
+            spacing[2] = distance / (len(image_list) - 1)
+
+        origin, oriented_spacing, direction = first.GetOrigin(), spacing, first_direction
+        shape = (len(image_list),) + slice_shape
+
+        if orientation:
+            # Strides of zero, only the geometry and the shape of the oriented volume are needed
+            view, origin, oriented_spacing, direction = SitkUtils.OrientArray( np.broadcast_to(np.zeros((), volume_dtype), shape),
+                                                                              first.GetOrigin(), spacing, first_direction, orientation )
+            shape = view.shape
+
+        stored_dtype = plan['dtype'] if plan is not None else volume_dtype
+        slope, intercept = (plan['slope'], plan['intercept']) if plan is not None else (1.0, 0.0)
+
+        header = NiftiUtils.GeometryHeader(shape[::-1], origin, oriented_spacing, direction, stored_dtype, slope, intercept)
+
+        def Slabs():
+
+            # A flipped slice axis is written from the last slab, each one reversed by its view
+            for slab in Decoded( starts[::-1] if orientation and oriented[1][2] else starts ):
+
+                if orientation:
+                    slab = SitkUtils.OrientArray(slab, first.GetOrigin(), spacing, first_direction, orientation)[0]
+
+                yield NiftiUtils.Apply(plan, slab) if plan is not None else slab
+
+        os.makedirs(path2save, exist_ok=True)
+        path = os.path.join(path2save, sequence+'.nii.gz' )
+
+        with Metrics.Stage('write_nifti') as stage:
+
+            NiftiUtils.WriteSlabs(path, header, Slabs())
+
+            if Metrics.enabled:
+                stage.Count(files=len(image_list), bytes_read=Metrics.FileSize(image_list), volumes_written=1, bytes_written=Metrics.FileSize(path))
+
+        return {    'dtype': str(stored_dtype),
+                    'slope': slope,
+                    'intercept': intercept,
+                    'compacted': plan is not None,
+                    'verified': None,
+                    'rescaled': plan is not None and plan.get('rescaled', False),
+                    # The decoded slab, converted to the type of the volume and to the stored type
+                    'peak_bytes': min(slab_slices, len(image_list)) * int(np.prod(slice_shape)) * (2 * volume_dtype.itemsize + stored_dtype.itemsize)
+        }
 
     #### Not used. Decoding is performed by pydicom. SimpleITK may fail to read some bvalues.
     # import base64 #Package needed for decoding 
@@ -1,11 +1,20 @@
+import os
 import json
-import pandas as pd
+import hashlib
 from pathlib import Path
 
 class DataFrameUtils:
     
     @staticmethod
-    def Read(file: str or pd.DataFrame) -> pd.DataFrame:
+    def Read(file: 'str or pd.DataFrame', columns: list = None, filters: list = None) -> 'pd.DataFrame':
+        '''
+        columns: read only these columns (all if None).
+        filters: rows to keep, list of (column, op, value) joined with AND, op in ==, !=, <, <=, >, >=, in, not in.
+        For parquet both are pushed down to pyarrow, so only the needed columns and row groups are read.
+        '''
+
+        # Imported here, JsonUtils and the CLI do not need pandas
+        import pandas as pd
 
         PandasLoaderDict = {    '.csv':     pd.read_csv,
                                 '.xlsx':    pd.read_excel,
@@ -22,12 +31,72 @@ class DataFrameUtils:
             if suffix not in PandasLoaderDict:
                 raise ValueError(f"I haven't build this path yet. Unknown {suffix}")
 
-            return PandasLoaderDict[suffix](file)
+            if suffix == '.parquet':
+                return pd.read_parquet(file, columns=columns, filters=filters or None)
+
+            file = PandasLoaderDict[suffix](file)
 
         if isinstance(file,pd.DataFrame):
             
+            if filters:
+                file = DataFrameUtils.Filter(file, filters)
+
+            if columns is not None:
+                file = file[columns]
+
             return file
 
+    @staticmethod
+    def Columns(file: 'str or pd.DataFrame') -> list:
+        '''
+        Column names, for parquet only the schema is read
+        '''
+        if isinstance(file, str) and Path(file).suffix == '.parquet':
+
+            if not Path(file).exists():
+                raise FileNotFoundError(f'Path to parquet:{file}')
+
+            import pyarrow.parquet as pq
+
+            schema = pq.read_schema(file)
+            index_columns = (schema.pandas_metadata or {}).get('index_columns', [])
+
+            return [ name for name in schema.names if name not in index_columns ]
+
+        if isinstance(file, str) and Path(file).suffix == '.csv':
+
+            import pandas as pd
+            return pd.read_csv(file, nrows=0).columns.tolist()
+
+        return DataFrameUtils.Read(file).columns.tolist()
+
+    @staticmethod
+    def Filter(df: 'pd.DataFrame', filters: list) -> 'pd.DataFrame':
+        '''
+        Same filters as pyarrow, for DataFrames and csv/xlsx
+        '''
+        operators = {   '==':       lambda col, val: col == val,
+                        '=':        lambda col, val: col == val,
+                        '!=':       lambda col, val: col != val,
+                        '<':        lambda col, val: col < val,
+                        '<=':       lambda col, val: col <= val,
+                        '>':        lambda col, val: col > val,
+                        '>=':       lambda col, val: col >= val,
+                        'in':       lambda col, val: col.isin(val),
+                        'not in':   lambda col, val: ~col.isin(val)
+        }
+
+        mask = None
+        for column, op, value in filters:
+
+            if op not in operators:
+                raise ValueError(f'Unknown filter operator {op}')
+
+            condition = operators[op](df[column], value)
+            mask = condition if mask is None else mask & condition
+
+        return df if mask is None else df[mask]
+
 class JsonUtils:
     
     @staticmethod
@@ -48,6 +117,66 @@ class JsonUtils:
             return json.load(f)
         
 
+class StudyJsonWriter:
+    '''
+    {patient: {study: value}} json written one study at a time, the file is the one JsonUtils.Write gives for the whole dict.
+    The studies of a patient come one after the other. Written to path.partial, moved to path once closed.
+
+    with StudyJsonWriter('image_loader.json') as writer:
+        for patient, study, value in studies:
+            writer.Write(patient, study, value)
+    '''
+
+    def __init__(self, path: Path) -> None:
+
+        self.path = str(path)
+        self.partial_path = self.path + '.partial'
+        self.file = open(self.partial_path, 'w')
+        self.patient = None
+        self.patients = set()
+        self.studies = 0
+
+        self.file.write('{')
+
+    def Write(self, patient: str, study: str, value: dict) -> None:
+
+        if patient != self.patient:
+
+            if patient in self.patients:
+                raise ValueError(f'The studies of {patient} are not consecutive')
+
+            self.file.write( '\n    },' if self.patient is not None else '' )
+            self.file.write( f'\n    {json.dumps(patient)}: {{' )
+
+            self.patient = patient
+            self.patients.add(patient)
+            self.studies = 0
+
+        self.file.write( ',' if self.studies else '' )
+        self.file.write( f'\n        {json.dumps(study)}: ' + json.dumps(value, indent=4).replace('\n', '\n        ') )
+
+        self.studies += 1
+
+    def Close(self) -> None:
+
+        self.file.write( '\n    }\n}' if self.patient is not None else '}' )
+        self.file.close()
+
+        os.replace(self.partial_path, self.path)
+
+    def __enter__(self):
+
+        return self
+
+    def __exit__(self, exc_type, *exc) -> None:
+
+        # A failed scan leaves the partial file and the previous manifest
+        if exc_type is None:
+            self.Close()
+        else:
+            self.file.close()
+
+
 def GetDirectionDict() -> dict:
      
     direction_dict =    {   '0': {'plane':'SAG','origin':0}, # Sagittal
@@ -56,3 +185,152 @@ def GetDirectionDict() -> dict:
         }
  
     return direction_dict
+
+
+class ShardUtils:
+    '''
+    Deterministic split of the cohort by patient across batch nodes. shard is given as "i/N", i in 0...N-1.
+    '''
+
+    @staticmethod
+    def Parse(shard: str) -> tuple:
+
+        try:
+            index, count = [int(part) for part in str(shard).split('/')]
+        except ValueError:
+            raise ValueError(f'Shard should be given as "i/N", got {shard}')
+
+        if count < 1 or not 0 <= index < count:
+            raise ValueError(f'Shard index should be in 0...{count - 1}, got {shard}')
+
+        return index, count
+
+    @staticmethod
+    def InShard(patient_id: str, shard: str, plan: dict = None) -> bool:
+        '''
+        Patient belongs to the shard. sha1 of the patient_id, python's hash() is salted per process.
+        plan: shard plan of WorkPlanner ({'shards': N, 'patients': {patient_id: i}}), patients missing from it use the sha1
+        '''
+        index, count = ShardUtils.Parse(shard)
+
+        if plan is not None:
+
+            if plan['shards'] != count:
+                raise ValueError(f"The shard plan is for {plan['shards']} shards, got {shard}")
+
+            if patient_id in plan['patients']:
+                return plan['patients'][patient_id] == index
+
+        return int( hashlib.sha1( str(patient_id).encode() ).hexdigest(), 16 ) % count == index
+
+    @staticmethod
+    def ShardPath(path: Path, shard: str = None) -> str:
+        '''
+        image_loader.json -> image_loader.shard-0-of-4.json, unchanged if shard is None
+        '''
+        if not shard:
+            return str(path)
+
+        index, count = ShardUtils.Parse(shard)
+        root, suffix = os.path.splitext(str(path))
+
+        return f'{root}.shard-{index}-of-{count}{suffix}'
+
+    @staticmethod
+    def __MergeManifest(shard_paths: list, path: Path, order: dict = None) -> None:
+        '''
+        {patient: ...} of the shard files into path, the file JsonUtils.Write gives for the merged dict.
+        One shard is loaded at a time, the patients are kept as their json text until they are written in order.
+        '''
+        patients = {}
+        for shard_path in shard_paths:
+
+            for patient, value in JsonUtils.Load(shard_path).items():
+                patients[patient] = json.dumps(value, indent=4).replace('\n', '\n    ')
+
+        keys = list(patients)
+
+        if order is not None:
+            keys.sort( key=lambda patient: order.get(patient, len(order)) )
+
+        with open(path, 'w') as file:
+
+            file.write('{')
+
+            for i, patient in enumerate(keys):
+                file.write( f'{"," if i else ""}\n    {json.dumps(patient)}: {patients.pop(patient)}' )
+
+            file.write('\n}' if keys else '}')
+
+    @staticmethod
+    def Merge(  count: int,
+                parquet_series: Path = None,
+                image_loader: Path = 'image_loader.json',
+                nifti_files: Path = 'nifti_files.json',
+                validation_plan: Path = 'validation_plan.json',
+                crop_boxes: Path = 'crop_boxes.json',
+                issues: Path = 'issues/image_loader_issues.json',
+                sop_index: Path = 'sop_index.sqlite'
+    ) -> None:
+        '''
+        Combine the per-shard manifests and issue logs into the canonical files.
+        If parquet_series is given, patients are ordered as in the parquet, as in a single-node run.
+        Manifests without any shard file (e.g. nifti_files.json when nothing was exported, validation_plan.json without --validate,
+        crop_boxes.json without --crop-to-gland) are skipped.
+        The shard indexes are merged first: an instance stored in series of different shards is a DuplicateInstance only
+        in the merged index, checked there for the series the shards scanned as a single-node run does.
+        '''
+
+        order = None
+        if parquet_series is not None:
+            order = { patient: i for i, patient in enumerate( DataFrameUtils.Read(parquet_series, columns=['patient_id']).patient_id.unique() ) }
+
+        for path in [image_loader, nifti_files, validation_plan, crop_boxes]:
+
+            shard_paths = [ ShardUtils.ShardPath(path, f'{i}/{count}') for i in range(count) ]
+            shard_paths = [ shard_path for shard_path in shard_paths if os.path.isfile(shard_path) ]
+
+            if not shard_paths:
+                continue
+
+            ShardUtils.__MergeManifest(shard_paths, path, order)
+
+        duplicates = {}
+
+        shard_paths = [ ShardUtils.ShardPath(sop_index, f'{i}/{count}') for i in range(count) ]
+        shard_paths = [ shard_path for shard_path in shard_paths if os.path.isfile(shard_path) ]
+
+        if shard_paths:
+
+            from .SOPIndex import SOPIndex
+            series_uids = SOPIndex.Merge(shard_paths, sop_index)
+
+            index = SOPIndex(sop_index)
+
+            try:
+                duplicates = index.Duplicates(series_uids)
+
+            finally:
+                index.Close()
+
+        merged_issues = {}
+        for i in range(count):
+
+            shard_path = ShardUtils.ShardPath(issues, f'{i}/{count}')
+
+            if not os.path.isfile(shard_path):
+                continue
+
+            for issue, message in JsonUtils.Load(shard_path).items():
+
+                if isinstance(message, dict) and isinstance(merged_issues.get(issue), dict):
+                    merged_issues[issue].update(message)
+                else:
+                    merged_issues[issue] = message
+
+        # Every path of the instances, a shard only saw its own copies
+        if duplicates:
+            merged_issues['DuplicateInstance'] = duplicates
+
+        os.makedirs(os.path.dirname(issues) or '.', exist_ok=True)
+        JsonUtils.Write(merged_issues, issues)
@@ -0,0 +1,113 @@
+'''
+Micro-benchmark of the b-value decoding per DWI slice.
+
+For every encoding of the tags in DCMUtils.GetBvaluesTags a series of slices is built in memory
+(a few distinct b-values, as in a real series) and DCMUtils.GetBValue is timed against the
+previous eval() based decoder. The decoded values of both must be the same.
+
+python benchmarks/bench_bvalue.py --slices 3000
+'''
+import sys
+import time
+import struct
+import argparse
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+from pydicom.dataset import Dataset
+from ProCanLoad.pydicom_utils import DCMUtils
+
+BVALUES = [0, 50, 800, 1400]
+
+
+def LegacyGetBValue(dcm_image: Dataset) -> tuple:
+    '''
+    Decoder before the memoization, kept for comparison
+    '''
+    b_iter = iter(DCMUtils.GetBvaluesTags())
+    b_tag = next(b_iter)
+
+    while (b_tag not in dcm_image):
+        b_tag = next(b_iter)
+        if b_tag is None:
+            break
+
+    if b_tag == None:
+        return b_tag, 'Unknown'
+
+    bval = dcm_image[b_tag].value
+
+    if isinstance(bval, bytes):
+
+        if '\\x' in str(bval):
+            return str(int(struct.unpack('<d', bval)[0])), 'DecodedInt'
+
+        elif '\\' in str(bval):
+            return str(int(bval.decode().split('\\')[0][-4:])), 'Bytes2String2Int'
+
+        return str(int(bval)), 'Bytes2Int'
+
+    elif isinstance(eval(str(bval)), list):
+        return str(eval(str(bval))[0])[-4:], 'MultiValue2String'
+
+    return str(int(bval)), 'normal'
+
+
+def Slice(encoding: str, bvalue: int) -> Dataset:
+
+    ds = Dataset()
+    ds.Manufacturer = 'SIEMENS' if encoding in ('public', 'siemens') else 'GE MEDICAL SYSTEMS'
+
+    if encoding == 'public':
+        ds.add_new( (0x0018, 0x9087), 'FD', float(bvalue) )
+
+    elif encoding == 'siemens':
+        ds.add_new( (0x0019, 0x100c), 'IS', str(bvalue) )
+
+    elif encoding == 'multivalue':
+        ds.add_new( (0x0043, 0x1039), 'IS', [str(1000000000 + bvalue), '8', '0', '0'] )
+
+    elif encoding == 'bytes_string':
+        ds.add_new( (0x0043, 0x1039), 'OB', f'{1000000000 + bvalue}\\8\\0\\0'.encode() )
+
+    elif encoding == 'bytes_int':
+        ds.add_new( (0x0043, 0x1039), 'OB', str(bvalue).encode() )
+
+    elif encoding == 'bytes_double':
+        ds.add_new( (0x0043, 0x1039), 'OB', struct.pack('<d', float(bvalue)) )
+
+    return ds
+
+
+def TimePerSlice(decoder, slices: list) -> tuple:
+
+    start = time.perf_counter()
+    values = [ decoder(ds) for ds in slices ]
+
+    return (time.perf_counter() - start) / len(slices) * 1e6, values
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--slices", type=int, help="slices per encoding", default=3000)
+    args = parser.parse_args()
+
+    encodings = ['public', 'siemens', 'multivalue', 'bytes_string', 'bytes_int', 'bytes_double', 'missing']
+
+    print(f'{"encoding":<14} {"eval (us)":>10} {"memoized (us)":>14} {"speedup":>8}')
+
+    for encoding in encodings:
+
+        slices = [ Slice(encoding, BVALUES[i % len(BVALUES)]) for i in range(args.slices) ]
+
+        DCMUtils.DecodeRawBValue.cache_clear()
+
+        legacy_us, legacy_values = TimePerSlice(LegacyGetBValue, slices)
+        memo_us, memo_values = TimePerSlice(DCMUtils.GetBValue, slices)
+
+        assert legacy_values == memo_values, (encoding, legacy_values[:4], memo_values[:4])
+
+        print(f'{encoding:<14} {legacy_us:10.2f} {memo_us:14.2f} {legacy_us / memo_us:7.1f}x   '
+              f'decoded {DCMUtils.DecodeRawBValue.cache_info().misses} times')
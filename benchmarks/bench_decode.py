@@ -0,0 +1,99 @@
+'''
+Volume assembly of a compressed series, ImageSeriesReader against the thread pool decoder.
+
+A synthetic T2 series is written with SyntheticCohort and every slice is recompressed to JPEG 2000 (lossless) with GDCM.
+SitkUtils.LoadImageByFolder and SitkUtils.LoadImageThreaded are timed on it, the volumes (pixels, pixel type and geometry)
+must be identical. The speedup depends on the cores available, there is none with a single core.
+
+python benchmarks/bench_decode.py --slices 40 --matrix 512 --workers 1,2,4,8
+'''
+import os
+import sys
+import time
+import argparse
+import tempfile
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+import numpy as np
+import SimpleITK as sitk
+from ProCanLoad import SyntheticCohort
+from ProCanLoad.sitk_utils import SitkUtils
+
+
+def CompressSeries(series_path: str, compressor: str) -> list:
+    '''
+    Rewrite every slice of the series with the compressor, the header is kept
+    '''
+    files = sorted( os.path.join(series_path, name) for name in os.listdir(series_path) )
+
+    for file in files:
+
+        image = sitk.ReadImage(file)
+
+        writer = sitk.ImageFileWriter()
+        writer.SetImageIO('GDCMImageIO')
+        writer.KeepOriginalImageUIDOn()
+        writer.SetUseCompression(True)
+        writer.SetCompressor(compressor)
+        writer.SetFileName(file)
+        writer.Execute(image)
+
+    return files
+
+
+def Sorted(files: list) -> list:
+
+    return sorted( files, key=lambda file: SitkUtils.ReadImageInfo(file).GetOrigin()[2] )
+
+
+def Time(load, repeat: int) -> tuple:
+
+    times = []
+    for _ in range(repeat):
+
+        start = time.perf_counter()
+        volume = load()
+        times.append(time.perf_counter() - start)
+
+    return min(times), volume
+
+
+def Same(a: sitk.Image, b: sitk.Image) -> bool:
+
+    return  np.array_equal(sitk.GetArrayViewFromImage(a), sitk.GetArrayViewFromImage(b)) and a.GetPixelID() == b.GetPixelID() \
+            and np.allclose(a.GetOrigin(), b.GetOrigin()) and np.allclose(a.GetSpacing(), b.GetSpacing()) \
+            and np.allclose(a.GetDirection(), b.GetDirection())
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument("--slices", type=int, default=40)
+    parser.add_argument("--matrix", type=int, default=512)
+    parser.add_argument("--compressor", type=str, help="GDCM compressor", default='JPEG2000')
+    parser.add_argument("--workers", type=str, help="comma separated thread counts", default='1,2,4,8')
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+
+        paths = SyntheticCohort(directory, n_patients=1, series_types=['T2'], labels=[], n_slices=args.slices, t2_matrix=args.matrix).Generate()
+
+        series_path = next( root for root, _, names in os.walk(paths['images_dir']) if names )
+        files = Sorted( CompressSeries(series_path, args.compressor) )
+
+        reference_seconds, reference = Time(lambda: SitkUtils.LoadImageByFolder(files, 'LPS'), args.repeat)
+
+        print(f'{args.slices} slices {args.matrix}x{args.matrix} {args.compressor}, {os.cpu_count()} cores')
+        print(f'ImageSeriesReader     {reference_seconds:8.3f} s')
+
+        for workers in [ int(value) for value in args.workers.split(',') ]:
+
+            seconds, volume = Time(lambda: SitkUtils.LoadImageThreaded(files, 'LPS', workers), args.repeat)
+
+            assert Same(reference, volume), f'volume of {workers} workers differs from ImageSeriesReader'
+
+            print(f'threaded, {workers:2d} workers  {seconds:8.3f} s   x{reference_seconds / seconds:.2f}')
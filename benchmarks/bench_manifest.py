@@ -0,0 +1,111 @@
+'''
+Memory of the in-memory manifest, the SeriesRecord layout against the dict per slice written to image_loader.json.
+
+No DICOM is read, the manifest of a cohort is built directly (patients x studies x sequences x slices)
+and the memory retained by it is measured with tracemalloc.
+
+python benchmarks/bench_manifest.py --patients 1000
+'''
+import sys
+import json
+import argparse
+import tracemalloc
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+from ProCanLoad.Manifest import Manifest, SeriesRecord
+
+SEQUENCES = {'T2': ['N/A'], 'ADC': ['N/A'], 'DWI': ['0', '800', '1400']}
+
+
+def Slices(patient: int, study: int, sequence: str, n_slices: int) -> tuple:
+
+    directory = f'DICOM_images/PCa-{patient:040d}/1.3.6.1.4.1.58108.1.{study:039d}/1.3.6.1.4.1.58108.1.{patient:020d}{sequence}'
+    paths = [ f'{directory}/image-{index + 1:03d}.dcm' for index in range(n_slices) ]
+    origins = [ (-120.5 + 0.1 * patient, -98.25 + 0.01 * index, -45.123456789 + 3.6 * index) for index in range(n_slices) ]
+
+    return paths, origins
+
+
+def Meta(patient: int, study: int, sequence: str) -> dict:
+
+    return {    'series_uid': f'1.3.6.1.4.1.58108.1.{patient:020d}{sequence}',
+                'study_uid': f'1.3.6.1.4.1.58108.1.{study:039d}',
+                'provided_by': 'Synthetic',
+                'user_series_type': sequence,
+                'manufacturer': 'SIEMENS',
+    }
+
+
+def BuildDicts(patients: int, studies: int, n_slices: int) -> dict:
+    '''
+    Layout before the records: a deep copy of meta per b-value and one dict per slice
+    '''
+    manifest = {}
+
+    for patient in range(patients):
+        for study in range(studies):
+            for sequence, bvalues in SEQUENCES.items():
+
+                paths, origins = Slices(patient, study, sequence, n_slices)
+
+                for bvalue in bvalues:
+
+                    manifest.setdefault(str(patient), {}).setdefault(str(study), {}).setdefault(sequence, {})[bvalue] = {
+                            'meta': Meta(patient, study, sequence),
+                            'dcm_path': { origin[2]: {'path': path, 'ImagePositionPatient': ','.join(map(str, origin))}
+                                          for path, origin in zip(paths, origins) }
+                    }
+
+    return manifest
+
+
+def BuildRecords(patients: int, studies: int, n_slices: int) -> Manifest:
+
+    manifest = Manifest()
+
+    for patient in range(patients):
+        for study in range(studies):
+            for sequence, bvalues in SEQUENCES.items():
+
+                paths, origins = Slices(patient, study, sequence, n_slices)
+                meta = Meta(patient, study, sequence)
+
+                for bvalue in bvalues:
+
+                    manifest.setdefault(str(patient), {}).setdefault(str(study), {}).setdefault(sequence, {})[bvalue] = \
+                            SeriesRecord(meta, paths, [origin[2] for origin in origins], origins)
+
+    return manifest
+
+
+def Retained(build, *args) -> tuple:
+
+    tracemalloc.start()
+    manifest = build(*args)
+    retained = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+
+    return manifest, retained
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument("--patients", type=int, default=1000)
+    parser.add_argument("--studies", type=int, default=1)
+    parser.add_argument("--slices", type=int, default=24)
+    args = parser.parse_args()
+
+    dicts, dicts_bytes = Retained(BuildDicts, args.patients, args.studies, args.slices)
+    del dicts
+
+    records, records_bytes = Retained(BuildRecords, args.patients, args.studies, args.slices)
+
+    # to_json must give back the dict layout
+    assert json.dumps(records.to_json()) == json.dumps(BuildDicts(args.patients, args.studies, args.slices))
+
+    print(f'dict per slice  {dicts_bytes / 2**20:8.1f} MiB')
+    print(f'SeriesRecord    {records_bytes / 2**20:8.1f} MiB   x{dicts_bytes / records_bytes:.1f} smaller')
@@ -0,0 +1,88 @@
+'''
+.nii.gz of float volumes as sitk.WriteImage writes them against NiftiUtils.Write (smallest lossless integer type).
+
+rescaled: 12 bit values with an integer slope, read as float64 by GDCM when the intercept is not an integer
+decimal:  12 bit values with the RescaleSlope of a scanner (11.441269841269786, not a float32), as GDCM computes them;
+          no float32 scl_slope restores them, the volume stays float64
+integral: the same values as float32 (e.g. ADC x 1000 of a float ADC)
+mask:     0/1 in int16
+
+Every file is read back with SimpleITK and must have the values of the volume.
+
+python benchmarks/bench_nifti.py --shape 30,512,512
+'''
+import os
+import sys
+import time
+import argparse
+import tempfile
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+import numpy as np
+import SimpleITK as sitk
+from ProCanLoad.nifti_utils import NiftiUtils
+
+
+def Volumes(shape: tuple, seed: int) -> dict:
+
+    rng = np.random.default_rng(seed)
+    z, y, x = np.meshgrid( *[ np.linspace(-1, 1, size) for size in shape ], indexing='ij' )
+
+    stored = 400 * ( (x / 0.8) ** 2 + (y / 0.6) ** 2 <= 1 ) + 300 * ( (x / 0.25) ** 2 + (y / 0.2) ** 2 + (z / 0.6) ** 2 <= 1 )
+    stored = np.clip( stored + rng.normal(0, 10, shape), 0, 4095 ).astype(np.int64)
+
+    return {    'rescaled': stored * 2.0 - 1024.5,
+                'decimal': stored * decimal_slope + 0.0,
+                'integral': stored.astype(np.float32),
+                'mask': ( (x / 0.25) ** 2 + (y / 0.2) ** 2 + (z / 0.6) ** 2 <= 1 ).astype(np.int16)
+    }
+
+
+# RescaleSlope of a T2 of the sample data, with a zero RescaleIntercept
+decimal_slope = 11.441269841269786
+
+rescales = {'decimal': (decimal_slope, 0.0)}
+
+
+def Time(function) -> tuple:
+
+    start = time.perf_counter()
+    result = function()
+
+    return time.perf_counter() - start, result
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument("--shape", type=str, help="z,y,x of the volumes", default='30,512,512')
+    args = parser.parse_args()
+
+    shape = tuple( int(value) for value in args.shape.split(',') )
+
+    print(f'volume {shape}, write and read seconds, MiB on disk')
+
+    with tempfile.TemporaryDirectory() as directory:
+
+        for name, volume in Volumes(shape, 0).items():
+
+            image = sitk.GetImageFromArray(volume)
+            image.SetSpacing( (0.4, 0.4, 3.0) )
+
+            original = os.path.join(directory, f'{name}_original.nii.gz')
+            compact = os.path.join(directory, f'{name}_compact.nii.gz')
+
+            original_write, _ = Time(lambda: sitk.WriteImage(image, original))
+            compact_write, info = Time(lambda: NiftiUtils.Write(image, compact, rescale=rescales.get(name)))
+
+            original_read, _ = Time(lambda: sitk.ReadImage(original))
+            compact_read, written = Time(lambda: sitk.ReadImage(compact))
+
+            assert np.array_equal( sitk.GetArrayViewFromImage(written), volume ), f'{name} does not read back bit-exact'
+
+            print(f'{name:<9} {str(volume.dtype):<8} write {original_write:6.2f}  read {original_read:6.2f}  {os.path.getsize(original) / 2**20:7.2f} MiB')
+            print(f'{"":<9} {info["dtype"]:<8} write {compact_write:6.2f}  read {compact_read:6.2f}  {os.path.getsize(compact) / 2**20:7.2f} MiB'
+                  f'   slope {info["slope"]:g} intercept {info["intercept"]:g}')
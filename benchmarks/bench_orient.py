@@ -0,0 +1,73 @@
+'''
+LPS reorientation, sitk.DICOMOrient against SitkUtils.Orient.
+
+Volumes with the axes of an axial LPS acquisition (slightly oblique, as scanned), of a coronal one and of a flipped
+axial one are reoriented by both. The images must be identical, pixels and geometry.
+
+python benchmarks/bench_orient.py --shape 30,512,512
+'''
+import sys
+import time
+import argparse
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+import numpy as np
+import SimpleITK as sitk
+from ProCanLoad.sitk_utils import SitkUtils
+
+
+angle = np.radians(2.4)
+
+directions = {  'axial':            (np.cos(angle), -np.sin(angle), 0.0, np.sin(angle), np.cos(angle), 0.0, 0.0, 0.0, 1.0),
+                'coronal':          (1.0, 0.0, 0.0, 0.0, 0.0, 1.0, 0.0, -1.0, 0.0),
+                'axial flipped':    (-1.0, 0.0, 0.0, 0.0, -1.0, 0.0, 0.0, 0.0, 1.0)
+}
+
+
+def Time(orient, image: sitk.Image, repeat: int) -> tuple:
+
+    times = []
+    for _ in range(repeat):
+
+        start = time.perf_counter()
+        oriented = orient(image, 'LPS')
+        times.append(time.perf_counter() - start)
+
+    return min(times) * 1000, oriented
+
+
+def Same(a: sitk.Image, b: sitk.Image) -> bool:
+
+    return  np.array_equal(sitk.GetArrayViewFromImage(a), sitk.GetArrayViewFromImage(b)) and a.GetPixelID() == b.GetPixelID() \
+            and a.GetOrigin() == b.GetOrigin() and a.GetSpacing() == b.GetSpacing() and a.GetDirection() == b.GetDirection()
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument("--shape", type=str, help="z,y,x of the volumes", default='30,512,512')
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    shape = tuple( int(value) for value in args.shape.split(',') )
+    volume = np.random.default_rng(0).integers(0, 4096, shape).astype(np.int16)
+
+    print(f'volume {shape} int16, ms per volume')
+
+    for name, direction in directions.items():
+
+        image = sitk.GetImageFromArray(volume)
+        image.SetDirection(direction)
+        image.SetSpacing( (0.4, 0.4, 3.0) )
+        image.SetOrigin( (-100.0, -100.0, -60.0) )
+
+        reference_ms, reference = Time(sitk.DICOMOrient, image, args.repeat)
+        orient_ms, oriented = Time(SitkUtils.Orient, image, args.repeat)
+
+        assert Same(reference, oriented), f'{name} differs from DICOMOrient'
+
+        copied = 'no copy' if oriented is image else 'one copy'
+        print(f'{name:<14} DICOMOrient {reference_ms:8.2f}   Orient {orient_ms:8.2f} ({copied})')
@@ -0,0 +1,188 @@
+'''
+Throughput benchmark on a synthetic cohort.
+
+Times ImageLoader.GetImageLoader, SegmentationLoader.GetSeriesSegmentations and DICOM2NII.Execute,
+each one in a fresh process, so the peak RSS recorded belongs only to that stage.
+
+python benchmarks/bench_pipeline.py --patients 20 --output bench.json
+python benchmarks/bench_pipeline.py --patients 20 --baseline bench.json   # exit code 1 on regression
+'''
+import os
+import sys
+import json
+import time
+import argparse
+import tempfile
+import multiprocessing
+from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+STAGES = ['GetImageLoader', 'GetSeriesSegmentations', 'DICOM2NII.Execute']
+
+
+def PeakRSS() -> int or None:
+    '''
+    Peak resident set size of the current process in bytes, None where resource is not available (Windows)
+    '''
+    try:
+        import resource
+    except ImportError:
+        return None
+
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+def RunStage(stage: str, workdir: str, paths: dict) -> dict:
+
+    os.chdir(workdir)
+
+    from ProCanLoad import ImageLoader, SegmentationLoader, DICOM2NII, DataFrameUtils, JsonUtils
+
+    start = time.perf_counter()
+
+    if stage == 'GetImageLoader':
+
+        ImageLoader(paths['images_dir'], paths['series_df']).GetImageLoader()
+
+    elif stage == 'GetSeriesSegmentations':
+
+        image_loader = JsonUtils.Load('image_loader.json')
+        df_seg = DataFrameUtils.Read(paths['segments_df'])
+        source_series = set(df_seg.source_series_uid)
+
+        for patient, pval in image_loader.items():
+
+            for study, stval in pval.items():
+
+                if 'T2' not in stval or stval['T2']['N/A']['meta']['series_uid'] not in source_series:
+                    continue
+
+                loader = SegmentationLoader(paths['images_dir'], paths['series_df'], paths['segments_df'], sop_index='sop_index.sqlite')
+                stval['SEG'], _ = loader.GetSeriesSegmentations(stval['T2']['N/A'])
+
+        # Export stage also writes the masks
+        JsonUtils.Write(image_loader, 'image_loader.json')
+
+    elif stage == 'DICOM2NII.Execute':
+
+        DICOM2NII('image_loader.json').Execute()
+
+    seconds = time.perf_counter() - start
+
+    return {'stage': stage, 'seconds': seconds, 'peak_rss': PeakRSS()}
+
+
+def RunBenchmark(paths: dict, workdir: str, repeat: int = 1) -> dict:
+
+    results = {}
+    context = multiprocessing.get_context('spawn')
+
+    for _ in range(repeat):
+
+        for stage in STAGES:
+
+            with ProcessPoolExecutor(max_workers=1, mp_context=context) as executor:
+                result = executor.submit(RunStage, stage, workdir, paths).result()
+
+            if stage not in results or result['seconds'] < results[stage]['seconds']:
+                results[stage] = result
+
+    return results
+
+
+def CompareToBaseline(results: dict, baseline: dict, tolerance: float) -> list:
+
+    regressions = []
+
+    for stage, result in results.items():
+
+        if stage not in baseline:
+            continue
+
+        for key in ['seconds', 'peak_rss']:
+
+            new, old = result[key], baseline[stage][key]
+
+            if new is None or old is None:
+                continue
+
+            if new > old * (1 + tolerance):
+                regressions.append(f'{stage} {key}: {old:.4g} -> {new:.4g} (+{100 * (new / old - 1):.1f}%)')
+
+    return regressions
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument("--patients", type=int, help="number of synthetic patients", default=10)
+    parser.add_argument("--studies", type=int, help="studies per patient", default=1)
+    parser.add_argument("--slices", type=int, help="slices per volume", default=20)
+    parser.add_argument("--t2-matrix", type=int, help="T2 rows/columns", default=128)
+    parser.add_argument("--dwi-matrix", type=int, help="ADC/DWI rows/columns", default=64)
+    parser.add_argument("--duplicate-slices", type=int, help="duplicated slices per volume", default=0)
+    parser.add_argument("--repeat", type=int, help="run every stage N times and keep the fastest", default=1)
+    parser.add_argument("--workdir", type=str, help="directory for the cohort and outputs, temporary if not given", default='')
+    parser.add_argument("--output", type=str, help="path/to/results.json", default='')
+    parser.add_argument("--baseline", type=str, help="path/to/previous/results.json, fail on regression", default='')
+    parser.add_argument("--tolerance", type=float, help="allowed relative slowdown against the baseline", default=0.25)
+    args = parser.parse_args()
+
+    from ProCanLoad.SyntheticCohort import SyntheticCohort
+
+    workdir = args.workdir or tempfile.mkdtemp(prefix='procanload-bench-')
+    os.makedirs(workdir, exist_ok=True)
+
+    cohort = SyntheticCohort(   os.path.join(workdir, 'cohort'),
+                                n_patients = args.patients,
+                                n_studies = args.studies,
+                                n_slices = args.slices,
+                                t2_matrix = args.t2_matrix,
+                                dwi_matrix = args.dwi_matrix,
+                                duplicate_slices = args.duplicate_slices
+    )
+    paths = { key: os.path.abspath(value) for key, value in cohort.Generate().items() }
+
+    n_files = sum( len(files) for _, _, files in os.walk(paths['images_dir']) )
+
+    results = RunBenchmark(paths, workdir, args.repeat)
+
+    print(f'{args.patients} patients, {n_files} files, workdir {workdir}')
+
+    for stage, result in results.items():
+
+        rss = f"{result['peak_rss'] / 2**20:.1f} MiB" if result['peak_rss'] else 'n/a'
+        print(f"{stage:<25} {result['seconds']:8.3f} s  {n_files / result['seconds']:8.1f} files/s  peak RSS {rss}")
+
+    report = {  'cohort': { 'patients': args.patients,
+                            'studies': args.studies,
+                            'slices': args.slices,
+                            't2_matrix': args.t2_matrix,
+                            'dwi_matrix': args.dwi_matrix,
+                            'duplicate_slices': args.duplicate_slices,
+                            'files': n_files
+                },
+                'stages': results
+    }
+
+    if args.output:
+
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=4)
+
+    if args.baseline:
+
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+
+        regressions = CompareToBaseline(results, baseline['stages'], args.tolerance)
+
+        for regression in regressions:
+            print(f'REGRESSION {regression}')
+
+        sys.exit(1 if regressions else 0)
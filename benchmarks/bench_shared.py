@@ -0,0 +1,81 @@
+'''
+Volumes returned by worker processes, pickled (ProcessPoolExecutor default) against SharedVolume.
+
+Every worker fills a volume and returns it, the coordinator sums it. The pickled volume is copied into the pipe and out
+of it, the SharedVolume only sends the name of its block.
+
+python benchmarks/bench_shared.py --shape 30,512,512 --volumes 16 --workers 4
+'''
+import sys
+import time
+import argparse
+from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+import numpy as np
+from ProCanLoad.SharedVolume import SharedVolume
+
+
+def Volume(shape: tuple, seed: int) -> np.ndarray:
+
+    return np.full(shape, seed, dtype=np.float32)
+
+
+def Pickled(shape: tuple, seed: int) -> np.ndarray:
+
+    return Volume(shape, seed)
+
+
+def Shared(shape: tuple, seed: int) -> SharedVolume:
+
+    volume = SharedVolume.Empty(shape, np.float32, meta={'seed': seed})
+    volume.array[...] = seed
+
+    return volume.Handoff()
+
+
+def Run(worker, shape: tuple, volumes: int, workers: int) -> tuple:
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+
+        # Workers started before the clock
+        list( executor.map(abs, range(workers)) )
+
+        start = time.perf_counter()
+        total = 0.0
+
+        for result in executor.map(worker, [shape] * volumes, range(volumes)):
+
+            if isinstance(result, SharedVolume):
+
+                with result:
+                    total += float(result.array[0].sum())
+
+            else:
+                total += float(result[0].sum())
+
+        return time.perf_counter() - start, total
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument("--shape", type=str, help="z,y,x of the volumes", default='30,512,512')
+    parser.add_argument("--volumes", type=int, default=16)
+    parser.add_argument("--workers", type=int, default=4)
+    args = parser.parse_args()
+
+    shape = tuple( int(value) for value in args.shape.split(',') )
+    size = np.prod(shape) * 4 / 2**20
+
+    pickled_seconds, pickled_total = Run(Pickled, shape, args.volumes, args.workers)
+    shared_seconds, shared_total = Run(Shared, shape, args.volumes, args.workers)
+
+    assert pickled_total == shared_total
+
+    print(f'{args.volumes} volumes {shape} float32 ({size:.1f} MiB each), {args.workers} workers')
+    print(f'pickled      {pickled_seconds:6.2f} s   {args.volumes * size / pickled_seconds:8.1f} MiB/s')
+    print(f'SharedVolume {shared_seconds:6.2f} s   {args.volumes * size / shared_seconds:8.1f} MiB/s')
@@ -0,0 +1,89 @@
+'''
+Startup benchmark, guards the lazy imports of the package.
+
+Measures `python ProCanLoad/main.py --help` and `import ProCanLoad` + reading a manifest in fresh interpreters,
+and checks that SimpleITK, pydicom, pandas, tqdm and numpy are not imported on these paths.
+Exit code is 1 if the median time is over --max-ms or a heavy dependency was imported.
+
+python benchmarks/bench_startup.py --max-ms 100
+'''
+import os
+import sys
+import json
+import argparse
+import statistics
+import subprocess
+import time
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parents[1]
+
+HEAVY_MODULES = ['SimpleITK', 'pydicom', 'pandas', 'tqdm', 'numpy']
+
+CHECK_IMPORTS = f'''
+import sys
+import ProCanLoad
+from ProCanLoad import JsonUtils, Metrics
+print(",".join(m for m in {HEAVY_MODULES!r} if m in sys.modules))
+'''
+
+COMMANDS = {    'main.py --help':   [sys.executable, str(ROOT / 'ProCanLoad' / 'main.py'), '--help'],
+                'import + manifest':[sys.executable, '-c', 'import ProCanLoad; ProCanLoad.JsonUtils.Load(r"%s")' % (ROOT / 'nifti_files.json')],
+                'python baseline':  [sys.executable, '-c', 'pass']
+}
+
+
+def TimeCommand(command: list, environment: dict, repeat: int) -> float:
+    '''
+    Median wall time in ms of the command in a new interpreter
+    '''
+    times = []
+
+    for _ in range(repeat):
+
+        start = time.perf_counter()
+        subprocess.run(command, env=environment, check=True, stdout=subprocess.DEVNULL)
+        times.append( (time.perf_counter() - start) * 1000 )
+
+    return statistics.median(times)
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument("--repeat", type=int, help="runs per command, the median is reported", default=15)
+    parser.add_argument("--max-ms", type=float, help="fail if the median startup of a command is slower", default=100)
+    parser.add_argument("--output", type=str, help="path/to/results.json", default='')
+    args = parser.parse_args()
+
+    environment = dict(os.environ)
+    environment['PYTHONPATH'] = os.pathsep.join( filter(None, [str(ROOT), environment.get('PYTHONPATH')]) )
+
+    failures = []
+
+    heavy = subprocess.run( [sys.executable, '-c', CHECK_IMPORTS], env=environment, check=True,
+                            capture_output=True, text=True ).stdout.strip()
+
+    if heavy:
+        failures.append(f'heavy modules imported at startup: {heavy}')
+
+    results = {}
+
+    for name, command in COMMANDS.items():
+
+        results[name] = TimeCommand(command, environment, args.repeat)
+        print(f'{name:<20} {results[name]:8.1f} ms')
+
+        if name != 'python baseline' and results[name] > args.max_ms:
+            failures.append(f'{name} took {results[name]:.1f} ms > {args.max_ms} ms')
+
+    if args.output:
+
+        with open(args.output, 'w') as f:
+            json.dump({'median_ms': results, 'heavy_modules': heavy.split(',') if heavy else []}, f, indent=4)
+
+    for failure in failures:
+        print(f'REGRESSION {failure}')
+
+    sys.exit(1 if failures else 0)
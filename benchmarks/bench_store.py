@@ -0,0 +1,102 @@
+'''
+Random patch reads from the .nii.gz files against the chunked VolumeStore (zarr and/or hdf5).
+
+A volume like a T2 (smooth anatomy plus noise) is written as .nii.gz and into the stores, then random patches are read.
+A .nii.gz has to be inflated completely for every patch, the store decompresses only the chunks the patch overlaps.
+Every patch is checked against the NIfTI volume.
+
+python benchmarks/bench_store.py --shape 40,512,512 --patch 8,64,64 --patches 50
+'''
+import os
+import sys
+import time
+import argparse
+import tempfile
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+import numpy as np
+import SimpleITK as sitk
+from ProCanLoad.VolumeStore import VolumeStore
+
+
+def Volume(shape: tuple, seed: int) -> sitk.Image:
+
+    rng = np.random.default_rng(seed)
+    z, y, x = np.meshgrid( *[ np.linspace(-1, 1, size) for size in shape ], indexing='ij' )
+
+    volume = 400 * ( (x / 0.8) ** 2 + (y / 0.6) ** 2 <= 1 ) + 300 * ( (x / 0.25) ** 2 + (y / 0.2) ** 2 + (z / 0.6) ** 2 <= 1 )
+    volume = np.clip( volume + rng.normal(0, 10, shape), 0, 4095 ).astype(np.int16)
+
+    image = sitk.GetImageFromArray(volume)
+    image.SetSpacing( (0.4, 0.4, 3.0) )
+    image.SetOrigin( (-100.0, -100.0, -60.0) )
+
+    return image
+
+
+def Time(read, starts: list) -> tuple:
+
+    start_time = time.perf_counter()
+    patches = [ read(start) for start in starts ]
+
+    return (time.perf_counter() - start_time) / len(starts) * 1000, patches
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument("--shape", type=str, help="z,y,x of the volume", default='40,512,512')
+    parser.add_argument("--patch", type=str, help="z,y,x of the patches", default='8,64,64')
+    parser.add_argument("--chunks", type=str, help="z,y,x chunks of the store", default='8,64,64')
+    parser.add_argument("--patches", type=int, default=50)
+    parser.add_argument("--formats", type=str, default='zarr,hdf5')
+    args = parser.parse_args()
+
+    shape = tuple( int(value) for value in args.shape.split(',') )
+    patch = tuple( int(value) for value in args.patch.split(',') )
+    chunks = tuple( int(value) for value in args.chunks.split(',') )
+
+    rng = np.random.default_rng(0)
+    starts = [ tuple( int(rng.integers(0, size - length + 1)) for size, length in zip(shape, patch) ) for _ in range(args.patches) ]
+
+    image = Volume(shape, 0)
+
+    with tempfile.TemporaryDirectory() as directory:
+
+        nifti = os.path.join(directory, 'T2.nii.gz')
+        sitk.WriteImage(image, nifti)
+
+        def ReadNifti(start: tuple) -> np.ndarray:
+
+            volume = sitk.GetArrayFromImage( sitk.ReadImage(nifti) )
+            return volume[ tuple( slice(first, first + length) for first, length in zip(start, patch) ) ].copy()
+
+        nifti_ms, reference = Time(ReadNifti, starts)
+
+        print(f'volume {shape} int16, patch {patch}, chunks {chunks}')
+        print(f'nii.gz  {nifti_ms:8.2f} ms/patch   {os.path.getsize(nifti) / 2**20:6.2f} MiB on disk   inflated per patch 100.0%')
+
+        # Chunks overlapped by a patch, at most, against the chunks of the volume
+        touched = np.prod( [ -(-(length - 1) // chunk) + 1 if length > 1 else 1 for length, chunk in zip(patch, chunks) ] )
+        total = np.prod( [ -(-size // chunk) for size, chunk in zip(shape, chunks) ] )
+
+        for store_format in args.formats.split(','):
+
+            path = os.path.join(directory, 'cohort' + {'zarr': '.zarr', 'hdf5': '.h5'}[store_format])
+
+            with VolumeStore(path, chunks=chunks) as store:
+                store.Write('patient/study/T2', image)
+
+            size = sum( os.path.getsize(os.path.join(root, name)) for root, _, names in os.walk(path) for name in names ) \
+                   if os.path.isdir(path) else os.path.getsize(path)
+
+            with VolumeStore(path, mode='r') as store:
+                store_ms, patches = Time(lambda start: store.ReadPatch('patient/study/T2', start, patch), starts)
+
+            assert all( np.array_equal(a, b) for a, b in zip(reference, patches) ), f'{store_format} patches differ from the NIfTI'
+
+            print(f'{store_format:<7} {store_ms:8.2f} ms/patch   {size / 2**20:6.2f} MiB on disk   '
+                  f'inflated per patch {100 * touched / total:5.1f}% (at most)   x{nifti_ms / store_ms:.0f} faster')
@@ -0,0 +1,91 @@
+'''
+Peak memory of a T2 .nii.gz written from the whole volume (LoadSlices + WriteDICOM2Nifti) against
+SitkUtils.StreamDICOM2Nifti, slab_slices slices at a time.
+
+Every run is a fresh process, the peak is its maximum resident set size. The .nii inside both files must be identical.
+
+python benchmarks/bench_stream.py --slices 120 --matrix 512 --slab 8
+'''
+import os
+import sys
+import gzip
+import time
+import argparse
+import tempfile
+from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+
+def PeakRSS() -> int:
+
+    import resource
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+def Run(mode: str, slices: list, directory: str, slab: int) -> dict:
+
+    from ProCanLoad.sitk_utils import SitkUtils
+
+    base = PeakRSS()
+    start = time.perf_counter()
+
+    if mode == 'whole':
+        info = SitkUtils.WriteDICOM2Nifti(SitkUtils.LoadSlices(slices, 'LPS'), directory, 'T2')
+    else:
+        info = SitkUtils.StreamDICOM2Nifti(slices, directory, 'T2', 'LPS', slab_slices=slab)
+
+    return {'seconds': time.perf_counter() - start, 'peak_rss': PeakRSS(), 'base_rss': base, 'dtype': info['dtype']}
+
+
+def T2Slices(images_dir: str) -> list:
+
+    import pydicom
+
+    paths = [ os.path.join(root, name) for root, _, names in os.walk(images_dir) for name in names ]
+    headers = [ pydicom.dcmread(path, stop_before_pixels=True) for path in paths ]
+    t2 = [ (float(header.ImagePositionPatient[2]), path) for header, path in zip(headers, paths) if header.Modality == 'MR' and str(header.SeriesDescription).startswith('t2') ]
+
+    return [ {'path': path} for _, path in sorted(t2) ]
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument("--slices", type=int, default=120)
+    parser.add_argument("--matrix", type=int, default=512)
+    parser.add_argument("--slab", type=int, help="slices per slab of the streamed writer", default=8)
+    args = parser.parse_args()
+
+    from ProCanLoad import SyntheticCohort
+
+    with tempfile.TemporaryDirectory() as directory:
+
+        SyntheticCohort(directory, n_patients=1, series_types=('T2',), n_slices=args.slices, t2_matrix=args.matrix).Generate()
+        slices = T2Slices(os.path.join(directory, 'DICOM_images'))
+
+        print(f'T2 {len(slices)} x {args.matrix} x {args.matrix}, slab {args.slab} slices')
+
+        written = {}
+        for mode in ('whole', 'stream'):
+
+            output = os.path.join(directory, mode)
+
+            # max_tasks_per_child is not in Python 3.8, one executor per run keeps the peaks apart
+            with ProcessPoolExecutor(max_workers=1) as executor:
+                result = executor.submit(Run, mode, slices, output, args.slab).result()
+
+            print(f'{mode:<7} {result["seconds"]:6.2f} s   peak RSS {result["peak_rss"] / 2**20:8.1f} MiB '
+                  f'(+{(result["peak_rss"] - result["base_rss"]) / 2**20:7.1f} MiB)   {result["dtype"]}')
+
+        # Read once both have run, the forked processes do not start with the files in memory
+        for mode in ('whole', 'stream'):
+
+            with gzip.open(os.path.join(directory, mode, 'T2.nii.gz'), 'rb') as file:
+                written[mode] = file.read()
+
+        assert written['whole'] == written['stream'], 'the streamed .nii differs'
@@ -19,5 +19,11 @@ setup(
         'simpleitk>=2.1',
         'pydicom',
         'tqdm'
-    ]
+    ],
+
+    # Chunked volume store, DICOM2NII(output_format='zarr' or 'hdf5')
+    extras_require={
+        'zarr': ['zarr'],
+        'hdf5': ['h5py']
+    }
 )